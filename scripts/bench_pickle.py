@@ -0,0 +1,60 @@
+# This file is part of PyKbd
+#
+# Copyright (C) 2019-2020  Nulano
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import copyreg
+import io
+import pickle
+import sys
+from timeit import timeit
+
+from PyKbd.layout import Layout
+
+
+class FieldsPickler(pickle.Pickler):
+    """
+    Pickles Layout field by field like any other dataclass, i.e. without Layout.__reduce__.
+
+    This is not the pickling of layouts before Layout.__reduce__ was added: the keys, shift states
+    and characters inside the fields still pickle through their own __reduce__, so this only measures
+    the flat tables against pickling the same objects one by one.
+    """
+
+    def reducer_override(self, obj):
+        if type(obj) is Layout:
+            return copyreg.__newobj__, (Layout,), dict(vars(obj))
+        return NotImplemented
+
+
+def dumps_fields(layout: Layout) -> bytes:
+    out = io.BytesIO()
+    FieldsPickler(out, pickle.HIGHEST_PROTOCOL).dump(layout)
+    return out.getvalue()
+
+
+def dumps(layout: Layout) -> bytes:
+    return pickle.dumps(layout, pickle.HIGHEST_PROTOCOL)
+
+
+with open(sys.argv[1], "r", encoding="utf-8") as f:
+    layout = Layout.from_json(f.read())
+number = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+for name, function in (("fields", dumps_fields), ("flat", dumps)):
+    data = function(layout)
+    assert pickle.loads(data) == layout
+    dump_time = timeit(lambda: function(layout), number=number) / number
+    load_time = timeit(lambda: pickle.loads(data), number=number) / number
+    print("%-8s %6i bytes  dumps %7.1f us  loads %7.1f us" % (name, len(data), dump_time * 1e6, load_time * 1e6))
@@ -10,8 +10,7 @@ with open(sys.argv[1] + ".json", "r", encoding="utf-8") as f:
 
 layout = Layout.from_json(data)
 
+shared = {}
 for arch in (X86, AMD64, WOW64):
-    windll = WinDll(layout, arch)
-    data = windll.compile()
-    with open(sys.argv[1] + arch.suffix + ".dll", "wb") as f:
-        f.write(data)
+    windll = WinDll(layout, arch, shared=shared)
+    windll.compile_to(sys.argv[1] + arch.suffix + ".dll")
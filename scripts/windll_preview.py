@@ -22,9 +22,7 @@ from PyKbd.layout import Layout
 from PyKbd.visualizer import draw_keyboard, ISO, draw_dead_keys
 
 windll = WinDll()
-
-with open(sys.argv[1], "rb") as f:
-    windll.decompile(f.read())
+windll.decompile_file(sys.argv[1])
 
 draw_keyboard(windll.layout, ISO).show()
 draw_dead_keys(windll.layout).show()
@@ -6,6 +6,7 @@ setup(
     description='a cross-platform Python library for creating and manipulating keyboard layouts',
     packages=['PyKbd'],
     package_dir={'PyKbd': 'src/PyKbd'},
+    extras_require={'numpy': ['numpy']},
     author='Nulano',
     author_email='nulano@nulano.eu',
     license='GNU APGLv3 or later'
@@ -0,0 +1,156 @@
+# This file is part of PyKbd
+#
+# Copyright (C) 2019-2020  Nulano
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+asyncio counterparts of the compile, decompile and render entry points.
+
+The work runs in an executor, the default executor of the event loop if none is given.
+Process executors avoid the GIL, but arguments and results must be pickled.
+
+Every coroutine accepts a timeout in seconds and raises asyncio.TimeoutError when it expires.
+Jobs that have not started when they are cancelled or time out never run.
+Compiles in thread executors also stop at the next pipeline stage,
+other running jobs finish in the background and their result is discarded.
+"""
+
+import asyncio
+import threading
+from concurrent.futures import CancelledError, Executor, ProcessPoolExecutor
+from functools import partial
+from typing import Awaitable, Callable, Iterable, List, Optional, Tuple, TypeVar
+
+from . import _version
+from .compile_windll import WinDll, decompile_bytes
+from .layout import Layout
+from .wintypes import Architecture
+from .windows.dll import Decompiler
+
+
+__version__ = _version
+
+
+T = TypeVar("T")
+
+
+async def run(function: Callable[..., T], *args, executor: Optional[Executor] = None,
+              timeout: Optional[float] = None) -> T:
+    """Await function(*args) run in executor."""
+    future = asyncio.get_running_loop().run_in_executor(executor, function, *args)
+    return await asyncio.wait_for(future, timeout)
+
+
+def _check_cancelled(cancelled: threading.Event, stage, target):
+    if cancelled.is_set():
+        raise CancelledError("compile cancelled before %s" % stage.name)
+
+
+def _compile(layout: Layout, architecture: Optional[Architecture], options: dict,
+             cancelled: Optional[threading.Event] = None) -> bytes:
+    windll = WinDll(layout, architecture, **options)
+    if cancelled is not None:
+        windll.pipeline.before.append(partial(_check_cancelled, cancelled))
+    return windll.compile()
+
+
+def _decompile(data: bytes, options: dict):
+    return Decompiler(data, **options).decompile()
+
+
+def _draw_keyboard(layout: Layout, keyboard):
+    # Pillow is only needed for rendering
+    from . import visualizer
+
+    return visualizer.draw_keyboard(layout, keyboard)
+
+
+async def compile(layout: Layout, architecture: Optional[Architecture] = None, *,
+                  executor: Optional[Executor] = None, timeout: Optional[float] = None, **options) -> bytes:
+    """
+    Counterpart of WinDll(layout, architecture, **options).compile().
+
+    :param options: keyword arguments of WinDll, e.g. optimize_size
+    """
+    cancelled = None if isinstance(executor, ProcessPoolExecutor) else threading.Event()
+    try:
+        return await run(_compile, layout, architecture, options, cancelled, executor=executor, timeout=timeout)
+    finally:
+        # stops a compile still running in a thread after a timeout or cancellation
+        if cancelled is not None:
+            cancelled.set()
+
+
+async def decompile(data: bytes, *, executor: Optional[Executor] = None, timeout: Optional[float] = None,
+                    **options):
+    """
+    Counterpart of Decompiler(data, **options).decompile().
+
+    :param options: keyword arguments of Decompiler, e.g. max_nodes
+    """
+    return await run(_decompile, bytes(data), options, executor=executor, timeout=timeout)
+
+
+async def decompile_layout(data: bytes, *, executor: Optional[Executor] = None,
+                           timeout: Optional[float] = None) -> Layout:
+    """Counterpart of WinDll.decompile(data), returns the layout."""
+    return await run(decompile_bytes, bytes(data), executor=executor, timeout=timeout)
+
+
+async def draw_keyboard(layout: Layout, keyboard, *, executor: Optional[Executor] = None,
+                        timeout: Optional[float] = None):
+    """Counterpart of visualizer.draw_keyboard(layout, keyboard), requires Pillow."""
+    return await run(_draw_keyboard, layout, keyboard, executor=executor, timeout=timeout)
+
+
+async def gather(awaitables: Iterable[Awaitable[T]], limit: Optional[int] = None,
+                 return_exceptions: bool = False) -> List[T]:
+    """
+    Like asyncio.gather, but awaits at most limit awaitables at once.
+
+    Limiting is useful with the default executor, which would otherwise queue all jobs at once.
+    """
+    if limit is None:
+        return await asyncio.gather(*awaitables, return_exceptions=return_exceptions)
+    semaphore = asyncio.Semaphore(limit)
+
+    async def limited(awaitable):
+        async with semaphore:
+            return await awaitable
+
+    return await asyncio.gather(*map(limited, awaitables), return_exceptions=return_exceptions)
+
+
+async def compile_many(jobs: Iterable[Tuple[Layout, Architecture]], *, limit: Optional[int] = None,
+                       return_exceptions: bool = False, **kwargs) -> List[bytes]:
+    """
+    Compile many layouts concurrently, see compile().
+
+    :param jobs: pairs of layout and architecture
+    :param limit: maximum number of concurrent jobs
+    :param return_exceptions: return exceptions of failed jobs in place of their result instead of raising the first
+    """
+    return await gather((compile(layout, arch, **kwargs) for layout, arch in jobs), limit, return_exceptions)
+
+
+async def decompile_many(data: Iterable[bytes], *, limit: Optional[int] = None,
+                         return_exceptions: bool = False, **kwargs) -> list:
+    """Decompile many DLLs concurrently, see decompile() and compile_many()."""
+    return await gather((decompile(item, **kwargs) for item in data), limit, return_exceptions)
+
+
+async def draw_keyboards(layouts: Iterable[Layout], keyboard, *, limit: Optional[int] = None,
+                         return_exceptions: bool = False, **kwargs) -> list:
+    """Draw many layouts concurrently, see draw_keyboard() and compile_many()."""
+    return await gather((draw_keyboard(layout, keyboard, **kwargs) for layout in layouts), limit, return_exceptions)
@@ -0,0 +1,312 @@
+# This file is part of PyKbd
+#
+# Copyright (C) 2019-2020  Nulano
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Command-line interface, run as ``python -m PyKbd``.
+
+Every subcommand accepts any number of inputs and glob patterns, processes them in one process
+or in a pool of ``--jobs`` processes, and prints one line per input as soon as it is done.
+The ``watch`` subcommand keeps running and compiles JSON layouts whenever they change, see watch module,
+the ``serve`` subcommand runs a compile server, see server module.
+Layouts are read from ``.json`` files or decompiled from ``.dll`` files.
+"""
+
+import argparse
+import glob
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+from time import perf_counter
+from typing import Callable, Iterable, List, Optional
+
+from . import _version
+from .compile_windll import WinDll
+from .layout import Layout
+from .profiling import worker_initializer
+from .wintypes import AMD64, WOW64, X86
+
+
+__version__ = _version
+
+
+ARCHITECTURES = {"x86": X86, "wow64": WOW64, "amd64": AMD64}
+
+KEYBOARDS = ("iso", "ansi")
+"""physical keyboards of the render command, names of visualizer keyboards in lower case"""
+
+
+def _expand(patterns: Iterable[str], suffix: Optional[str] = None) -> List[str]:
+    """
+    Expand glob patterns, other inputs are passed through even if they do not exist.
+
+    :param suffix: only keep glob matches with this suffix
+    """
+    paths = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            paths.extend(path for path in sorted(glob.glob(pattern, recursive=True))
+                         if suffix is None or path.lower().endswith(suffix))
+        else:
+            paths.append(pattern)
+    return paths
+
+
+def _load(path: str) -> Layout:
+    if path.lower().endswith(".dll"):
+        windll = WinDll()
+        windll.decompile_file(path)
+        return windll.layout
+    with open(path, "r", encoding="utf-8") as f:
+        return Layout.from_json(f.read())
+
+
+def _output(path: str, output: Optional[str], suffix: str) -> str:
+    directory = output if output is not None else os.path.dirname(path)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(directory, stem + suffix)
+
+
+def _compile(path: str, architectures: List[str], output: Optional[str],
+             optimize_size: bool = False, merge_sections: bool = False) -> List[dict]:
+    layout = _load(path)
+    results = []
+    shared = {}
+    for name in architectures:
+        arch = ARCHITECTURES[name]
+        start = perf_counter()
+        windll = WinDll(layout, arch, optimize_size=optimize_size, merge_sections=merge_sections, shared=shared)
+        target = _output(path, output, arch.suffix + ".dll")
+        size = windll.compile_to(target)
+        results.append({"input": path, "output": target, "architecture": arch.name,
+                        "size": size, "time": perf_counter() - start})
+    return results
+
+
+def _decompile(path: str, output: Optional[str]) -> List[dict]:
+    if not path.lower().endswith(".dll"):
+        raise ValueError("not a DLL")
+    start = perf_counter()
+    layout = _load(path)
+    target = _output(path, output, ".json")
+    data = layout.to_json()
+    with open(target, "w", encoding="utf-8") as f:
+        f.write(data)
+    return [{"input": path, "output": target, "size": len(data), "time": perf_counter() - start}]
+
+
+def _render(path: str, output: Optional[str], keyboard: str) -> List[dict]:
+    # Pillow is only needed for rendering
+    from . import visualizer
+
+    start = perf_counter()
+    layout = _load(path)
+    results = []
+    for suffix, image in ((".png", visualizer.draw_keyboard(layout, getattr(visualizer, keyboard.upper()))),
+                          ("_dead.png", visualizer.draw_dead_keys(layout))):
+        target = _output(path, output, suffix)
+        image.save(target)
+        results.append({"input": path, "output": target, "size": os.path.getsize(target),
+                        "time": perf_counter() - start})
+    return results
+
+
+def _convert(path: str, to: str, architectures: List[str], output: Optional[str]) -> List[dict]:
+    if to == "json":
+        return _decompile(path, output)
+    return _compile(path, architectures, output)
+
+
+def _bench(path: str, architectures: List[str], repeat: int) -> List[dict]:
+    layout = _load(path)
+    results = []
+    for name in architectures:
+        arch = ARCHITECTURES[name]
+        compile_times, decompile_times = [], []
+        for _ in range(repeat):
+            start = perf_counter()
+            data = WinDll(layout, arch).compile()
+            compile_times.append(perf_counter() - start)
+            start = perf_counter()
+            WinDll().decompile(data)
+            decompile_times.append(perf_counter() - start)
+        results.append({"input": path, "architecture": arch.name, "size": len(data), "repeat": repeat,
+                        "compile_min": min(compile_times), "compile_mean": sum(compile_times) / repeat,
+                        "decompile_min": min(decompile_times), "decompile_mean": sum(decompile_times) / repeat})
+    return results
+
+
+def _safe(function: Callable[[str], List[dict]], path: str) -> List[dict]:
+    try:
+        return function(path)
+    except Exception as e:
+        return [{"input": path, "error": "%s: %s" % (type(e).__name__, e)}]
+
+
+def run(function: Callable[[str], List[dict]], paths: List[str], jobs: int = 1) -> Iterable[dict]:
+    """
+    Apply function to each path, yielding results as they are ready.
+
+    :param function: picklable if jobs > 1, returns a list of result dicts for a path
+    :param jobs: number of worker processes, 1 to run in this process
+    """
+    if jobs <= 1 or len(paths) <= 1:
+        for path in paths:
+            yield from _safe(function, path)
+        return
+    with ProcessPoolExecutor(jobs, initializer=worker_initializer) as executor:
+        futures = [executor.submit(_safe, function, path) for path in paths]
+        for future in as_completed(futures):
+            yield from future.result()
+
+
+def _format(result: dict) -> str:
+    if "error" in result:
+        return "%s: error: %s" % (result["input"], result["error"])
+    if "compile_min" in result:
+        return "%s [%s]: compile %.2f ms (mean %.2f ms), decompile %.2f ms (mean %.2f ms), %i bytes" % (
+            result["input"], result["architecture"],
+            result["compile_min"] * 1000, result["compile_mean"] * 1000,
+            result["decompile_min"] * 1000, result["decompile_mean"] * 1000, result["size"],
+        )
+    return "%s -> %s (%i bytes, %.2f ms)" % (result["input"], result["output"], result["size"], result["time"] * 1000)
+
+
+def _positive(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1: %s" % value)
+    return number
+
+
+def _parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m PyKbd", description="Compile and inspect keyboard layouts.")
+    parser.add_argument("--version", action="version", version="PyKbd " + _version)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def command(name, help, jobs=True):
+        sub = commands.add_parser(name, help=help)
+        sub.add_argument("inputs", nargs="+", metavar="INPUT", help="layout files (.json or .dll) or glob patterns")
+        if jobs:
+            sub.add_argument("-j", "--jobs", type=_positive, default=1, help="number of worker processes")
+        sub.add_argument("--json", action="store_true", help="print results as JSON lines")
+        return sub
+
+    def architectures(sub):
+        sub.add_argument("-a", "--arch", action="append", choices=sorted(ARCHITECTURES), dest="architectures",
+                         help="target architecture, may be repeated (default: all)")
+
+    def output(sub):
+        sub.add_argument("-o", "--output", help="output directory (default: next to each input)")
+
+    sub = command("compile", "compile layouts to DLLs")
+    architectures(sub)
+    output(sub)
+    sub.add_argument("--optimize-size", action="store_true", help="use the smallest section alignment")
+    sub.add_argument("--merge-sections", action="store_true", help="place resources and relocations into one section")
+
+    sub = command("decompile", "decompile DLLs to JSON layouts")
+    output(sub)
+
+    sub = command("render", "draw keyboard images of layouts, requires Pillow")
+    output(sub)
+    sub.add_argument("-k", "--keyboard", default="iso", choices=KEYBOARDS, help="physical keyboard layout")
+
+    sub = command("convert", "convert layouts between formats")
+    architectures(sub)
+    output(sub)
+    sub.add_argument("--to", required=True, choices=["json", "dll"], help="output format")
+
+    sub = command("bench", "measure compile and decompile times")
+    architectures(sub)
+    sub.add_argument("-n", "--repeat", type=_positive, default=10, help="number of runs per layout and architecture")
+
+    sub = command("watch", "compile JSON layouts whenever they change", jobs=False)
+    architectures(sub)
+    output(sub)
+    sub.add_argument("--optimize-size", action="store_true", help="use the smallest section alignment")
+    sub.add_argument("--merge-sections", action="store_true", help="place resources and relocations into one section")
+    sub.add_argument("--interval", type=float, default=0.1, help="seconds between checks for changes")
+    sub.add_argument("--debounce", type=float, default=0.05, help="seconds a file must stay unchanged")
+
+    sub = commands.add_parser("serve", help="run a compile server, see server module")
+    sub.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    sub.add_argument("-p", "--port", type=int, default=8470, help="port to listen on")
+    sub.add_argument("--socket", help="listen on a Unix socket instead")
+    sub.add_argument("-w", "--workers", type=_positive, help="number of worker processes (default: number of CPUs)")
+    sub.add_argument("--backlog", type=_positive, default=16,
+                     help="number of waiting jobs before requests are rejected")
+    sub.add_argument("--max-body", type=_positive, default=16 * 1024 * 1024, help="maximum request size in bytes")
+
+    return parser
+
+
+def _watch(args, architectures: List[str]) -> int:
+    from .watch import Watcher
+
+    watcher = Watcher(args.inputs, [ARCHITECTURES[name] for name in architectures], args.output,
+                      debounce=args.debounce, interval=args.interval,
+                      optimize_size=args.optimize_size, merge_sections=args.merge_sections)
+    try:
+        watcher.run(lambda result: print(json.dumps(result) if args.json else _format(result), flush=True))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def _serve(args) -> int:
+    from .server import Server
+
+    server = Server(args.socket or (args.host, args.port), args.workers, args.backlog, verbose=True,
+                    max_body=args.max_body)
+    print("serving on %s" % (server.address,), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = _parser().parse_args(argv)
+    if args.command == "serve":
+        return _serve(args)
+    archs = getattr(args, "architectures", None) or ["x86", "wow64", "amd64"]
+    if getattr(args, "output", None) is not None:
+        os.makedirs(args.output, exist_ok=True)
+    if args.command == "watch":
+        return _watch(args, archs)
+    if args.command == "compile":
+        function = partial(_compile, architectures=archs, output=args.output,
+                           optimize_size=args.optimize_size, merge_sections=args.merge_sections)
+    elif args.command == "decompile":
+        function = partial(_decompile, output=args.output)
+    elif args.command == "render":
+        function = partial(_render, output=args.output, keyboard=args.keyboard)
+    elif args.command == "convert":
+        function = partial(_convert, to=args.to, architectures=archs, output=args.output)
+    else:
+        function = partial(_bench, architectures=archs, repeat=args.repeat)
+
+    # globs of commands reading DLLs skip other files, e.g. the JSON layouts they write
+    reads_dll = args.command == "decompile" or args.command == "convert" and args.to == "json"
+    failed = False
+    for result in run(function, _expand(args.inputs, ".dll" if reads_dll else None), args.jobs):
+        failed = failed or "error" in result
+        print(json.dumps(result) if args.json else _format(result), flush=True)
+    return 1 if failed else 0
@@ -17,15 +17,20 @@
 import dataclasses
 from bisect import bisect_left
 from collections import defaultdict
+from mmap import mmap, ACCESS_READ
 from operator import itemgetter
+from os import PathLike, fspath
 from time import time
-from typing import Union, List
-from warnings import warn
+from typing import Union, Dict, Iterable, List, BinaryIO
 
 from . import _version, _version_num
 from .layout import *
 from .wintypes import *
-from .linker_binary import BinaryObject, BinaryObjectReader, link
+from .linker_binary import BinaryObject, BinaryObjectReader, LinkerMap, link, link_to, link_into
+from .pipeline import Pipeline, Stage, StageStats
+from .profiling import Profiler, profiled
+from . import tracing
+from .tracing import warn
 
 
 __version__ = _version
@@ -70,29 +75,175 @@ class WinDll:
     align_file: int = 0x200
     align_section: int = 0x1000
 
-    def __init__(self, layout: Optional[Layout] = None, architecture: Optional[Architecture] = None):
+    # compile-only
+    optimize_size: bool = False
+    merge_sections: bool = False
+    emit_map: bool = False
+    linker_map: Optional[LinkerMap] = None
+    pipeline: Optional[Pipeline] = None
+    stage_stats: Optional[List[StageStats]] = None  # stats of the stages of the last compile, see Pipeline.run()
+    shared: Optional[dict] = None
+
+    def __init__(self, layout: Optional[Layout] = None, architecture: Optional[Architecture] = None,
+                 optimize_size: bool = False, merge_sections: bool = False, emit_map: bool = False,
+                 pipeline: Optional[Pipeline] = None, shared: Optional[dict] = None):
+        """
+        :param optimize_size: use the smallest section alignment accepted by the loader, so that sections
+                              are not padded to whole pages in memory; this reduces SizeOfImage, the file
+                              size stays the same as sections are still padded to the file alignment
+        :param merge_sections: place resources and relocations into one section, so that one section less
+                               is padded to the file alignment; this reduces the file size, the section is
+                               not executable, unlike .data with the KbdLayerDescriptor code
+        :param emit_map: store a map of the compiled image in linker_map
+        :param pipeline: compile stages, see default_pipeline()
+        :param shared: cache of architecture-independent tables, see compile_all(); an entry is reused while
+                       the options and the parts of the layout it was computed from are equal, e.g. by another
+                       layout with only a different name, layouts must not be modified while it is in use
+        """
         self.layout = layout or Layout()
         self.architecture = architecture or AMD64
 
         self.timestamp = int(time())
 
-    def compile(self) -> bytes:
-        self.compile_kbd_keymap()
-        self.compile_kbd_charmap()
-        # self.compile_kbd_ligature()
-        self.compile_tables()
-        self.compile_dir_export()
-        self.compile_dir_resource()
-        self.link()
-        self.compile_dir_reloc()
-        self.compile_header()
-        self.assemble()
+        self.optimize_size = optimize_size
+        self.merge_sections = merge_sections
+        self.emit_map = emit_map
+        self.pipeline = pipeline or self.default_pipeline()
+        self.shared = shared
+        if optimize_size:
+            # SectionAlignment may be below page size only if it equals FileAlignment,
+            # the image is then mapped as-is, i.e. file offsets must equal RVAs
+            if self.align_section not in (WinDll.align_section, self.align_file):
+                raise ValueError("optimize_size requires align_section equal to align_file")
+            self.align_section = self.align_file
+
+    @staticmethod
+    def default_pipeline() -> Pipeline:
+        """Stages run by compile(), compile_to() and compile_into() stop before assemble."""
+        return Pipeline([
+            Stage("compile_kbd_keymap", WinDll.compile_kbd_keymap,
+                  ("kbd_vsc_to_vk", "kbd_vsc_to_vk_e0", "kbd_vsc_to_vk_e1", "kbd_key_names", "kbd_key_names_ext")),
+            Stage("compile_kbd_charmap", WinDll.compile_kbd_charmap,
+                  ("kbd_modifiers", "kbd_vk_to_wchar_table", "kbd_dead_key", "kbd_key_names_dead")),
+            # Stage("compile_kbd_ligature", WinDll.compile_kbd_ligature),
+            Stage("compile_tables", WinDll.compile_tables, ("kbdtables",)),
+            Stage("compile_dir_export", WinDll.compile_dir_export, ("dir_export",)),
+            Stage("compile_dir_resource", WinDll.compile_dir_resource, ("dir_resource",)),
+            Stage("link", WinDll.link, ("sec_data", "sec_rsrc", "sec_reloc")),
+            Stage("compile_dir_reloc", WinDll.compile_dir_reloc, ("dir_reloc",)),
+            Stage("compile_header", WinDll.compile_header, ("sec_HEADER",)),
+            Stage("linker_map", WinDll.compile_linker_map),
+            Stage("assemble", WinDll.assemble, ("assembly",)),
+        ])
+
+    def compile(self, profile: Optional[Profiler] = None) -> bytes:
+        """:param profile: profile the run, see profiling module"""
+        with profiled(profile, "compile %s" % self.layout.dll_name), self._span("compile") as span:
+            self.stage_stats = self.pipeline.run(self)
+            span.set(size=len(self.assembly.data))
 
         return bytes(self.assembly.data)
 
-    def decompile(self, data: bytes):
-        self.assembly = BinaryObject(data, alignment=self.align_file)
+    def compile_to(self, file: Union[str, PathLike, BinaryIO], profile: Optional[Profiler] = None) -> int:
+        """
+        Compile and write the image directly to a file, without assembling it in memory.
+
+        :param file: path or writable binary file object
+        :param profile: profile the run, see profiling module
+        :return: number of bytes written
+        """
+        with profiled(profile, "compile %s" % self.layout.dll_name), self._span("compile") as span:
+            self.compile_sections()
+
+            with tracing.span("write", path=fspath(file) if isinstance(file, (str, PathLike)) else None) as write:
+                if isinstance(file, (str, PathLike)):
+                    with open(file, "wb") as f:
+                        length = self.assemble_to(f)
+                else:
+                    length = self.assemble_to(file)
+                write.set(size=length)
+            span.set(size=length)
+            return length
+
+    def compile_into(self, buffer, profile: Optional[Profiler] = None) -> int:
+        """
+        Compile and write the image directly into a writable buffer, without assembling it in memory.
+
+        :param buffer: object supporting the writable buffer protocol, e.g. bytearray or mmap
+        :param profile: profile the run, see profiling module
+        :return: number of bytes written
+        """
+        with profiled(profile, "compile %s" % self.layout.dll_name), self._span("compile") as span:
+            self.compile_sections()
+
+            with tracing.span("write") as write:
+                length = link_into(self._assembly_objects(), buffer)
+                write.set(size=length)
+            span.set(size=length)
+            return length
 
+    def compile_sections(self):
+        self.stage_stats = self.pipeline.run(self, stop="assemble")
+
+    def _shared(self, function, *inputs):
+        """
+        Result of an architecture-independent part of a stage, computed once per options and inputs.
+
+        :param inputs: the parts of the layout read by function, the cached result is reused while they are equal
+        """
+        if self.shared is None:
+            return function()
+        key = function.__name__, self.optimize_size, self.merge_sections
+        entry = self.shared.get(key)
+        if entry is None or not all(a is b or a == b for a, b in zip(entry[0], inputs)):
+            entry = self.shared[key] = inputs, function()
+        else:
+            tracing.count("cache_hits")
+        return entry[1]
+
+    def _span(self, event: str, **fields):
+        return tracing.span(event, layout=self.layout.name, architecture=self.architecture.name, **fields)
+
+    def compile_linker_map(self):
+        if self.emit_map:
+            self.linker_map = self._linker_map()
+
+    def _linker_map(self) -> LinkerMap:
+        # must run before assembling, addresses are RVAs only until then
+        linker_map = LinkerMap()
+        linker_map.add("headers", self.sec_HEADER)
+        for name, first, last, characteristics in self._sections():
+            for section in (self.sec_data, self.sec_rsrc, self.sec_reloc):
+                if first.placement[1] <= section.placement[1] <= last.placement[1]:
+                    linker_map.add(name.rstrip(b"\0").decode("ascii"), section)
+        return linker_map
+
+    def decompile(self, data: bytes, profile: Optional[Profiler] = None):
+        """:param profile: profile the run, see profiling module"""
+        with profiled(profile, "decompile"), tracing.span("decompile", size=len(data)) as span:
+            self.assembly = BinaryObject(data, alignment=self.align_file)
+            self.decompile_assembly()
+            span.set(layout=self.layout.name, architecture=self.architecture.name)
+
+    def decompile_file(self, path: Union[str, PathLike], profile: Optional[Profiler] = None):
+        """
+        Decompile a DLL by mapping it into memory instead of reading it.
+
+        Only the parts of the file that are needed are read. The mapping is closed before returning,
+        so unlike decompile(), assembly is not kept.
+
+        :param profile: profile the run, see profiling module
+        """
+        with profiled(profile, "decompile %s" % fspath(path)), tracing.span("decompile", path=fspath(path)) as span, \
+                open(path, "rb") as f, mmap(f.fileno(), 0, access=ACCESS_READ) as data:
+            self.assembly = BinaryObject.wrap(data, alignment=self.align_file)
+            try:
+                self.decompile_assembly()
+            finally:
+                self.assembly = None
+            span.set(size=len(data), layout=self.layout.name, architecture=self.architecture.name)
+
+    def decompile_assembly(self):
         self.decompile_header()
         # skipping .reloc
         self.decompile_dir_export()
@@ -118,16 +269,16 @@ class WinDll:
                 break
         return bytes(data), len(data) // entry_size - 1
 
-    def compile_kbd_keymap(self):
+    def _keymap_tables(self):
+        """Architecture-independent part of compile_kbd_keymap: scan code tables and key name entries"""
         vsc_to_vk = BinaryObject(alignment=4)
         vsc_to_vk.append(USHORT(0xFF))
         for vsc in range(1, max(map(lambda k: k.code, filter(lambda k: k.prefix == 0, self.layout.keymap))) + 1):
             key = self.layout.keymap.get(ScanCode(vsc), KeyCode(0xFF))
             vsc_to_vk.append(USHORT(key.win_vk))
-        self.kbd_vsc_to_vk = vsc_to_vk
 
-        key_names = BinaryObject(alignment=8)
-        key_names_ext = BinaryObject(alignment=8)
+        key_names = []
+        key_names_ext = []
         vsc_to_vk_e0 = BinaryObject(alignment=4)
         vsc_to_vk_e1 = BinaryObject(alignment=4)
         for scan_code, key_code in self.layout.keymap.items():
@@ -140,27 +291,34 @@ class WinDll:
             if key_code.name:
                 # Pause (E1-1D-45)
                 if scan_code == ScanCode(0x1D, 0xE1):
-                    key_names.append(BYTE(0x45))
-                    key_names.append(LPTR(self.architecture, WSTR(key_code.name)))
+                    key_names.append((0x45, key_code.name))
                 # extended (E0-XX) or NumLock (45); (E0-45) is not in use
                 elif scan_code.prefix == 0xE0 or scan_code.code == 0x45:
-                    key_names_ext.append(BYTE(scan_code.code))
-                    key_names_ext.append(LPTR(self.architecture, WSTR(key_code.name)))
+                    key_names_ext.append((scan_code.code, key_code.name))
                 else:
-                    key_names.append(BYTE(scan_code.code))
-                    key_names.append(LPTR(self.architecture, WSTR(key_code.name)))
-        key_names.append(BYTE(0))
-        key_names.append(LPTR(self.architecture, None))
-        self.kbd_key_names = key_names
-        key_names_ext.append(BYTE(0))
-        key_names_ext.append(LPTR(self.architecture, None))
-        self.kbd_key_names_ext = key_names_ext
+                    key_names.append((scan_code.code, key_code.name))
         vsc_to_vk_e0.append(BYTE(0))
         vsc_to_vk_e0.append(USHORT(0))
-        self.kbd_vsc_to_vk_e0 = vsc_to_vk_e0
         vsc_to_vk_e1.append(BYTE(0))
         vsc_to_vk_e1.append(USHORT(0))
-        self.kbd_vsc_to_vk_e1 = vsc_to_vk_e1
+        return bytes(vsc_to_vk.data), bytes(vsc_to_vk_e0.data), bytes(vsc_to_vk_e1.data), key_names, key_names_ext
+
+    def _key_names(self, entries: List[Tuple[int, str]], name: str) -> BinaryObject:
+        key_names = BinaryObject(alignment=8, name=name)
+        for code, key_name in entries:
+            key_names.append(BYTE(code))
+            key_names.append(LPTR(self.architecture, WSTR(key_name)))
+        key_names.append(BYTE(0))
+        key_names.append(LPTR(self.architecture, None))
+        return key_names
+
+    def compile_kbd_keymap(self):
+        vsc_to_vk, vsc_to_vk_e0, vsc_to_vk_e1, key_names, key_names_ext = self._shared(self._keymap_tables, self.layout.keymap)
+        self.kbd_vsc_to_vk = BinaryObject(vsc_to_vk, alignment=4, name="VSC_TO_VK")
+        self.kbd_key_names = self._key_names(key_names, "KEY_NAMES")
+        self.kbd_key_names_ext = self._key_names(key_names_ext, "KEY_NAMES_EXT")
+        self.kbd_vsc_to_vk_e0 = BinaryObject(vsc_to_vk_e0, alignment=4, name="VSC_TO_VK_E0")
+        self.kbd_vsc_to_vk_e1 = BinaryObject(vsc_to_vk_e1, alignment=4, name="VSC_TO_VK_E1")
 
     def decompile_kbd_keymap(self):
         self.layout.keymap = {}
@@ -223,17 +381,20 @@ class WinDll:
                 continue
             self.layout.keymap[scancode] = get_keycode(scancode, vk)
         
-    def compile_kbd_charmap(self):
+    def _charmap_tables(self):
+        """
+        Architecture-independent part of compile_kbd_charmap:
+        modifier and character tables without pointers, number of shift states and dead key names
+        """
         vk_to_bits = BinaryObject(alignment=4)
         for key, shift in {0x10: 1, 0x11: 2, 0x12: 4, 0x15: 8}.items():  # pretty much guaranteed
             vk_to_bits.append(BYTE(key))
             vk_to_bits.append(BYTE(shift))
         vk_to_bits.append(WORD(0))  # end of table
 
-        max_mask = 0
-        shift_states = []
-        shift_state_map = {}
+        used_states = set()
         vk_attributes = {}
+        vk_characters = {}
         for scancode, keycode in self.layout.keymap.items():
             vk = KeyCode.translate_vk(keycode.win_vk)
             if vk in (0, 0xFF) or len(self.layout.charmap.get(vk, {})) == 0:
@@ -242,87 +403,74 @@ class WinDll:
                 warn("unknown special vk, skipping: 0x%X" % vk)
                 continue
             vk_attributes[vk] = keycode.attributes
-            for shiftstate, character in self.layout.charmap[vk].items():
-                shiftstate = dataclasses.replace(shiftstate, capslock=False)
-                if shiftstate not in shift_state_map:
-                    shift_state_map[shiftstate] = len(shift_state_map)
-                    shift_states.append(shiftstate)
-                    max_mask = max(max_mask, shiftstate.to_bits())
+            # shift states as bits, see iter_characters
+            vk_characters[vk] = characters = list(iter_characters(self.layout.charmap[vk]))
+            used_states.update(shiftstate & 0xF for shiftstate, char, dead in characters)  # without capslock
+
+        # columns in the order of the shift state bits, so that the output does not depend on the order
+        # in which the charmap stores the characters of a key
+        shift_states = sorted(used_states)
+        shift_state_map = {shiftstate: column for column, shiftstate in enumerate(shift_states)}
+        max_mask = max(shift_states, default=0)
 
         if len(shift_state_map) >= 15:
             raise RuntimeError("Too many shift states: %i >= 15" % len(shift_state_map))
         elif len(shift_state_map) > 10:
             warn("Too many shift states: %i > 10" % len(shift_state_map))
 
-        modifiers = BinaryObject(alignment=8)
-        modifiers.append(LPTR(self.architecture, vk_to_bits))
+        # follows the pointer to vk_to_bits
+        modifiers = BinaryObject(alignment=2)
         modifiers.append(WORD(max_mask))
         for mask in range(max_mask + 1):
-            modifiers.append(BYTE(shift_state_map.get(ShiftState.from_bits(mask), 0xF)))
-        self.kbd_modifiers = modifiers
+            modifiers.append(BYTE(shift_state_map.get(mask, 0xF)))
 
         vk_to_wchars = BinaryObject(alignment=2)
         for vk, attributes in sorted(vk_attributes.items(), key=lambda e: KeyCode.untranslate_vk(e[0])):
-            characters = self.layout.charmap[vk]
+            characters = {shiftstate: "\uF001" if dead else char  # WCH_DEAD
+                          for shiftstate, char, dead in vk_characters[vk]}
 
             secondary = {}
-            dead = {shiftstate: character.char
-                    for shiftstate, character in characters.items()
-                    if character.dead and not shiftstate.capslock}
+            dead = {shiftstate: char
+                    for shiftstate, char, dead in vk_characters[vk]
+                    if dead and not shiftstate & 0x10}
 
             if attributes.capslock_secondary:
                 if dead:
                     warn("CAPSLOCK_SECONDARY is incompatible with dead keys, ignoring")
                     attributes = dataclasses.replace(attributes, capslock_secondary=False)
                 else:
-                    secondary = {dataclasses.replace(shiftstate, capslock=False): character
-                                 for shiftstate, character in characters.items()
-                                 if shiftstate.capslock}
+                    secondary = {shiftstate & 0xF: char
+                                 for shiftstate, char in characters.items()
+                                 if shiftstate & 0x10}
                     # while unusual, deadkeys are valid in secondary capslock layer
-                    dead = {dataclasses.replace(shiftstate, capslock=False): character
-                            for shiftstate, character in characters.items()
-                            if character.dead and shiftstate.capslock}
+                    dead = {shiftstate & 0xF: char
+                            for shiftstate, char, dead in vk_characters[vk]
+                            if dead and shiftstate & 0x10}
 
             # base row
             vk_to_wchars.append(BYTE(vk))
             vk_to_wchars.append(BYTE(attributes.to_bits()))  # Attributes
-            for shiftstate in range(len(shift_states)):
-                character = characters.get(shift_states[shiftstate], Character("\uF000"))  # WCH_NONE
-                if character.dead:
-                    character = Character("\uF001")  # WCH_DEAD
-                vk_to_wchars.append(WCHAR(character.char))
+            for shiftstate in shift_states:
+                vk_to_wchars.append(WCHAR(characters.get(shiftstate, "\uF000")))  # WCH_NONE
 
             # secondary capslock row (SGCAPS)
             if attributes.capslock_secondary:
                 vk_to_wchars.append(BYTE(vk))
                 vk_to_wchars.append(BYTE(0))
-                for shiftstate in range(len(shift_states)):
-                    character = secondary.get(shift_states[shiftstate], Character("\uF000"))  # WCH_NONE
-                    if character.dead:
-                        character = Character("\uF001")  # WCH_DEAD
-                    vk_to_wchars.append(WCHAR(character.char))
+                for shiftstate in shift_states:
+                    vk_to_wchars.append(WCHAR(secondary.get(shiftstate, "\uF000")))  # WCH_NONE
 
             # dead keys row
             if dead:
                 vk_to_wchars.append(BYTE(0xFF))
                 vk_to_wchars.append(BYTE(0))
-                for shiftstate in range(len(shift_states)):
-                    vk_to_wchars.append(WCHAR(dead.get(shift_states[shiftstate], "\uF000")))
+                for shiftstate in shift_states:
+                    vk_to_wchars.append(WCHAR(dead.get(shiftstate, "\uF000")))
         vk_to_wchars.append(BYTE(0))  # end of table
         vk_to_wchars.append(BYTE(0))
         for shiftstate in range(len(shift_states)):
             vk_to_wchars.append(WCHAR('\0'))
 
-        vk_to_wchar_table = BinaryObject(alignment=8)
-        vk_to_wchar_table.append(LPTR(self.architecture, vk_to_wchars))
-        vk_to_wchar_table.append(BYTE(len(shift_states)))
-        vk_to_wchar_table.append(BYTE(len(shift_states) * 2 + 2))
-        vk_to_wchar_table.append(LPTR(self.architecture, None))  # end of table
-        vk_to_wchar_table.append(BYTE(0))
-        vk_to_wchar_table.append(BYTE(0))
-        vk_to_wchar_table.append_padding(self.architecture.long_pointer)
-        self.kbd_vk_to_wchar_table = vk_to_wchar_table
-
         dead_key = BinaryObject(alignment=4)
         for accent, key in self.layout.deadkeys.items():
             for character, composed in key.charmap.items():
@@ -332,11 +480,35 @@ class WinDll:
         dead_key.append(DWORD(0))  # end of table
         dead_key.append(WORD(0))  # WCHAR
         dead_key.append(USHORT(0))
-        self.kbd_dead_key = dead_key
 
-        key_names_dead = BinaryObject(alignment=8)
-        for accent, key in self.layout.deadkeys.items():
-            key_names_dead.append(LPTR(self.architecture, WSTR(accent + key.name)))
+        key_names_dead = [accent + key.name for accent, key in self.layout.deadkeys.items()]
+        return (bytes(vk_to_bits.data), bytes(modifiers.data), bytes(vk_to_wchars.data), len(shift_states),
+                bytes(dead_key.data), key_names_dead)
+
+    def compile_kbd_charmap(self):
+        vk_to_bits, modifiers_data, vk_to_wchars, shift_states, dead_key, dead_names = \
+            self._shared(self._charmap_tables, self.layout.keymap, self.layout.charmap, self.layout.deadkeys)
+
+        modifiers = BinaryObject(alignment=8, name="MODIFIERS")
+        modifiers.append(LPTR(self.architecture, BinaryObject(vk_to_bits, alignment=4, name="VK_TO_BIT")))
+        modifiers.append(modifiers_data)
+        self.kbd_modifiers = modifiers
+
+        vk_to_wchar_table = BinaryObject(alignment=8, name="VK_TO_WCHAR_TABLE")
+        vk_to_wchar_table.append(LPTR(self.architecture, BinaryObject(vk_to_wchars, alignment=2, name="VK_TO_WCHARS")))
+        vk_to_wchar_table.append(BYTE(shift_states))
+        vk_to_wchar_table.append(BYTE(shift_states * 2 + 2))
+        vk_to_wchar_table.append(LPTR(self.architecture, None))  # end of table
+        vk_to_wchar_table.append(BYTE(0))
+        vk_to_wchar_table.append(BYTE(0))
+        vk_to_wchar_table.append_padding(self.architecture.long_pointer)
+        self.kbd_vk_to_wchar_table = vk_to_wchar_table
+
+        self.kbd_dead_key = BinaryObject(dead_key, alignment=4, name="DEADKEY")
+
+        key_names_dead = BinaryObject(alignment=8, name="KEY_NAMES_DEAD")
+        for name in dead_names:
+            key_names_dead.append(LPTR(self.architecture, WSTR(name)))
         key_names_dead.append(LPTR(self.architecture, None))  # end of table
         self.kbd_key_names_dead = key_names_dead
 
@@ -385,7 +557,7 @@ class WinDll:
                 characters = {}
                 for col in range(vk_to_wchar_cols):
                     shiftstate = shift_state_map[col]
-                    character = Character(WCHAR.read(vk_to_wchar))
+                    character = intern(Character(WCHAR.read(vk_to_wchar)))
                     if character.char == "\uF000":  # Null
                         pass
                     elif character.char == "\uF001":  # Dead
@@ -402,8 +574,8 @@ class WinDll:
                     vk_to_wchar.read_or_warn(BYTE(vk))
                     vk_to_wchar.read_or_warn(BYTE(0x00))
                     for col in range(vk_to_wchar_cols):
-                        shiftstate = dataclasses.replace(shift_state_map[col], capslock=True)
-                        character = Character(WCHAR.read(vk_to_wchar))
+                        shiftstate = intern(dataclasses.replace(shift_state_map[col], capslock=True))
+                        character = intern(Character(WCHAR.read(vk_to_wchar)))
                         if character.char == "\uF000":  # Null
                             pass
                         elif character.char == "\uF001":  # Dead
@@ -420,8 +592,9 @@ class WinDll:
                         if not dead.get(col, False):
                             vk_to_wchar.read_or_warn(WCHAR("\uF000"))
                         else:
-                            shiftstate = dataclasses.replace(shift_state_map[col], capslock=attributes.capslock_secondary)
-                            character = Character(WCHAR.read(vk_to_wchar), True)
+                            shiftstate = intern(dataclasses.replace(shift_state_map[col],
+                                                                            capslock=attributes.capslock_secondary))
+                            character = intern(Character(WCHAR.read(vk_to_wchar), True))
                             if character.char in "\uF000\uF001\uF002":
                                 warn("dead key maps to invalid character")
                             else:
@@ -433,7 +606,8 @@ class WinDll:
                 self.layout.charmap[vk] = characters
                 attributes_update[vk] = attributes
         self.layout.keymap = {
-            scancode: dataclasses.replace(keycode, attributes=attributes_update.get(keycode.win_vk, KeyAttributes()))
+            scancode: dataclasses.replace(keycode,
+                                          attributes=attributes_update.get(keycode.win_vk, KeyAttributes.from_bits(0)))
             for scancode, keycode in self.layout.keymap.items()
         }
 
@@ -458,7 +632,7 @@ class WinDll:
                 composed_attr = USHORT.read(dead_key)
                 if composed_attr > 1:
                     warn("unknown dead key attributes: 0x%x" % composed_attr)
-                composed = Character(composed_char, composed_attr == 1)
+                composed = intern(Character(composed_char, composed_attr == 1))
                 if accent not in self.layout.deadkeys:
                     self.layout.deadkeys[accent] = DeadKey(dead_key_names.get(accent, accent), {})
                 if character in self.layout.deadkeys[accent].charmap:
@@ -485,7 +659,7 @@ class WinDll:
     #                            for keycode, character in self.layout.charmap.items()}
 
     def compile_tables(self):
-        kbdtables = BinaryObject(alignment=self.architecture.long_pointer)
+        kbdtables = BinaryObject(alignment=self.architecture.long_pointer, name="KBDTABLES")
         kbdtables.append(LPTR(self.architecture, self.kbd_modifiers))
         kbdtables.append(LPTR(self.architecture, self.kbd_vk_to_wchar_table))
         kbdtables.append(LPTR(self.architecture, self.kbd_dead_key))
@@ -548,7 +722,7 @@ class WinDll:
         # TODO fLocaleFlags, pLigature, dwType, dwSubType
 
     def compile_dir_export(self):
-        func = BinaryObject(alignment=16)                           # -- PKBDTABLES KbdLayerDescriptor() --
+        func = BinaryObject(alignment=16, name="KbdLayerDescriptor")  # -- PKBDTABLES KbdLayerDescriptor() --
         if self.architecture.pointer == 8:                          #
             func.append(BYTE(0x48))                                 # (if AMD64) REX ...
         func.append(BYTE(0xB8))                                     # MOV EAX, ...
@@ -570,7 +744,7 @@ class WinDll:
         ordinals = BinaryObject(alignment=4)
         ordinals.append(WORD(0))
 
-        export = BinaryObject(alignment=16)     # -- Export Directory --
+        export = BinaryObject(alignment=16, name="EXPORT")  # -- Export Directory --
         export.append(DWORD(0))                 # Export Flags (reserved)
         export.append(DWORD(self.timestamp))    # Timestamp
         export.append(WORD(0))                  # Major Version (unused)
@@ -635,7 +809,8 @@ class WinDll:
         self.kbdtables = BinaryObject(self._extract_fixed(table_rva, 11 * self.architecture.long_pointer + 16),
                                       alignment=self.architecture.long_pointer)
 
-    def compile_dir_resource(self):
+    def _version_info(self) -> bytes:
+        """Architecture-independent part of compile_dir_resource: VS_VERSIONINFO"""
         def version_word():
             return MAKELONG(self.layout.version[1], self.layout.version[0])
 
@@ -728,8 +903,15 @@ class WinDll:
         info.append(info_string)                    # Children (StringFileInfo{0,1})
         info.append(info_var)                       # Children (VarFileInfo{0,1})
         info.data[0:2] = WORD(len(info.data)).data
+        return bytes(info.data)
 
-        rsrc = BinaryObject(alignment=16)
+    def compile_dir_resource(self):
+        layout = self.layout
+        version_info = self._shared(self._version_info,
+                                    layout.name, layout.author, layout.copyright, layout.version, layout.dll_name)
+        info = BinaryObject(version_info, alignment=16)
+
+        rsrc = BinaryObject(alignment=16, name="RESOURCES")
         rsrc.append(RSRC_TABLES({0x10: {1: {0x409: (info, 0)}}}))
         rsrc.append(info)
 
@@ -803,7 +985,11 @@ class WinDll:
             warn(e)
 
     def link(self):
-        base = self.align_section
+        # relocations merged into the resource section are only aligned as required by their contents
+        align_reloc = 4 if self.merge_sections else self.align_file
+
+        base = self._header_length()
+        base += (-base) % self.align_section
         self.sec_data = link([self.dir_export], base=base)
         self.sec_data.alignment = self.align_file
 
@@ -813,12 +999,34 @@ class WinDll:
         self.sec_rsrc.alignment = self.align_file
 
         base += len(self.sec_rsrc.data)
-        base += (-base) % self.align_section
+        base += (-base) % (align_reloc if self.merge_sections else self.align_section)
         self.sec_reloc = link([], base=base)
-        self.sec_reloc.alignment = self.align_file
+        self.sec_reloc.alignment = align_reloc
+
+    def _sections(self):
+        """Section table entries: name, first and last linked section, characteristics"""
+        if self.merge_sections:
+            return (
+                (b".data\0\0\0", self.sec_data, self.sec_data, 0x60000040),     # char: init data, read, execute
+                (b".rsrc\0\0\0", self.sec_rsrc, self.sec_reloc, 0x42000040),    # char: init data, read, discard
+            )
+        return (
+            (b".data\0\0\0", self.sec_data, self.sec_data, 0x60000040),     # char: init data, read, execute
+            (b".rsrc\0\0\0", self.sec_rsrc, self.sec_rsrc, 0x42000040),     # char: init data, read, discard
+            (b".reloc\0\0", self.sec_reloc, self.sec_reloc, 0x42000040),     # char: init data, read, discard
+        )
+
+    def _header_length(self) -> int:
+        """Length of headers produced by compile_header, excluding padding"""
+        # the length only depends on the number of sections, not on their placement or size
+        unlinked = BinaryObject()
+        unlinked.placement = (None, 0)
+        return len(self._compile_headers([
+            (name, unlinked, unlinked, characteristics) for name, first, last, characteristics in self._sections()
+        ]).data)
 
     def compile_dir_reloc(self):
-        reloc = BinaryObject(alignment=4)
+        reloc = BinaryObject(alignment=4, name="RELOCS")
 
         blocks = defaultdict(set)
         for offset, symbol in self.sec_data.symbols.items():
@@ -840,29 +1048,36 @@ class WinDll:
         self.dir_reloc = reloc
 
         # section is already linked, insert data directly
+        self.sec_reloc.append_padding(reloc.alignment)
+        self.dir_reloc.placement = (self.sec_reloc, len(self.sec_reloc.data))
         self.sec_reloc.data.extend(reloc.data)
-        self.dir_reloc.placement = (self.sec_reloc, 0)
+        self.sec_reloc.linked.append(self.dir_reloc)
 
     def compile_header(self):
-        def len_file(section: BinaryObject):
-            length = len(section.data)
+        header = self._compile_headers(self._sections())
+        header.append_padding(self.align_file)
+        self.sec_HEADER = header
+
+    def _compile_headers(self, sections) -> BinaryObject:
+        """Headers with the section table entries sections, see _sections(), excluding padding"""
+        def len_virtual(first: BinaryObject, last: BinaryObject):
+            return last.placement[1] + len(last.data) - first.placement[1]
+
+        def len_file(first: BinaryObject, last: BinaryObject):
+            length = len_virtual(first, last)
             length += (-length) % self.align_file
             return length
 
-        header = BinaryObject(alignment=self.align_file)
+        header = BinaryObject(alignment=self.align_file, name="HEADERS")
 
         # https://docs.microsoft.com/en-us/windows/win32/debug/pe-format#section-table-section-headers
         sec = BinaryObject(alignment=4)             # -- Section Table --
-        for name, section, characteristics in (
-                (b".data\0\0\0", self.sec_data, 0x60000040),  # char: init data, read, execute
-                (b".rsrc\0\0\0", self.sec_rsrc, 0x42000040),  # char: init data, read, discard
-                (b".reloc\0\0", self.sec_reloc, 0x42000040),  # char: init data, read, discard
-        ):
-            sec.append(name)                        # Name
-            sec.append(DWORD(len(section.data)))    # VirtualSize
-            sec.append(RVA(section)())              # VirtualAddress
-            sec.append(DWORD(len_file(section)))    # SizeOfRawData
-            sec.append(RVA(section))                # PointerToRawData
+        for name, first, last, characteristics in sections:
+            sec.append(name)                                # Name
+            sec.append(DWORD(len_virtual(first, last)))     # VirtualSize
+            sec.append(RVA(first)())                        # VirtualAddress
+            sec.append(DWORD(len_file(first, last)))        # SizeOfRawData
+            sec.append(RVA(first))                          # PointerToRawData
             sec.append(DWORD(0))                    # PointerToRelocations
             sec.append(DWORD(0))                    # PointerToLinenumbers
             sec.append(WORD(0))                     # NumberOfRelocations
@@ -876,7 +1091,7 @@ class WinDll:
         opt.append(BYTE(_version_num[0]))           # MajorLinkerVersion
         opt.append(BYTE(_version_num[1]))           # MinorLinkerVersion
         opt.append(DWORD(0))                        # SizeOfCode
-        opt_size_data = sum(map(len_file, (self.sec_data, self.sec_rsrc, self.sec_reloc)))
+        opt_size_data = sum(len_file(first, last) for name, first, last, characteristics in sections)
         opt.append(DWORD(opt_size_data))            # SizeOfInitializedData
         opt.append(DWORD(0))                        # SizeOfUninitializedData
         opt.append(DWORD(0))                        # AddressOfEntryPoint
@@ -893,8 +1108,8 @@ class WinDll:
         opt.append(WORD(5))                         # MajorSubsystemVersion  # TODO is XP ok?
         opt.append(WORD(1))                         # MinorSubsystemVersion  # TODO is WinXP SP1 ok?
         opt.append(DWORD(0))                        # Win32VersionValue (reserved)
-        # assuming .reloc section is shorter than section alignment
-        opt_img_size = self.sec_reloc.placement[1] + self.align_section
+        opt_img_size = sections[-1][2].placement[1] + max(len(sections[-1][2].data), 1)
+        opt_img_size += (-opt_img_size) % self.align_section
         opt.append(DWORD(opt_img_size))             # SizeOfImage
         opt.append(SIZEOF(DWORD, header))           # SizeOfHeaders
         opt.append(DWORD(0))                        # CheckSum  # FIXME
@@ -925,7 +1140,7 @@ class WinDll:
         coff = BinaryObject(alignment=4)            # -- COFF header --
         coff_machine = 0x14C if self.architecture.pointer == 4 else 0x8664
         coff.append(WORD(coff_machine))             # Machine
-        coff.append(WORD(3))                        # NumberOfSections
+        coff.append(WORD(len(sections)))            # NumberOfSections
         coff.append(DWORD(self.timestamp))          # TimeDateStamp
         coff.append(DWORD(0))                       # PointerToSymbolTable (deprecated)
         coff.append(DWORD(0))                       # NumberOfSymbol (deprecated)
@@ -937,6 +1152,10 @@ class WinDll:
         pe.append(b"PE\0\0")                # Signature
         pe.extend((coff, opt, sec))
 
+        header.extend([self._compile_mz(pe), self._compile_notice(), pe])
+        return header
+
+    def _compile_mz(self, pe: BinaryObject) -> BinaryObject:
         # https://www.fileformat.info/format/exe/corion-mz.htm
         # https://en.wikibooks.org/wiki/X86_Disassembly/Windows_Executable_Files#MS-DOS_header
         mz = BinaryObject(alignment=16)     # -- MZ header --
@@ -966,14 +1185,12 @@ class WinDll:
         mz.append(WORD(0x4C01, False))      # ... 0x4C01 (exit(1))
         mz.append(b'\xCD\x21')              # INT 0x21
         mz.append(b'This program cannot be run in DOS mode.\n\n\r$')  # message
+        return mz
 
+    def _compile_notice(self) -> BinaryObject:
         notice = BinaryObject(alignment=16)
         notice.append(STR("Generated with PyKbd %s for %s" % (__version__, self.architecture.name)))
-
-        header.extend([mz, notice, pe])
-        header.append_padding(self.align_file)
-
-        self.sec_HEADER = header
+        return notice
 
     def decompile_header(self):
         reader = BinaryObjectReader(self.assembly)
@@ -1052,23 +1269,72 @@ class WinDll:
         else:
             self.dir_resource = BinaryObject(self._extract_fixed(dir_resource_rva, dir_resource_len), alignment=16)
 
-    def assemble(self):
+    def _assembly_objects(self):
         for section in (self.sec_data, self.sec_rsrc, self.sec_reloc):
             section.placement = None
             section.symbols = {}
-        self.assembly = link((
+        return (
             self.sec_HEADER,
             self.sec_data,
             self.sec_rsrc,
             self.sec_reloc,
             BinaryObject(alignment=self.align_file)
-        ))
+        )
+
+    def size_report(self) -> Tuple[int, int]:
+        """
+        Compile the layout with default options and with the options of this object.
+
+        :return: file size with default options, file size with current options
+        """
+        default = WinDll(self.layout, self.architecture)
+        default.timestamp = self.timestamp
+        return len(default.compile()), len(self.compile())
+
+    def assemble(self):
+        self.assembly = link(self._assembly_objects())
+
+    def assemble_to(self, output: BinaryIO) -> int:
+        return link_to(self._assembly_objects(), output)
 
 
 _RSRC_TABLE_ENTRIES = Dict[Union[int, str], Union[Tuple[BinaryObject, int], '_RSRC_TABLE_ENTRIES']]
 _RSRC_TABLE_ENTRY_OFFSETS = Dict[Union[int, str], Union[Tuple[int, int, int], '_RSRC_TABLE_ENTRY_OFFSETS']]
 
 
+def compile_layout(layout: Layout, architecture: Architecture = AMD64, options: Optional[dict] = None) -> bytes:
+    """
+    Compile a layout into a DLL image.
+
+    Unlike WinDll, no compiler state outlives the call; only the layout goes in and bytes come out,
+    which keeps jobs of process pools cheap to send and receive.
+
+    :param options: keyword arguments of WinDll, e.g. {"optimize_size": True}
+    """
+    return WinDll(layout, architecture, **(options or {})).compile()
+
+
+def decompile_bytes(data) -> Layout:
+    """Decompile a DLL image into a layout, see compile_layout()."""
+    windll = WinDll()
+    windll.decompile(data)
+    return windll.layout
+
+
+def compile_all(layout: Layout, architectures: Iterable[Architecture] = (X86, WOW64, AMD64),
+                **options) -> Dict[Architecture, bytes]:
+    """
+    Compile a layout for several architectures.
+
+    Architecture-independent tables are computed once, only tables containing pointers,
+    linking and headers are compiled for each architecture.
+
+    :param options: keyword arguments of WinDll, e.g. optimize_size
+    """
+    shared = {}
+    return {arch: WinDll(layout, arch, shared=shared, **options).compile() for arch in architectures}
+
+
 @dataclass(frozen=True)
 class _RSRC_OFFSET(Symbol):
     target: BinaryObject
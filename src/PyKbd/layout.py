@@ -14,17 +14,53 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from dataclasses import dataclass, field, fields, is_dataclass
+from array import array
+from collections.abc import MutableMapping
+from dataclasses import dataclass, field, fields, is_dataclass, replace
 import json
 from functools import partial
-from typing import Tuple, Dict, Mapping, Collection, List, Optional, Union
+from typing import Tuple, Dict, Iterator, Mapping, Collection, List, Optional, TypeVar, Union
 
-from . import _version
+from . import _version, tracing
+from .persistent import PMap
 
 
 __version__ = _version
 
 
+T = TypeVar("T")
+
+_interned: dict = {}
+
+
+def intern(value: T) -> T:
+    """
+    Return a shared instance equal to value.
+
+    Layouts hold the same few shift states, key attributes and characters many times over,
+    loaders and decompilers intern them so that equal values are stored only once across all layouts.
+    Interned values are never released.
+    """
+    return _interned.setdefault(value, value)
+
+
+def _slots(cls):
+    """Recreate a frozen dataclass with __slots__, like dataclass(slots=True) of Python 3.10"""
+    names = tuple(fld.name for fld in fields(cls))
+    namespace = {key: value for key, value in cls.__dict__.items() if key not in names + ("__dict__", "__weakref__")}
+    namespace["__slots__"] = names
+
+    def __reduce__(self):
+        return _unpickle_interned, (type(self), tuple(getattr(self, name) for name in names))
+
+    namespace["__reduce__"] = __reduce__
+    return type(cls)(cls.__name__, cls.__bases__, namespace)
+
+
+def _unpickle_interned(cls, values):
+    return intern(cls(*values))
+
+
 def _asdict(obj):
     if is_dataclass(obj):
         if hasattr(obj, "to_string"):
@@ -54,7 +90,8 @@ def _fromdict(cls, data):
     if is_dataclass(cls) and isinstance(data, str):
         return cls.from_string(data)
     elif is_dataclass(cls) and isinstance(data, dict):
-        return cls(**{fld.name: _fromdict(fld.type, data.get(fld.name, fld.default)) for fld in fields(cls)})
+        value = cls(**{fld.name: _fromdict(fld.type, data.get(fld.name, fld.default)) for fld in fields(cls)})
+        return intern(value) if cls in _INTERNED else value
     elif issubclass(generic_class, Dict) and isinstance(data, dict):
         kt, vt = cls.__args__
         return dict((_fromdict(kt, k), _fromdict(vt, v)) for k, v in data.items())
@@ -80,18 +117,22 @@ def _flags(bits: Optional[Collection[str]] = None):
         @staticmethod
         def from_string(string):
             if string == 'default':
-                return cls()
+                return intern(cls())
             invert = string.split(',')
-            return cls(**{fld.name: not fld.default for fld in fields(cls) if fld.name in invert})
+            return intern(cls(**{fld.name: not fld.default for fld in fields(cls) if fld.name in invert}))
 
         def to_bits(self):
             invert = [fld.name for fld in fields(self) if getattr(self, fld.name) != fld.default]
             return sum((1 << i) for i, name in enumerate(_bits) if name in invert)
 
+        by_bits = {}
+
         @staticmethod
         def from_bits(value):
-            invert = [fld for i, fld in enumerate(_bits) if (value >> i) & 1]
-            return cls(**{fld.name: not fld.default for fld in fields(cls) if fld.name in invert})
+            if value not in by_bits:
+                invert = [fld for i, fld in enumerate(_bits) if (value >> i) & 1]
+                by_bits[value] = intern(cls(**{fld.name: not fld.default for fld in fields(cls) if fld.name in invert}))
+            return by_bits[value]
 
         cls.to_string = to_string
         cls.from_string = from_string
@@ -134,6 +175,7 @@ class ScanCode:
 
 
 @_flags()
+@_slots
 @dataclass(frozen=True)
 class KeyAttributes:
     capslock: bool = False
@@ -146,7 +188,7 @@ class KeyAttributes:
 class KeyCode:
     win_vk: int
     name: Optional[str] = None
-    attributes: KeyAttributes = KeyAttributes()
+    attributes: KeyAttributes = intern(KeyAttributes())
 
     @staticmethod
     def translate_vk(vk: int):
@@ -186,6 +228,7 @@ class KeyCode:
 
 
 @_flags(['shift', 'control', 'alt', 'kana'])
+@_slots
 @dataclass(frozen=True)
 class ShiftState:
     shift: bool = False
@@ -195,12 +238,181 @@ class ShiftState:
     capslock: bool = False  # only compatible with shift, conflicts with WCH_DEAD
 
 
+@_slots
 @dataclass(frozen=True)
 class Character:
     char: str
     dead: bool = False
 
 
+_INTERNED = (KeyAttributes, ShiftState, Character)
+
+_CAPSLOCK = 0x10
+"""state bit of ShiftState.capslock, which ShiftState.to_bits() leaves out"""
+
+_state_bits_cache: Dict[ShiftState, int] = {}
+
+
+def _state_bits(state: ShiftState) -> int:
+    bits = _state_bits_cache.get(state)
+    if bits is None:
+        bits = _state_bits_cache[state] = state.to_bits() | state.capslock * _CAPSLOCK
+    return bits
+
+
+def _state_from_bits(bits: int) -> ShiftState:
+    state = ShiftState.from_bits(bits & 0xF)
+    return intern(replace(state, capslock=True)) if bits & _CAPSLOCK else state
+
+
+_STATES = tuple(_state_from_bits(bits) for bits in range(32))
+"""ShiftState of each column of DenseCharmap"""
+
+_LONG = 0xFFFF
+"""code of characters that do not fit into a DenseCharmap row"""
+
+_EMPTY_ROW = array("H", [0]) * 32
+
+
+class DenseCharmap(MutableMapping):
+    """
+    Charmap stored as a matrix of code points with one row per virtual key and one column per shift state,
+    and a bitmap of dead characters per row.
+
+    Can be used in place of the Dict[int, Dict[ShiftState, Character]] of Layout.charmap, rows are mutable views.
+    Columns are indexed by ShiftState.to_bits() plus 0x10 for capslock, so rows iterate in that order
+    rather than in insertion order. Use iter_characters() to read a row without creating any objects.
+    Rows of deleted keys are reused, so a row view must not be used after its key is deleted or replaced.
+    Code points outside the Basic Multilingual Plane and strings of several characters,
+    neither of which fit into a keyboard layout DLL, are kept in a separate dict.
+
+    :param charmap: initial contents
+    """
+
+    __slots__ = ("_rows", "_codes", "_dead", "_long", "_free")
+
+    def __init__(self, charmap: Mapping[int, Mapping[ShiftState, Character]] = None):
+        self._rows: Dict[int, int] = {}
+        """virtual key -> row"""
+        self._codes = array("H")
+        """row * 32 + column -> code point + 1, 0 if there is no character"""
+        self._dead = array("I")
+        """row -> bitmap of columns with dead characters"""
+        self._long: Dict[int, str] = {}
+        """row * 32 + column -> characters that do not fit into _codes"""
+        self._free: List[int] = []
+        """cleared rows of deleted keys"""
+        if charmap is not None:
+            self.update(charmap)
+
+    def __getitem__(self, vk: int) -> "_DenseRow":
+        return _DenseRow(self, self._rows[vk])
+
+    def __setitem__(self, vk: int, characters: Mapping[ShiftState, Character]):
+        items = list(characters.items())
+        row = self._rows.get(vk)
+        if row is None and self._free:
+            row = self._rows[vk] = self._free.pop()
+        elif row is None:
+            row = self._rows[vk] = len(self._dead)
+            self._codes.extend(_EMPTY_ROW)
+            self._dead.append(0)
+        else:
+            _DenseRow(self, row).clear()
+        view = _DenseRow(self, row)
+        for state, character in items:
+            view[state] = character
+
+    def __delitem__(self, vk: int):
+        row = self._rows.pop(vk)
+        _DenseRow(self, row).clear()
+        self._free.append(row)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._rows)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, {vk: dict(characters) for vk, characters in self.items()})
+
+
+class _DenseRow(MutableMapping):
+    __slots__ = ("_charmap", "_row")
+
+    def __init__(self, charmap: DenseCharmap, row: int):
+        self._charmap = charmap
+        self._row = row
+
+    def _entries(self) -> Iterator[Tuple[int, str, bool]]:
+        charmap, base = self._charmap, self._row * 32
+        dead = charmap._dead[self._row]
+        for column, code in enumerate(charmap._codes[base:base + 32]):
+            if code:
+                yield column, charmap._long[base + column] if code == _LONG else chr(code - 1), bool(dead >> column & 1)
+
+    def __getitem__(self, state: ShiftState) -> Character:
+        column = _state_bits(state)
+        code = self._charmap._codes[self._row * 32 + column]
+        if not code:
+            raise KeyError(state)
+        char = self._charmap._long[self._row * 32 + column] if code == _LONG else chr(code - 1)
+        return intern(Character(char, bool(self._charmap._dead[self._row] >> column & 1)))
+
+    def __setitem__(self, state: ShiftState, character: Character):
+        column = _state_bits(state)
+        index = self._row * 32 + column
+        self._charmap._long.pop(index, None)
+        if len(character.char) == 1 and ord(character.char) + 1 < _LONG:
+            self._charmap._codes[index] = ord(character.char) + 1
+        else:
+            self._charmap._codes[index] = _LONG
+            self._charmap._long[index] = character.char
+        if character.dead:
+            self._charmap._dead[self._row] |= 1 << column
+        else:
+            self._charmap._dead[self._row] &= ~(1 << column)
+
+    def __delitem__(self, state: ShiftState):
+        column = _state_bits(state)
+        index = self._row * 32 + column
+        if not self._charmap._codes[index]:
+            raise KeyError(state)
+        self._charmap._codes[index] = 0
+        self._charmap._long.pop(index, None)
+        self._charmap._dead[self._row] &= ~(1 << column)
+
+    def clear(self):
+        base = self._row * 32
+        self._charmap._codes[base:base + 32] = _EMPTY_ROW
+        for column in range(32):
+            self._charmap._long.pop(base + column, None)
+        self._charmap._dead[self._row] = 0
+
+    def __iter__(self) -> Iterator[ShiftState]:
+        return (_STATES[column] for column, char, dead in self._entries())
+
+    def __len__(self) -> int:
+        base = self._row * 32
+        return 32 - self._charmap._codes[base:base + 32].count(0)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+def iter_characters(characters: Mapping[ShiftState, Character]) -> Iterator[Tuple[int, str, bool]]:
+    """
+    Iterate over a charmap row as (state bits, characters, dead) tuples,
+    without creating any objects for rows of a DenseCharmap.
+
+    The state bits are ShiftState.to_bits() plus 0x10 for capslock.
+    """
+    if isinstance(characters, _DenseRow):
+        return characters._entries()
+    return ((_state_bits(state), character.char, character.dead) for state, character in characters.items())
+
+
 @dataclass(frozen=True)
 class DeadKey:
     name: str
@@ -217,14 +429,308 @@ class Layout:
 
     # VSC -> virtual key name (+ attrib)
     keymap: Dict[ScanCode, KeyCode] = field(default_factory=dict)
-    # virtual key -> (modifiers -> char (+ attrib))
+    # virtual key -> (modifiers -> char (+ attrib)), or a DenseCharmap
     charmap: Dict[int, Dict[ShiftState, Character]] = field(default_factory=dict)
     # dead char -> (char -> char (+ attrib)) (+ attrib)
     deadkeys: Dict[str, DeadKey] = field(default_factory=dict)
 
+    def to_json(self) -> str:
+        return json.dumps(_asdict(self), sort_keys=True)
+
+    def __reduce__(self):
+        # pickled as flat tuples and arrays instead of one object per key and character
+        return _unpickle_layout, (type(self), _PICKLE_VERSION, self.name, self.author, self.copyright,
+                                  self.version, self.dll_name) + _pack_tables(self)
+
+    @classmethod
+    def from_json(cls, string):
+        with tracing.span("load", format="json", size=len(string)) as span:
+            layout = _fromdict(cls, json.loads(string))
+            span.set(layout=layout.name)
+        return layout
+
+    def diff(self, other: "Layout") -> "LayoutPatch":
+        """Changes that turn this layout into other, found in a single pass over both layouts."""
+        patch = LayoutPatch(keymap=_diff(self.keymap, other.keymap),
+                            charmap=_diff(self.charmap, other.charmap, rows=True),
+                            deadkeys=_diff(self.deadkeys, other.deadkeys))
+        for name in _METADATA:
+            if getattr(self, name) != getattr(other, name):
+                setattr(patch, name, getattr(other, name))
+        return patch
+
+    def apply(self, patch: "LayoutPatch"):
+        """Apply changes from diff() in place, removing entries that do not exist is not an error."""
+        for name in _METADATA:
+            if getattr(patch, name) is not None:
+                setattr(self, name, getattr(patch, name))
+        _apply(self.keymap, patch.keymap)
+        for vk, changes in patch.charmap.items():
+            if changes is None:
+                self.charmap.pop(vk, None)
+            elif vk not in self.charmap:
+                self.charmap[vk] = {state: character for state, character in changes.items() if character is not None}
+            else:
+                _apply(self.charmap[vk], changes)
+        _apply(self.deadkeys, patch.deadkeys)
+
+    def freeze(self) -> "FrozenLayout":
+        return FrozenLayout(self.name, self.author, self.copyright, self.version, self.dll_name,
+                            self.keymap, self.charmap, self.deadkeys)
+
+
+_METADATA = ("name", "author", "copyright", "version", "dll_name")
+
+
+@dataclass(frozen=True)
+class FrozenLayout:
+    """
+    Immutable layout built on persistent maps, see Layout.freeze().
+
+    Edits return a new layout sharing all unchanged keys, rows and dead keys with this one,
+    so that each snapshot costs memory proportional to the change. Metadata is changed with dataclasses.replace().
+    Reads work as on Layout, so frozen layouts can be compiled or drawn directly,
+    though the compiled DLL may differ in table order from that of the equivalent Layout.
+    Tables passed to the constructor are converted to persistent maps.
+    """
+    name: str = ""
+    author: str = ""
+    copyright: str = ""
+    version: Tuple[int, int] = (0, 0)
+    dll_name: str = ""
+
+    keymap: Mapping[ScanCode, KeyCode] = field(default_factory=PMap)
+    charmap: Mapping[int, Mapping[ShiftState, Character]] = field(default_factory=PMap)
+    deadkeys: Mapping[str, DeadKey] = field(default_factory=PMap)
+
+    def __post_init__(self):
+        if not isinstance(self.keymap, PMap):
+            object.__setattr__(self, "keymap", PMap(self.keymap))
+        if not isinstance(self.charmap, PMap):
+            object.__setattr__(self, "charmap", PMap((vk, PMap(characters)) for vk, characters in self.charmap.items()))
+        if not isinstance(self.deadkeys, PMap):
+            object.__setattr__(self, "deadkeys", PMap((accent, _freeze_deadkey(key))
+                                                      for accent, key in self.deadkeys.items()))
+
+    def to_json(self) -> str:
+        return json.dumps(_asdict(self), sort_keys=True)
+
+    @classmethod
+    def from_json(cls, string) -> "FrozenLayout":
+        return Layout.from_json(string).freeze()
+
+    __reduce__ = Layout.__reduce__
+
+    def thaw(self) -> Layout:
+        """Mutable copy of this layout."""
+        return Layout(self.name, self.author, self.copyright, self.version, self.dll_name, dict(self.keymap),
+                      {vk: dict(characters) for vk, characters in self.charmap.items()},
+                      {accent: DeadKey(key.name, dict(key.charmap)) for accent, key in self.deadkeys.items()})
+
+    def _evolve(self, **changes) -> "FrozenLayout":
+        # like dataclasses.replace(), but without converting the tables again
+        new = object.__new__(type(self))
+        new.__dict__.update(self.__dict__, **changes)
+        return new
+
+    def set_key(self, scancode: ScanCode, keycode: KeyCode) -> "FrozenLayout":
+        return self._evolve(keymap=self.keymap.set(scancode, keycode))
+
+    def remove_key(self, scancode: ScanCode) -> "FrozenLayout":
+        return self._evolve(keymap=self.keymap.delete(scancode))
+
+    def set_character(self, vk: int, state: ShiftState, character: Character) -> "FrozenLayout":
+        return self._evolve(charmap=self.charmap.set(vk, self.charmap.get(vk, PMap()).set(state, character)))
+
+    def remove_character(self, vk: int, state: ShiftState) -> "FrozenLayout":
+        return self._evolve(charmap=self.charmap.set(vk, self.charmap[vk].delete(state)))
+
+    def set_characters(self, vk: int, characters: Mapping[ShiftState, Character]) -> "FrozenLayout":
+        """Replace the whole row of vk."""
+        return self._evolve(charmap=self.charmap.set(vk, PMap(characters)))
+
+    def remove_characters(self, vk: int) -> "FrozenLayout":
+        return self._evolve(charmap=self.charmap.delete(vk))
+
+    def set_deadkey(self, accent: str, deadkey: DeadKey) -> "FrozenLayout":
+        return self._evolve(deadkeys=self.deadkeys.set(accent, _freeze_deadkey(deadkey)))
+
+    def remove_deadkey(self, accent: str) -> "FrozenLayout":
+        return self._evolve(deadkeys=self.deadkeys.delete(accent))
+
+    diff = Layout.diff
+
+    def apply(self, patch: "LayoutPatch") -> "FrozenLayout":
+        """Like Layout.apply(), but return a new layout."""
+        metadata = {name: getattr(patch, name) for name in _METADATA if getattr(patch, name) is not None}
+        charmap = self.charmap
+        for vk, changes in patch.charmap.items():
+            if changes is None:
+                charmap = charmap.discard(vk)
+                continue
+            row = charmap.get(vk, PMap())
+            for state, character in changes.items():
+                row = row.discard(state) if character is None else row.set(state, character)
+            charmap = charmap.set(vk, row)
+        return self._evolve(keymap=_apply_frozen(self.keymap, patch.keymap), charmap=charmap,
+                       deadkeys=_apply_frozen(self.deadkeys, {accent: key and _freeze_deadkey(key)
+                                                               for accent, key in patch.deadkeys.items()}),
+                       **metadata)
+
+
+def _freeze_deadkey(key: DeadKey) -> DeadKey:
+    return key if isinstance(key.charmap, PMap) else DeadKey(key.name, PMap(key.charmap))
+
+
+def _apply_frozen(target: PMap, changes: Mapping) -> PMap:
+    for key, value in changes.items():
+        target = target.discard(key) if value is None else target.set(key, value)
+    return target
+
+
+@dataclass
+class LayoutPatch:
+    """
+    Changes between two layouts, see Layout.diff() and Layout.apply().
+
+    Metadata fields are None if unchanged. Removed keys, characters and dead keys map to None,
+    changed charmap rows only contain the changed shift states, dead keys are replaced whole.
+    """
+    name: Optional[str] = None
+    author: Optional[str] = None
+    copyright: Optional[str] = None
+    version: Optional[Tuple[int, int]] = None
+    dll_name: Optional[str] = None
+
+    keymap: Dict[ScanCode, Optional[KeyCode]] = field(default_factory=dict)
+    charmap: Dict[int, Optional[Dict[ShiftState, Optional[Character]]]] = field(default_factory=dict)
+    deadkeys: Dict[str, Optional[DeadKey]] = field(default_factory=dict)
+
+    def __bool__(self):
+        return any(getattr(self, name) is not None for name in _METADATA) or \
+            bool(self.keymap or self.charmap or self.deadkeys)
+
     def to_json(self) -> str:
         return json.dumps(_asdict(self), sort_keys=True)
 
     @classmethod
     def from_json(cls, string):
         return _fromdict(cls, json.loads(string))
+
+
+def _diff(old: Mapping, new: Mapping, rows: bool = False) -> dict:
+    """Entries of new that differ from old, entries missing from new map to None"""
+    changes = {key: None for key in old if key not in new}
+    for key, value in new.items():
+        if key not in old:
+            changes[key] = dict(value) if rows else value
+            continue
+        previous = old[key]
+        if previous is value:
+            # shared, e.g. by versions of a FrozenLayout
+            continue
+        if rows:
+            row = _diff(previous, value)
+            if row:
+                changes[key] = row
+        elif value != previous:
+            changes[key] = value
+    return changes
+
+
+def _apply(target: MutableMapping, changes: Mapping):
+    for key, value in changes.items():
+        if value is None:
+            target.pop(key, None)
+        else:
+            target[key] = value
+
+
+_PICKLE_VERSION = 1
+
+
+def _pack_chars(chars: List[str]):
+    """One string if all characters are single code points, else a tuple; both iterate over the characters"""
+    return "".join(chars) if all(len(char) == 1 for char in chars) else tuple(chars)
+
+
+def _pack_tables(layout: Layout) -> tuple:
+    # few distinct attributes are shared by all keys, convert each only once
+    bits = {}
+
+    def to_bits(value, convert) -> int:
+        if value not in bits:
+            bits[value] = convert(value)
+        return bits[value]
+
+    keycodes = list(layout.keymap.values())
+    keymap = (
+        array("H", [scancode.prefix << 8 | scancode.code for scancode in layout.keymap]),
+        array("H", [keycode.win_vk for keycode in keycodes]),
+        tuple(keycode.name for keycode in keycodes),
+        bytes(to_bits(keycode.attributes, KeyAttributes.to_bits) for keycode in keycodes),
+    )
+
+    states, chars = bytearray(), []
+    for characters in layout.charmap.values():
+        for state, char, dead in iter_characters(characters):
+            states.append(state | dead << 7)
+            chars.append(char)
+    charmap = (
+        array("I", layout.charmap),
+        array("I", [len(characters) for characters in layout.charmap.values()]),
+        bytes(states),
+        _pack_chars(chars),
+        isinstance(layout.charmap, DenseCharmap),
+    )
+
+    keys, composed, dead = [], [], bytearray()
+    for key in layout.deadkeys.values():
+        for char, character in key.charmap.items():
+            keys.append(char)
+            composed.append(character.char)
+            dead.append(character.dead)
+    deadkeys = (
+        _pack_chars(list(layout.deadkeys)),
+        tuple(key.name for key in layout.deadkeys.values()),
+        array("I", [len(key.charmap) for key in layout.deadkeys.values()]),
+        _pack_chars(keys),
+        _pack_chars(composed),
+        bytes(dead),
+    )
+    return keymap, charmap, deadkeys
+
+
+def _unpickle_layout(cls, version, name, author, copyright, layout_version, dll_name, keymap, charmap, deadkeys):
+    if version != _PICKLE_VERSION:
+        raise ValueError("unsupported pickled layout version: %r" % version)
+    attributes = {}
+    characters = {}
+
+    def character(char: str, dead: bool) -> Character:
+        key = char, dead
+        if key not in characters:
+            characters[key] = intern(Character(char, dead))
+        return characters[key]
+
+    scancodes, vks, names, attribute_bits = keymap
+    for bits in set(attribute_bits):
+        attributes[bits] = KeyAttributes.from_bits(bits)
+    keymap = {ScanCode(scancode & 0xFF, scancode >> 8): KeyCode(vk, key_name, attributes[bits])
+              for scancode, vk, key_name, bits in zip(scancodes, vks, names, attribute_bits)}
+
+    charmap_vks, counts, state_bits, chars, dense = charmap
+    entries = iter(zip(state_bits, chars))
+    charmap = DenseCharmap() if dense else {}
+    for vk, count in zip(charmap_vks, counts):
+        charmap[vk] = {_STATES[bits & 0x7F]: character(char, bool(bits & 0x80))
+                       for bits, char in (next(entries) for _ in range(count))}
+
+    accents, dead_names, counts, keys, composed, dead = deadkeys
+    entries = iter(zip(keys, composed, dead))
+    deadkeys = {}
+    for accent, dead_name, count in zip(accents, dead_names, counts):
+        deadkeys[accent] = DeadKey(dead_name, {key: character(char, bool(flag))
+                                               for key, char, flag in (next(entries) for _ in range(count))})
+
+    return cls(name, author, copyright, layout_version, dll_name, keymap, charmap, deadkeys)
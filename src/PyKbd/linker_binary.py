@@ -17,13 +17,14 @@
 
 from __future__ import annotations
 
+import json
 from math import gcd
 from collections import deque
-from dataclasses import dataclass
-from typing import Optional, Union, Tuple, Iterable, Dict
-from warnings import warn
+from dataclasses import dataclass, field, asdict
+from typing import Optional, Union, Tuple, Iterable, Iterator, Dict, List, BinaryIO
 
 from . import _version
+from .tracing import warn
 
 
 __version__ = _version
@@ -42,8 +43,14 @@ class BinaryObject:
     alignment: int
     symbols: Dict[int, Symbol]
     placement: Optional[Tuple[Optional[BinaryObject], int]]
-
-    def __init__(self, data: bytes = (), alignment: Optional[int] = None):
+    name: Optional[str]
+    linked: Optional[List[BinaryObject]]
+
+    def __init__(self, data: bytes = (), alignment: Optional[int] = None, name: Optional[str] = None):
+        """
+        :param name: role of the object, used in linker maps;
+                     unnamed objects are listed after the first object referencing them, see LinkerMap.add()
+        """
         if alignment is None:
             alignment = 1
         if alignment < 1:
@@ -53,6 +60,20 @@ class BinaryObject:
         self.alignment = alignment
         self.symbols = {}
         self.placement = None
+        self.name = name
+        # objects placed by link(), if this object was created by link()
+        self.linked = None
+
+    @classmethod
+    def wrap(cls, data, alignment: Optional[int] = None) -> BinaryObject:
+        """
+        Create an object backed directly by data (e.g. bytes, memoryview or mmap) without copying it.
+
+        The object is intended for reading only, it must not be appended to.
+        """
+        obj = cls(alignment=alignment)
+        obj.data = data
+        return obj
 
     def append_padding(self, alignment):
         if self.alignment % alignment != 0:
@@ -164,10 +185,12 @@ def link(objects: Iterable[BinaryObject], base: int = 0) -> BinaryObject:
     seen = {out}
     queue = deque([x for x in objects if x not in seen and (seen.add(x) or True)])
 
+    out.linked = []
     while len(queue) > 0:
         obj = queue.popleft()
         out.alignment *= obj.alignment // gcd(out.alignment, obj.alignment)
         out.append(obj)
+        out.linked.append(obj)
         for offset, symbol in obj.symbols.items():
             target = symbol.target
             if target is not None and target.placement is not None:
@@ -185,3 +208,197 @@ def link(objects: Iterable[BinaryObject], base: int = 0) -> BinaryObject:
         out.data[offset: offset + len(value)] = value
 
     return out
+
+
+def _place(objects: Iterable[BinaryObject], base: int = 0) -> Tuple[BinaryObject, List[BinaryObject], int]:
+    """
+    Place objects like link() would, without copying their data.
+
+    Returns the (empty) container, the placed objects in order and the total length.
+    """
+    out = BinaryObject()
+    out.placement = (None, base)
+
+    seen = {out}
+    queue = deque([x for x in objects if x not in seen and (seen.add(x) or True)])
+
+    placed = out.linked = []
+    length = 0
+    while len(queue) > 0:
+        obj = queue.popleft()
+        if obj.placement is not None:
+            raise ValueError('value has been placed in another object')
+        out.alignment *= obj.alignment // gcd(out.alignment, obj.alignment)
+        length += (obj.alignment - length) % obj.alignment
+        obj.placement = (out, length)
+        length += len(obj.data)
+        placed.append(obj)
+        for offset, symbol in obj.symbols.items():
+            target = symbol.target
+            if target is not None and target.placement is not None:
+                target = target.find_placement()[0]
+            if target is not None and target not in seen:
+                seen.add(target)
+                queue.append(target)
+
+    return out, placed, length
+
+
+def _chunks(placed: List[BinaryObject]) -> Iterator[memoryview]:
+    """Yield the linked image of placed objects piece by piece, resolving symbols on the fly."""
+    position = 0
+    for obj in placed:
+        offset = obj.placement[1]
+        if offset > position:
+            yield memoryview(bytes(offset - position))
+        data = memoryview(obj.data)
+        start = 0
+        for symbol_offset, symbol in sorted(obj.symbols.items()):
+            value = symbol()
+            if isinstance(value, BinaryObject):
+                value = value.data
+            if symbol_offset > start:
+                yield data[start:symbol_offset]
+            yield memoryview(value)
+            start = symbol_offset + len(value)
+        if start < len(data):
+            yield data[start:]
+        position = offset + len(data)
+
+
+def link_to(objects: Iterable[BinaryObject], output: BinaryIO, base: int = 0) -> int:
+    """
+    Link objects and write the result directly to a binary stream.
+
+    Produces the same bytes as link(), but the linked image is never built in memory.
+    Objects are placed into an empty container, as if by link().
+
+    :return: number of bytes written
+    """
+    out, placed, length = _place(objects, base)
+    for chunk in _chunks(placed):
+        output.write(chunk)
+    return length
+
+
+def link_into(objects: Iterable[BinaryObject], buffer, base: int = 0) -> int:
+    """
+    Link objects and write the result directly to the start of a writable buffer.
+
+    :raises ValueError: if the buffer is too small for the linked image
+    :return: number of bytes written
+    """
+    out, placed, length = _place(objects, base)
+    view = memoryview(buffer).cast('B')
+    if len(view) < length:
+        raise ValueError('buffer too small: %i < %i' % (len(view), length))
+    position = 0
+    for chunk in _chunks(placed):
+        view[position : position + len(chunk)] = chunk
+        position += len(chunk)
+    return length
+
+
+@dataclass(frozen=True)
+class MapEntry:
+    name: Optional[str]
+    address: int
+    size: int
+    alignment: int
+    padding: int
+    """alignment padding preceding this entry"""
+
+
+@dataclass()
+class MapSection:
+    name: str
+    address: int
+    entries: List[MapEntry] = field(default_factory=list)
+
+    @property
+    def size(self) -> int:
+        """size including alignment padding, excluding any padding after the last entry"""
+        if not self.entries:
+            return 0
+        return self.entries[-1].address + self.entries[-1].size - self.address
+
+    @property
+    def padding(self) -> int:
+        return sum(entry.padding for entry in self.entries)
+
+
+@dataclass()
+class LinkerMap:
+    sections: List[MapSection] = field(default_factory=list)
+
+    def add(self, section: str, obj: BinaryObject):
+        """
+        Add a linked object to a section, listing the objects it was linked from.
+
+        Link outputs placed by link() are expanded recursively, other objects are listed as a whole.
+        Addresses are taken from the current placement of the objects, a section added more than
+        once is extended. Unnamed objects are listed under the name of the first object referencing them
+        followed by "[]", e.g. the strings of a table of string pointers.
+        """
+        def leaves(o: BinaryObject, name: Optional[str]):
+            if o.linked is None:
+                yield o, name
+                return
+            # objects were placed in the order link() found them, so referencing objects come first
+            members = {id(child) for child in o.linked}
+            inherited = {}
+            for child in o.linked:
+                child_name = child.name if child.name is not None else inherited.get(id(child))
+                for symbol in child.symbols.values():
+                    target = symbol.target
+                    while target is not None and id(target) not in members:
+                        target = None if target.placement is None else target.placement[0]
+                    if target is not None:
+                        inherited.setdefault(id(target), None if child_name is None else child_name + "[]")
+                yield from leaves(child, child_name)
+
+        def address(o: BinaryObject):
+            placement = o.find_placement()
+            return 0 if placement is None else placement[1]
+
+        sec = next((sec for sec in self.sections if sec.name == section), None)
+        if sec is None:
+            sec = MapSection(section, address(obj))
+            self.sections.append(sec)
+        end = sec.address + sec.size
+        for leaf, name in sorted(leaves(obj, obj.name), key=lambda item: address(item[0])):
+            start = address(leaf)
+            sec.entries.append(MapEntry(name, start, len(leaf.data), leaf.alignment, start - end))
+            end = start + len(leaf.data)
+
+    def totals(self) -> Dict[Optional[str], int]:
+        """Total size of entries by name, largest first"""
+        totals = {}
+        for section in self.sections:
+            for entry in section.entries:
+                totals[entry.name] = totals.get(entry.name, 0) + entry.size
+        return dict(sorted(totals.items(), key=lambda item: -item[1]))
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "sections": [
+                dict(asdict(section), size=section.size, padding=section.padding)
+                for section in self.sections
+            ],
+            "totals": [{"name": name, "size": size} for name, size in self.totals().items()],
+        })
+
+    def to_text(self) -> str:
+        lines = []
+        for section in self.sections:
+            lines.append("%-8s address 0x%08X  size %6i  padding %4i"
+                         % (section.name, section.address, section.size, section.padding))
+            lines.append("    %-10s %6s %5s %4s  %s" % ("address", "size", "align", "pad", "name"))
+            for entry in section.entries:
+                lines.append("    0x%08X %6i %5i %4i  %s"
+                             % (entry.address, entry.size, entry.alignment, entry.padding, entry.name or "?"))
+            lines.append("")
+        lines.append("totals")
+        for name, size in self.totals().items():
+            lines.append("    %6i  %s" % (size, name or "?"))
+        return "\n".join(lines) + "\n"
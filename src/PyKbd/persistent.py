@@ -0,0 +1,278 @@
+# This file is part of PyKbd
+#
+# Copyright (C) 2019-2020  Nulano
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Persistent (immutable) mapping with structural sharing, used by FrozenLayout.
+
+PMap is a hash array mapped trie: every node has up to 32 entries selected by 5 bits of the key hash.
+Setting or deleting a key copies only the nodes on the path to it, O(log32 n),
+and the new map shares all other nodes with the old one.
+"""
+
+from collections.abc import ItemsView, Mapping
+from typing import Iterable, Iterator, Optional, Tuple, Union
+
+from . import _version
+
+
+__version__ = _version
+
+
+_BITS = 5
+_MASK = (1 << _BITS) - 1
+_HASH_MASK = (1 << 64) - 1
+
+
+def _hash(key) -> int:
+    return hash(key) & _HASH_MASK
+
+
+def _index(bitmap: int, bit: int) -> int:
+    return bin(bitmap & (bit - 1)).count("1")
+
+
+class _Collision:
+    """Keys with the same hash"""
+
+    __slots__ = ("hash", "items")
+
+    def __init__(self, hash: int, items: Tuple[Tuple[object, object], ...]):
+        self.hash = hash
+        self.items = items
+
+
+class _Node:
+    """Entries are (key, value) tuples, _Collision or child _Node, ordered by bit"""
+
+    __slots__ = ("bitmap", "entries")
+
+    def __init__(self, bitmap: int, entries: tuple):
+        self.bitmap = bitmap
+        self.entries = entries
+
+
+_Entry = Union[Tuple[object, object], _Collision, _Node]
+
+_EMPTY = _Node(0, ())
+
+
+def _pair(entry1: _Entry, hash1: int, entry2: _Entry, hash2: int, shift: int) -> _Node:
+    """Node containing two entries with different hashes"""
+    bit1 = 1 << ((hash1 >> shift) & _MASK)
+    bit2 = 1 << ((hash2 >> shift) & _MASK)
+    if bit1 == bit2:
+        return _Node(bit1, (_pair(entry1, hash1, entry2, hash2, shift + _BITS),))
+    return _Node(bit1 | bit2, (entry1, entry2) if bit1 < bit2 else (entry2, entry1))
+
+
+def _get(node: _Node, key, hash: int):
+    shift = 0
+    while True:
+        bit = 1 << ((hash >> shift) & _MASK)
+        if not node.bitmap & bit:
+            raise KeyError(key)
+        entry = node.entries[_index(node.bitmap, bit)]
+        if isinstance(entry, tuple):
+            if entry[0] is key or entry[0] == key:
+                return entry[1]
+            raise KeyError(key)
+        if isinstance(entry, _Collision):
+            for item in entry.items:
+                if item[0] == key:
+                    return item[1]
+            raise KeyError(key)
+        node = entry
+        shift += _BITS
+
+
+def _set(node: _Node, key, value, hash: int, shift: int) -> Tuple[_Node, bool]:
+    """:return: new node, or the same node if nothing changed, and whether a key was added"""
+    bit = 1 << ((hash >> shift) & _MASK)
+    index = _index(node.bitmap, bit)
+    if not node.bitmap & bit:
+        return _Node(node.bitmap | bit, node.entries[:index] + ((key, value),) + node.entries[index:]), True
+
+    entry = node.entries[index]
+    added = False
+    if isinstance(entry, tuple):
+        if entry[0] is key or entry[0] == key:
+            if entry[1] is value:
+                return node, False
+            new = (key, value)
+        else:
+            entry_hash = _hash(entry[0])
+            if entry_hash == hash:
+                new = _Collision(hash, (entry, (key, value)))
+            else:
+                new = _pair(entry, entry_hash, (key, value), hash, shift + _BITS)
+            added = True
+    elif isinstance(entry, _Collision):
+        if entry.hash != hash:
+            new = _pair(entry, entry.hash, (key, value), hash, shift + _BITS)
+            added = True
+        else:
+            items = [item for item in entry.items if item[0] != key]
+            added = len(items) == len(entry.items)
+            if any(item[0] == key and item[1] is value for item in entry.items):
+                return node, False
+            new = _Collision(hash, tuple(items) + ((key, value),))
+    else:
+        new, added = _set(entry, key, value, hash, shift + _BITS)
+        if new is entry:
+            return node, False
+    return _Node(node.bitmap, node.entries[:index] + (new,) + node.entries[index + 1:]), added
+
+
+def _delete(node: _Node, key, hash: int, shift: int) -> Optional[_Entry]:
+    """:return: new node or a single entry to replace it with, None if empty, raise KeyError if missing"""
+    bit = 1 << ((hash >> shift) & _MASK)
+    if not node.bitmap & bit:
+        raise KeyError(key)
+    index = _index(node.bitmap, bit)
+    entry = node.entries[index]
+    if isinstance(entry, tuple):
+        if not (entry[0] is key or entry[0] == key):
+            raise KeyError(key)
+        new = None
+    elif isinstance(entry, _Collision):
+        items = tuple(item for item in entry.items if item[0] != key)
+        if len(items) == len(entry.items):
+            raise KeyError(key)
+        new = items[0] if len(items) == 1 else _Collision(hash, items)
+    else:
+        new = _delete(entry, key, hash, shift + _BITS)
+
+    if new is None:
+        entries = node.entries[:index] + node.entries[index + 1:]
+        if not entries:
+            return None
+        if len(entries) == 1 and not isinstance(entries[0], _Node) and shift > 0:
+            # a single key or collision moves up to the parent
+            return entries[0]
+        return _Node(node.bitmap & ~bit, entries)
+    if not isinstance(new, _Node) and len(node.entries) == 1 and shift > 0:
+        return new
+    return _Node(node.bitmap, node.entries[:index] + (new,) + node.entries[index + 1:])
+
+
+def _items(node: _Node) -> Iterator[Tuple[object, object]]:
+    for entry in node.entries:
+        if isinstance(entry, tuple):
+            yield entry
+        elif isinstance(entry, _Collision):
+            yield from entry.items
+        else:
+            yield from _items(entry)
+
+
+class PMap(Mapping):
+    """
+    Immutable mapping, set() and delete() return new maps sharing unchanged structure with this one.
+
+    Iteration order is arbitrary but stable for equal contents built in the same order.
+
+    :param items: initial contents, a mapping or (key, value) pairs
+    """
+
+    __slots__ = ("_root", "_len", "_hash")
+
+    def __init__(self, items: Union[Mapping, Iterable[Tuple[object, object]]] = ()):
+        self._root = _EMPTY
+        self._len = 0
+        self._hash = None
+        if isinstance(items, PMap):
+            self._root, self._len = items._root, items._len
+            return
+        for key, value in (items.items() if isinstance(items, Mapping) else items):
+            self._root, added = _set(self._root, key, value, _hash(key), 0)
+            self._len += added
+
+    @classmethod
+    def _new(cls, root: _Node, length: int) -> "PMap":
+        new = cls.__new__(cls)
+        new._root, new._len, new._hash = root, length, None
+        return new
+
+    def set(self, key, value) -> "PMap":
+        root, added = _set(self._root, key, value, _hash(key), 0)
+        return self if root is self._root else self._new(root, self._len + added)
+
+    def delete(self, key) -> "PMap":
+        """:raise KeyError: if key is missing"""
+        root = _delete(self._root, key, _hash(key), 0)
+        return self._new(_EMPTY if root is None else root, self._len - 1)
+
+    def discard(self, key) -> "PMap":
+        """Like delete(), but return this map if key is missing"""
+        try:
+            return self.delete(key)
+        except KeyError:
+            return self
+
+    def update(self, items: Union[Mapping, Iterable[Tuple[object, object]]]) -> "PMap":
+        root, length = self._root, self._len
+        for key, value in (items.items() if isinstance(items, Mapping) else items):
+            root, added = _set(root, key, value, _hash(key), 0)
+            length += added
+        return self if root is self._root else self._new(root, length)
+
+    def __getitem__(self, key):
+        return _get(self._root, key, _hash(key))
+
+    def __contains__(self, key) -> bool:
+        try:
+            _get(self._root, key, _hash(key))
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return _get(self._root, key, _hash(key))
+        except KeyError:
+            return default
+
+    def __iter__(self) -> Iterator:
+        return (key for key, value in _items(self._root))
+
+    def items(self):
+        return _Items(self)
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __eq__(self, other):
+        if isinstance(other, PMap) and other._root is self._root:
+            return True
+        return super().__eq__(other)
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(frozenset(_items(self._root)))
+        return self._hash
+
+    def __reduce__(self):
+        return PMap, (list(_items(self._root)),)
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, dict(_items(self._root)))
+
+
+class _Items(ItemsView):
+    __slots__ = ()
+
+    def __iter__(self):
+        return _items(self._mapping._root)
@@ -0,0 +1,143 @@
+# This file is part of PyKbd
+#
+# Copyright (C) 2019-2020  Nulano
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import tracemalloc
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import Any, Callable, List, Optional, Tuple
+
+from . import _version, tracing
+
+
+__version__ = _version
+
+
+@dataclass(frozen=True)
+class Stage:
+    name: str
+    run: Callable[[Any], Any]
+    """called with the compiler, e.g. WinDll.compile_tables"""
+    outputs: Tuple[str, ...] = ()
+    """attributes of the compiler set by this stage, their size is reported as the output size"""
+
+
+@dataclass(frozen=True)
+class StageStats:
+    name: str
+    wall_time: float
+    """seconds"""
+    allocated: Optional[int]
+    """net bytes allocated by the stage, i.e. still allocated after it, None if tracemalloc was not tracing"""
+    output_size: int
+
+
+def _size(value) -> int:
+    if value is None:
+        return 0
+    data = getattr(value, "data", value)
+    try:
+        return len(data)
+    except TypeError:
+        return 0
+
+
+@dataclass()
+class Pipeline:
+    """
+    Named compile stages run in order, with hooks called before and after each stage.
+
+    Each run returns the wall time, output size and, if tracemalloc is tracing, allocated bytes of each stage,
+    a pipeline can be shared by compilers running at the same time.
+    """
+    stages: List[Stage] = field(default_factory=list)
+    before: List[Callable[[Stage, Any], None]] = field(default_factory=list)
+    """hooks called with the stage and the compiler before each stage"""
+    after: List[Callable[[Stage, Any, StageStats], None]] = field(default_factory=list)
+    """hooks called with the stage, the compiler and the recorded stats after each stage"""
+    trace_memory: bool = False  # start tracemalloc while running, if not already tracing
+
+    def index(self, name: str) -> int:
+        for i, stage in enumerate(self.stages):
+            if stage.name == name:
+                return i
+        raise KeyError(name)
+
+    def __getitem__(self, name: str) -> Stage:
+        return self.stages[self.index(name)]
+
+    @property
+    def names(self) -> List[str]:
+        return [stage.name for stage in self.stages]
+
+    def insert_before(self, name: str, stage: Stage):
+        self.stages.insert(self.index(name), stage)
+
+    def insert_after(self, name: str, stage: Stage):
+        self.stages.insert(self.index(name) + 1, stage)
+
+    def replace(self, name: str, stage: Stage):
+        self.stages[self.index(name)] = stage
+
+    def remove(self, name: str):
+        del self.stages[self.index(name)]
+
+    def run(self, target, stop: Optional[str] = None) -> List[StageStats]:
+        """
+        Run stages on target.
+
+        :param stop: name of the first stage not to run, e.g. to write the output instead of assembling it
+        :return: stats of the stages run
+        """
+        stages = self.stages if stop is None else self.stages[:self.index(stop)]
+        results = []
+        started = self.trace_memory and not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        try:
+            for stage in stages:
+                for hook in self.before:
+                    hook(stage, target)
+                # the peak of tracemalloc is process-wide, resetting it would disturb other measurements
+                tracing_memory = tracemalloc.is_tracing()
+                if tracing_memory:
+                    current, _ = tracemalloc.get_traced_memory()
+                with tracing.span("stage", stage=stage.name) as span:
+                    start = perf_counter()
+                    stage.run(target)
+                    wall_time = perf_counter() - start
+                    allocated = tracemalloc.get_traced_memory()[0] - current if tracing_memory else None
+                    output_size = sum(_size(getattr(target, name)) for name in stage.outputs)
+                    span.set(size=output_size)
+                stats = StageStats(stage.name, wall_time, allocated, output_size)
+                results.append(stats)
+                for hook in self.after:
+                    hook(stage, target, stats)
+        finally:
+            if started:
+                tracemalloc.stop()
+        return results
+
+    @staticmethod
+    def report(results: List[StageStats]) -> str:
+        """Human-readable table of the stats of a run."""
+        lines = ["%-24s %10s %12s %10s" % ("stage", "time [ms]", "allocated", "size")]
+        for stats in results:
+            allocated = "-" if stats.allocated is None else str(stats.allocated)
+            lines.append("%-24s %10.3f %12s %10i" % (stats.name, stats.wall_time * 1000, allocated, stats.output_size))
+        total = sum(stats.wall_time for stats in results)
+        lines.append("%-24s %10.3f" % ("total", total * 1000))
+        return "\n".join(lines)
@@ -0,0 +1,248 @@
+# This file is part of PyKbd
+#
+# Copyright (C) 2019-2020  Nulano
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Profiling of compile and decompile runs.
+
+Pass a Profiler as ``profile=`` to the compile and decompile entry points, or set the ``PYKBD_PROFILE``
+environment variable to a file name to profile all runs of the process and write the result at exit.
+A file name ending with ``.collapsed`` or ``.folded`` selects the sampling profiler and writes collapsed stacks
+(e.g. for flamegraph.pl), any other file name selects cProfile and writes pstats.
+
+Runs profiled with the same Profiler are aggregated, also across threads.
+Worker processes write their own files, see worker_initializer().
+"""
+
+import atexit
+import cProfile
+import multiprocessing.util
+import os
+import pstats
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass
+from time import perf_counter
+from typing import List, Optional, Union
+
+from . import _version
+
+
+__version__ = _version
+
+
+ENVIRONMENT_VARIABLE = "PYKBD_PROFILE"
+
+
+@dataclass(frozen=True)
+class RunStats:
+    name: str
+    wall_time: float
+    """seconds"""
+    peak_memory: int
+    """peak bytes traced by tracemalloc during the run, and during overlapping runs of other threads"""
+
+
+class _Sampler:
+    """Samples the stack of a thread at a fixed interval."""
+
+    def __init__(self, interval: float, counts: Counter):
+        self.interval = interval
+        self.counts = counts
+        self.thread_id = threading.get_ident()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample, name="PyKbd sampler", daemon=True)
+
+    def _sample(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("%s (%s:%i)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if stack and not self.stopped.is_set():
+                self.counts[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+class Profiler:
+    """
+    Profiles runs with cProfile or a sampling profiler and records the peak memory of each run.
+
+    :param mode: ``"cprofile"`` or ``"sample"``
+    :param interval: seconds between samples of the sampling profiler
+    """
+
+    def __init__(self, mode: str = "cprofile", interval: float = 0.001):
+        if mode not in ("cprofile", "sample"):
+            raise ValueError("unknown profiler mode: %s" % mode)
+        self.mode = mode
+        self.interval = interval
+        self.runs: List[RunStats] = []
+        self.samples = Counter()
+        self._profiles: List[cProfile.Profile] = []
+        """one per thread, cProfile only profiles the thread that enabled it"""
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def run(self, name: str):
+        """Profile the enclosed code as one run. Nested runs of the same thread are part of the enclosing run."""
+        local = self._local
+        if getattr(local, "active", False):
+            yield
+            return
+        local.active = True
+        _start_tracemalloc()
+        profile = sampler = None
+        if self.mode == "cprofile":
+            profile = getattr(local, "profile", None)
+            if profile is None:
+                profile = local.profile = cProfile.Profile()
+                with self._lock:
+                    self._profiles.append(profile)
+            profile.enable()
+        else:
+            sampler = _Sampler(self.interval, self.samples)
+            sampler.start()
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            wall_time = perf_counter() - start
+            if profile is not None:
+                profile.disable()
+            else:
+                sampler.stop()
+            peak = _stop_tracemalloc()
+            with self._lock:
+                self.runs.append(RunStats(name, wall_time, peak))
+            local.active = False
+
+    def stats(self) -> pstats.Stats:
+        """Aggregated cProfile stats of all runs."""
+        if self.mode != "cprofile":
+            raise ValueError("stats are only collected by the cprofile mode")
+        with self._lock:
+            profiles = list(self._profiles)
+        if not profiles:
+            # pstats cannot be created from nothing, use an empty profile
+            profiles.append(cProfile.Profile())
+        return pstats.Stats(*profiles)
+
+    def collapsed(self) -> str:
+        """Aggregated samples of all runs as collapsed stacks, one ``frame;frame;... count`` per line."""
+        if self.mode != "sample":
+            raise ValueError("stacks are only collected by the sample mode")
+        return "".join("%s %i\n" % item for item in sorted(self.samples.items()))
+
+    def dump(self, path: Union[str, os.PathLike]):
+        """Write pstats (cprofile mode) or collapsed stacks (sample mode) to a file."""
+        if self.mode == "cprofile":
+            self.stats().dump_stats(path)
+        else:
+            with open(path, "w") as f:
+                f.write(self.collapsed())
+
+
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_runs = 0
+"""number of running runs, the first one started tracemalloc unless it was tracing already"""
+_tracemalloc_started = False
+
+
+def _start_tracemalloc():
+    global _tracemalloc_runs, _tracemalloc_started
+    with _tracemalloc_lock:
+        if _tracemalloc_runs == 0:
+            _tracemalloc_started = not tracemalloc.is_tracing()
+            if _tracemalloc_started:
+                tracemalloc.start()
+            # the peak is process-wide, it can only be reset while no other run is measuring it
+            tracemalloc.reset_peak()
+        _tracemalloc_runs += 1
+
+
+def _stop_tracemalloc() -> int:
+    """:return: peak traced memory"""
+    global _tracemalloc_runs
+    with _tracemalloc_lock:
+        peak = tracemalloc.get_traced_memory()[1]
+        _tracemalloc_runs -= 1
+        if _tracemalloc_runs == 0 and _tracemalloc_started:
+            tracemalloc.stop()
+        return peak
+
+
+_environment_profiler: Optional[Profiler] = None
+_environment_checked = False
+
+
+def environment_profiler() -> Optional[Profiler]:
+    """Profiler of the process selected by PYKBD_PROFILE, dumped at exit, or None if the variable is not set."""
+    global _environment_profiler, _environment_checked
+    if not _environment_checked:
+        _environment_checked = True
+        path = os.environ.get(ENVIRONMENT_VARIABLE)
+        if path:
+            _environment_profiler = _new_environment_profiler(path)
+            atexit.register(_environment_profiler.dump, os.path.abspath(path))
+    return _environment_profiler
+
+
+def _new_environment_profiler(path: str) -> Profiler:
+    return Profiler("sample" if path.endswith((".collapsed", ".folded")) else "cprofile")
+
+
+def worker_initializer():
+    """
+    Initializer of worker processes, e.g. ``ProcessPoolExecutor(initializer=worker_initializer)``.
+
+    With PYKBD_PROFILE set, each worker writes its runs to a file of its own, named by inserting its process id
+    before the extension, e.g. ``profile.1234.pstats``, instead of all workers writing the same file.
+    """
+    global _environment_profiler, _environment_checked
+    # a forked worker inherits the profiler of its parent
+    _environment_checked = True
+    _environment_profiler = None
+    path = os.environ.get(ENVIRONMENT_VARIABLE)
+    if path:
+        stem, extension = os.path.splitext(os.path.abspath(path))
+        _environment_profiler = _new_environment_profiler(path)
+        # workers exit without running atexit handlers, but run multiprocessing finalizers
+        multiprocessing.util.Finalize(_environment_profiler, _environment_profiler.dump,
+                                      ("%s.%i%s" % (stem, os.getpid(), extension),), exitpriority=0)
+
+
+@contextmanager
+def profiled(profile: Optional[Profiler], name: str):
+    """Profile the enclosed code with profile, or with the PYKBD_PROFILE profiler if profile is None."""
+    if profile is None:
+        profile = environment_profiler()
+    if profile is None:
+        yield
+    else:
+        with profile.run(name):
+            yield
@@ -0,0 +1,388 @@
+# This file is part of PyKbd
+#
+# Copyright (C) 2019-2020  Nulano
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Long-running compile server, run as ``python -m PyKbd serve``.
+
+The server speaks HTTP on a localhost port or a Unix socket and keeps modules and caches loaded between jobs.
+Jobs are run by a fixed number of worker processes, so that compiles run in parallel despite the GIL;
+at most ``workers + backlog`` jobs are admitted at once,
+further requests are answered immediately with ``503 Service Unavailable`` and a ``Retry-After`` header.
+Both this check and the size limit of the body (``413 Payload Too Large``) happen before the body is read.
+
+Endpoints, all answering with JSON::
+
+    POST /compile?arch=x86&arch=amd64   body: layout JSON    -> {"artifacts": {name: base64}, "metrics": {...}}
+    POST /decompile                     body: DLL            -> same, artifact is the layout JSON
+    POST /render?keyboard=iso           body: JSON or DLL    -> same, artifacts are PNG images (requires Pillow)
+    GET /status                                              -> counters of the server
+
+Errors are answered with ``{"error": message}``, with status 400 for invalid input and 500 for other failures.
+Use Client to talk to a server.
+"""
+
+import base64
+import http.client
+import json
+import os
+import socket
+import socketserver
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from time import perf_counter, time
+from typing import Dict, List, Optional, Tuple, Union
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+from . import _version
+from .cli import ARCHITECTURES, KEYBOARDS
+from .compile_windll import compile_all, decompile_bytes
+from .layout import Layout
+from .profiling import worker_initializer
+
+
+__version__ = _version
+
+
+Address = Union[Tuple[str, int], str]
+"""(host, port) or path of a Unix socket"""
+
+
+class ServerError(Exception):
+    """Error answered by the server."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__("%i: %s" % (status, message))
+        self.status = status
+        self.message = message
+
+
+class ServerBusy(ServerError):
+    """The server is at capacity, retry later."""
+
+
+def _stem(dll_name: str) -> str:
+    return os.path.splitext(dll_name)[0]
+
+
+def _load(data: bytes) -> Layout:
+    if data[:2] == b"MZ":
+        return decompile_bytes(data)
+    return Layout.from_json(data.decode("utf-8"))
+
+
+def _compile(data: bytes, params: Dict[str, List[str]]) -> Dict[str, bytes]:
+    layout = Layout.from_json(data.decode("utf-8"))
+    names = params.get("arch", None) or ["x86", "wow64", "amd64"]
+    for name in names:
+        if name not in ARCHITECTURES:
+            raise ValueError("unknown architecture: %s" % name)
+    compiled = compile_all(layout, [ARCHITECTURES[name] for name in names])
+    return {_stem(layout.dll_name) + arch.suffix + ".dll": data for arch, data in compiled.items()}
+
+
+def _decompile(data: bytes, params: Dict[str, List[str]]) -> Dict[str, bytes]:
+    layout = decompile_bytes(data)
+    return {_stem(layout.dll_name) + ".json": layout.to_json().encode("utf-8")}
+
+
+def _render(data: bytes, params: Dict[str, List[str]]) -> Dict[str, bytes]:
+    name = params.get("keyboard", ["iso"])[0]
+    if name not in KEYBOARDS:
+        raise ValueError("unknown keyboard: %s" % name)
+
+    # Pillow is only needed for rendering
+    from . import visualizer
+
+    layout = _load(data)
+    keyboard = getattr(visualizer, name.upper())
+    artifacts = {}
+    for suffix, image in ((".png", visualizer.draw_keyboard(layout, keyboard)),
+                          ("_dead.png", visualizer.draw_dead_keys(layout))):
+        out = BytesIO()
+        image.save(out, "PNG")
+        artifacts[_stem(layout.dll_name) + suffix] = out.getvalue()
+    return artifacts
+
+
+JOBS = {"compile": _compile, "decompile": _decompile, "render": _render}
+"""job name -> function, looked up by name in the worker so that only the job data is sent to it"""
+
+# errors raised for malformed input, the binary reader raises IOError for invalid images
+_INPUT_ERRORS = (ValueError, TypeError, KeyError, IndexError, OSError)
+
+
+def _job(job: str, data: bytes, params: Dict[str, List[str]], submitted: float):
+    # wall clock time, the queue time is measured across processes
+    queue_time = time() - submitted
+    start = perf_counter()
+    artifacts = JOBS[job](data, params)
+    return artifacts, {"queue_time": max(queue_time, 0.0), "run_time": perf_counter() - start}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "_HTTPServer"
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        if self.server.owner.verbose:
+            super().log_message(format, *args)
+
+    def _reply(self, status: int, body: dict, headers: Dict[str, str] = None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if urlsplit(self.path).path != "/status":
+            return self._reply(404, {"error": "not found"})
+        self._reply(200, self.server.owner.status())
+
+    def do_POST(self):
+        owner = self.server.owner
+        url = urlsplit(self.path)
+        job = url.path.strip("/")
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        # the body is not read if the request is rejected, so the connection cannot be reused
+        self.close_connection = True
+        if job not in JOBS:
+            return self._reply(404, {"error": "unknown job: %s" % job})
+        if length < 0:
+            return self._reply(400, {"error": "invalid Content-Length"})
+        if length > owner.max_body:
+            return self._reply(413, {"error": "body larger than %i bytes" % owner.max_body})
+        if not owner._admit():
+            return self._reply(503, {"error": "server busy"}, {"Retry-After": "1"})
+        try:
+            data = self.rfile.read(length)
+            self.close_connection = False
+            status, body = owner._run(job, data, parse_qs(url.query))
+        finally:
+            owner._release()
+        self._reply(status, body)
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    owner: "Server"
+
+
+if hasattr(socket, "AF_UNIX"):
+    class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+        owner: "Server"
+
+
+class Server:
+    """
+    Compile server.
+
+    :param address: (host, port) to listen on, port 0 picks a free port, or path of a Unix socket
+    :param workers: number of worker processes running jobs
+    :param backlog: number of jobs waiting for a worker before requests are rejected
+    :param max_body: maximum size of a request body in bytes
+    :param processes: run jobs in worker processes; threads share the GIL and run compiles one at a time,
+                      but they can run jobs added to JOBS at runtime, which spawned processes do not see
+    """
+
+    def __init__(self, address: Address = ("127.0.0.1", 0), workers: Optional[int] = None, backlog: int = 16,
+                 verbose: bool = False, max_body: int = 16 * 1024 * 1024, processes: bool = True):
+        self.workers = workers or os.cpu_count() or 1
+        self.backlog = backlog
+        self.max_body = max_body
+        self.verbose = verbose
+        self._executor: Executor = (
+            ProcessPoolExecutor(self.workers, initializer=worker_initializer) if processes
+            else ThreadPoolExecutor(self.workers, thread_name_prefix="PyKbd worker")
+        )
+        self._lock = threading.Lock()
+        self._admitted = 0
+        self._counters = {"completed": 0, "failed": 0, "rejected": 0}
+        if isinstance(address, (str, os.PathLike)):
+            self._server = _UnixHTTPServer(os.fspath(address), _Handler)
+        else:
+            self._server = _HTTPServer(tuple(address), _Handler)
+        self._server.owner = self
+        self._thread = None
+
+    @property
+    def address(self) -> Address:
+        """Address the server listens on, with the actual port"""
+        return self._server.server_address
+
+    def status(self) -> dict:
+        with self._lock:
+            return dict(self._counters, workers=self.workers, backlog=self.backlog, admitted=self._admitted)
+
+    def run(self, job: str, data: bytes, params: Dict[str, List[str]]) -> Tuple[int, dict]:
+        """Run a job on a worker, return the HTTP status and body of the answer."""
+        if not self._admit():
+            return 503, {"error": "server busy"}
+        try:
+            return self._run(job, data, params)
+        finally:
+            self._release()
+
+    def _admit(self) -> bool:
+        """Reserve a place for a job, return False if the server is at capacity"""
+        with self._lock:
+            if self._admitted >= self.workers + self.backlog:
+                self._counters["rejected"] += 1
+                return False
+            self._admitted += 1
+            return True
+
+    def _release(self):
+        with self._lock:
+            self._admitted -= 1
+
+    def _run(self, job: str, data: bytes, params: Dict[str, List[str]]) -> Tuple[int, dict]:
+        submitted = time()
+        try:
+            future = self._executor.submit(_job, job, data, params, submitted)
+            artifacts, metrics = future.result()
+        except Exception as e:
+            with self._lock:
+                self._counters["failed"] += 1
+            return 400 if isinstance(e, _INPUT_ERRORS) else 500, {"error": "%s: %s" % (type(e).__name__, e)}
+        with self._lock:
+            self._counters["completed"] += 1
+        metrics.update(job=job, input_size=len(data), output_size=sum(map(len, artifacts.values())))
+        return 200, {
+            "artifacts": {name: base64.b64encode(value).decode("ascii") for name, value in artifacts.items()},
+            "metrics": metrics,
+        }
+
+    def serve_forever(self, poll_interval: float = 0.1):
+        """:param poll_interval: seconds between checks for stop()"""
+        self._server.serve_forever(poll_interval)
+
+    def start(self) -> "Server":
+        """Serve in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever, name="PyKbd server", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving, finish running jobs and close the socket."""
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+        self._executor.shutdown()
+        if isinstance(self.address, str):
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+
+    def __enter__(self) -> "Server":
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: Optional[float] = None):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+@dataclass()
+class Result:
+    artifacts: Dict[str, bytes] = field(default_factory=dict)
+    metrics: dict = field(default_factory=dict)
+    """queue_time and run_time in seconds, job, input_size and output_size in bytes"""
+
+
+class Client:
+    """
+    Client of a Server.
+
+    :param address: address of the server, see Server.address
+    :param timeout: socket timeout in seconds
+    """
+
+    def __init__(self, address: Address, timeout: Optional[float] = None):
+        self.address = address
+        self.timeout = timeout
+
+    def _connection(self) -> http.client.HTTPConnection:
+        if isinstance(self.address, (str, os.PathLike)):
+            return _UnixHTTPConnection(os.fspath(self.address), self.timeout)
+        return http.client.HTTPConnection(*self.address, timeout=self.timeout)
+
+    def _request(self, method: str, path: str, body: Optional[bytes] = None) -> dict:
+        connection = self._connection()
+        try:
+            connection.request(method, path, body)
+            response = connection.getresponse()
+            answer = json.loads(response.read().decode("utf-8"))
+        finally:
+            connection.close()
+        if response.status == 503:
+            raise ServerBusy(response.status, answer.get("error", ""))
+        if response.status != 200:
+            raise ServerError(response.status, answer.get("error", ""))
+        return answer
+
+    def _job(self, job: str, data: bytes, **params) -> Result:
+        query = urlencode(params, doseq=True)
+        answer = self._request("POST", "/" + job + ("?" + query if query else ""), data)
+        return Result({name: base64.b64decode(value) for name, value in answer["artifacts"].items()},
+                      answer["metrics"])
+
+    def compile(self, layout: Union[Layout, str], architectures: Tuple[str, ...] = ("x86", "wow64", "amd64")) -> Result:
+        """:param architectures: names of architectures, see cli.ARCHITECTURES"""
+        source = layout.to_json() if isinstance(layout, Layout) else layout
+        return self._job("compile", source.encode("utf-8"), arch=list(architectures))
+
+    def decompile(self, data: bytes) -> Result:
+        return self._job("decompile", bytes(data))
+
+    def render(self, layout: Union[Layout, str, bytes], keyboard: str = "iso") -> Result:
+        """:param layout: layout, layout JSON or DLL"""
+        if isinstance(layout, Layout):
+            layout = layout.to_json()
+        if isinstance(layout, str):
+            layout = layout.encode("utf-8")
+        return self._job("render", layout, keyboard=keyboard)
+
+    def status(self) -> dict:
+        return self._request("GET", "/status")
@@ -0,0 +1,231 @@
+# This file is part of PyKbd
+#
+# Copyright (C) 2019-2020  Nulano
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Structured trace events of load, compile, decompile, link and write runs.
+
+Tracing is disabled by default. Call ``enable()`` with a file name, a text file or a callback,
+use the ``traced()`` context manager, or set the ``PYKBD_TRACE`` environment variable to a file name.
+Files receive one JSON object per line, callbacks receive the same objects as dicts.
+
+Every event has the fields ``time`` (seconds since the epoch), ``event`` and ``duration`` (seconds),
+the ``layout`` and ``architecture`` of the enclosing run if known, event-specific fields such as ``size``,
+counters such as ``cache_hits``, and ``warnings`` issued during the event.
+Warnings issued with ``tracing.warn()`` are recorded in the spans of the thread issuing them
+and shown as usual, other warnings are not recorded.
+"""
+
+import json
+import os
+import threading
+import warnings
+from time import perf_counter, time
+from typing import Callable, Optional, TextIO, Union
+
+from . import _version
+
+
+__version__ = _version
+
+
+ENVIRONMENT_VARIABLE = "PYKBD_TRACE"
+
+_CONTEXT_FIELDS = ("layout", "architecture")
+
+
+class Tracer:
+    """
+    Writes trace events to a sink.
+
+    :param sink: file name (appended to), text file object, or callable accepting an event dict
+    """
+
+    def __init__(self, sink: Union[str, os.PathLike, TextIO, Callable[[dict], None]]):
+        self._lock = threading.Lock()
+        self._file = None
+        self._callback = None
+        if isinstance(sink, (str, os.PathLike)):
+            self._file = self._owned = open(sink, "a", encoding="utf-8")
+        elif callable(sink):
+            self._callback = sink
+            self._owned = None
+        else:
+            self._file = sink
+            self._owned = None
+
+    def emit(self, record: dict):
+        if self._callback is not None:
+            self._callback(record)
+        else:
+            line = json.dumps(record, default=str) + "\n"
+            with self._lock:
+                self._file.write(line)
+                self._file.flush()
+
+    def close(self):
+        if self._owned is not None:
+            self._owned.close()
+            self._owned = None
+
+
+_tracer: Optional[Tracer] = None
+_environment_checked = False
+_local = threading.local()
+
+
+def warn(message, category=UserWarning, stacklevel: int = 1):
+    """
+    Issue a warning with warnings.warn() and record it in the events of this thread.
+
+    The warning is recorded even if the warnings filter suppresses it, e.g. a repeated warning.
+
+    :param stacklevel: as for warnings.warn(), 1 is the caller of this function
+    """
+    span = getattr(_local, "span", None)
+    while span is not None:
+        span._warnings.append(str(message))
+        span = span.parent
+    warnings.warn(message, category, stacklevel + 1)
+
+
+def enable(sink) -> Tracer:
+    """Send events of all threads to sink, see Tracer."""
+    global _tracer, _environment_checked
+    _environment_checked = True
+    _tracer = sink if isinstance(sink, Tracer) else Tracer(sink)
+    return _tracer
+
+
+def disable():
+    global _tracer, _environment_checked
+    _environment_checked = True
+    if _tracer is not None:
+        _tracer.close()
+    _tracer = None
+
+
+class traced:
+    """Context manager enabling tracing to sink and restoring the previous tracer on exit."""
+
+    def __init__(self, sink):
+        self.sink = sink
+
+    def __enter__(self) -> Tracer:
+        global _tracer
+        self.previous = current()
+        _tracer = self.sink if isinstance(self.sink, Tracer) else Tracer(self.sink)
+        return _tracer
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        global _tracer
+        _tracer.close()
+        _tracer = self.previous
+
+
+def current() -> Optional[Tracer]:
+    """Active tracer, or None if tracing is disabled"""
+    global _environment_checked
+    if not _environment_checked:
+        _environment_checked = True
+        path = os.environ.get(ENVIRONMENT_VARIABLE)
+        if path:
+            enable(path)
+    return _tracer
+
+
+class Span:
+    """A traced event with a duration, emitted when the context manager exits."""
+
+    __slots__ = ("tracer", "event", "fields", "counters", "start", "parent", "_warnings")
+
+    def __init__(self, tracer: Tracer, event: str, fields: dict):
+        self.tracer = tracer
+        self.event = event
+        self.fields = fields
+        self.counters = {}
+        self._warnings = []
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def __enter__(self) -> "Span":
+        self.parent = getattr(_local, "span", None)
+        _local.span = self
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        duration = perf_counter() - self.start
+        _local.span = self.parent
+
+        record = {"time": time(), "event": self.event}
+        span = self.parent
+        while span is not None:
+            for name in _CONTEXT_FIELDS:
+                if name in span.fields and name not in record:
+                    record[name] = span.fields[name]
+            span = span.parent
+        record.update(self.fields)
+        record["duration"] = duration
+        record.update(self.counters)
+        if self.parent is not None:
+            for name, n in self.counters.items():
+                self.parent.count(name, n)
+        if self._warnings:
+            record["warnings"] = self._warnings
+        if exc_val is not None:
+            record["error"] = repr(exc_val)
+        self.tracer.emit(record)
+
+
+class _NullSpan:
+    """Span used when tracing is disabled."""
+
+    __slots__ = ()
+
+    def set(self, **fields):
+        pass
+
+    def count(self, name: str, n: int = 1):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(event: str, **fields):
+    """Context manager tracing the enclosed code as an event, does nothing if tracing is disabled."""
+    tracer = current()
+    if tracer is None:
+        return _NULL_SPAN
+    return Span(tracer, event, fields)
+
+
+def count(name: str, n: int = 1):
+    """Add to a counter of the innermost event of this thread."""
+    if _tracer is not None:
+        span = getattr(_local, "span", None)
+        if span is not None:
+            span.count(name, n)
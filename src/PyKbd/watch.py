@@ -0,0 +1,165 @@
+# This file is part of PyKbd
+#
+# Copyright (C) 2019-2020  Nulano
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Recompile layouts when their JSON files change, run as ``python -m PyKbd watch``.
+
+Files are polled with ``os.stat``, which is cheap for the handful of layouts being edited.
+A change is compiled once the file has not changed for the debounce time,
+so that editors writing a file in several steps trigger a single compile.
+"""
+
+import os
+import threading
+from time import monotonic, perf_counter
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from . import _version
+from .cli import _expand, _output
+from .compile_windll import WinDll
+from .layout import Layout
+from .wintypes import AMD64, WOW64, X86, Architecture
+
+
+__version__ = _version
+
+
+def _stat(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class Watcher:
+    """
+    Watches layout files and compiles those that changed.
+
+    Each file keeps its last source and layout, so that saving an unchanged file,
+    or a file whose layout did not change (e.g. only its formatting), does not compile anything.
+    It also keeps the architecture-independent tables of its last compile,
+    which are reused by the next compile if the parts of the layout they depend on did not change.
+
+    :param patterns: layout files or glob patterns of .json files, matched again on every poll to pick up new files
+    :param output: output directory, next to each layout if None
+    :param debounce: seconds a file must stay unchanged before it is compiled
+    :param interval: seconds between polls of run()
+    """
+
+    def __init__(self, patterns: Iterable[str], architectures: Iterable[Architecture] = (X86, WOW64, AMD64),
+                 output: Optional[str] = None, debounce: float = 0.05, interval: float = 0.1,
+                 optimize_size: bool = False, merge_sections: bool = False):
+        self.patterns = list(patterns)
+        self.architectures = list(architectures)
+        self.output = output
+        self.debounce = debounce
+        self.interval = interval
+        self.optimize_size = optimize_size
+        self.merge_sections = merge_sections
+        self._seen: Dict[str, Tuple[Tuple[int, int], float]] = {}
+        """path -> last stat and when it was first seen"""
+        self._built: Dict[str, Tuple[int, int]] = {}
+        """path -> stat of the last compiled version"""
+        self._sources: Dict[str, Tuple[str, Layout]] = {}
+        """path -> source and layout of the last compiled version"""
+        self._shared: Dict[str, dict] = {}
+        """path -> architecture-independent tables, see WinDll.shared"""
+
+    def changed(self) -> List[str]:
+        """Files that changed since they were last compiled and have settled."""
+        now = monotonic()
+        paths = _expand(self.patterns, ".json")
+        for path in set(self._seen) - set(paths):
+            self.forget(path)
+        changed = []
+        for path in paths:
+            stat = _stat(path)
+            if stat is None:
+                self.forget(path)
+                continue
+            seen = self._seen.get(path)
+            if seen is None or seen[0] != stat:
+                seen = self._seen[path] = stat, now
+            if self._built.get(path) != stat and now - seen[1] >= self.debounce:
+                changed.append(path)
+        return changed
+
+    def forget(self, path: str):
+        self._seen.pop(path, None)
+        self._built.pop(path, None)
+        self._sources.pop(path, None)
+        self._shared.pop(path, None)
+
+    def build(self, path: str) -> List[dict]:
+        """
+        Compile a layout file for all architectures, unless its layout did not change.
+
+        A failed version is not retried until the file changes again, and it is then compiled
+        even if its source or layout equals the failed one.
+
+        :return: one result per compiled architecture, or a single result with an error
+        """
+        self._built[path] = self._seen[path][0] if path in self._seen else _stat(path)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                source = f.read()
+            previous = self._sources.get(path)
+            if previous is not None and previous[0] == source:
+                return []
+            layout = Layout.from_json(source)
+            if previous is not None and previous[1] == layout:
+                self._sources[path] = source, layout
+                return []
+            results = []
+            shared = self._shared.setdefault(path, {})
+            for arch in self.architectures:
+                start = perf_counter()
+                windll = WinDll(layout, arch, optimize_size=self.optimize_size, merge_sections=self.merge_sections,
+                                shared=shared)
+                target = _output(path, self.output, arch.suffix + ".dll")
+                size = windll.compile_to(target)
+                results.append({"input": path, "output": target, "architecture": arch.name,
+                                "size": size, "time": perf_counter() - start})
+            self._sources[path] = source, layout
+            return results
+        except Exception as e:
+            self._sources.pop(path, None)
+            return [{"input": path, "error": "%s: %s" % (type(e).__name__, e)}]
+
+    def step(self) -> List[dict]:
+        """Poll once and compile all changed files."""
+        results = []
+        for path in self.changed():
+            results.extend(self.build(path))
+        return results
+
+    def run(self, callback: Callable[[dict], None], stop: Optional[threading.Event] = None):
+        """
+        Compile changed files until stop is set.
+
+        :param callback: called with each result as soon as it is ready
+        """
+        stop = stop or threading.Event()
+        while True:
+            for path in self.changed():
+                for result in self.build(path):
+                    callback(result)
+            if stop.wait(min(self.interval, self.debounce) if self._pending() else self.interval):
+                break
+
+    def _pending(self) -> bool:
+        return any(self._built.get(path) != seen[0] for path, seen in self._seen.items())
@@ -0,0 +1,177 @@
+# This file is part of PyKbd
+#
+# Copyright (C) 2019-2020  Nulano
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Generate specialized encoders and decoders for fixed-size structs.
+
+The Assembler walks type hints reflectively for every value it compiles.
+For structs made only of integers, fixed-length strings and bytes, tuples of those and pointers,
+the walk always visits the same fields at the same offsets, so it can be replaced by straight-line
+code calling ``struct.pack_into`` and ``struct.unpack_from`` once per struct.
+Pointed-to values are still compiled and decompiled by the Assembler.
+
+Sources are generated on first use for each (struct, pointer size) pair and kept in memory,
+call ``generate()`` to inspect them.
+"""
+
+import struct
+import typing
+from typing import Callable, Dict, Optional, Tuple
+
+from . import _version
+from .structs import FieldLayout, StructLayout
+
+
+__version__ = _version
+
+
+def _leaves(layout: StructLayout) -> Dict[str, Tuple[FieldLayout, ...]]:
+    """Values placed for each field: the field itself, or its elements for tuples"""
+    return {name: fld.elements or (fld,) for name, fld in layout.fields.items()}
+
+
+def _format(layout: StructLayout) -> str:
+    """struct module format of the whole struct, skipping pointers"""
+    fmt = "<"
+    offset = 0
+    for leaves in _leaves(layout).values():
+        for leaf in leaves:
+            if leaf.offset > offset:
+                fmt += "%ix" % (leaf.offset - offset)
+            fmt += "%ix" % leaf.size if leaf.pointer is not None else leaf.format
+            offset = leaf.offset + leaf.size
+    return fmt
+
+
+def generate(tp, ptr_size: int) -> Optional[str]:
+    """
+    Generate the source of ``encode(asm, obj, ctx)`` and ``decode(asm, data, ctx)`` for a struct.
+
+    The source expects the names ``cls``, ``BinaryObject``, ``BinaryObjectReader``, ``Offset``, ``pack_into``,
+    ``unpack_from`` and, for pointer fields, ``hint_<field>`` and ``target_<field>`` (the pointed-to type)
+    to be defined in its globals.
+
+    :return: Python source, or None if the struct is not fixed-size
+    """
+    if not StructLayout.is_fixed(tp, ptr_size):
+        return None
+    layout = StructLayout.of(tp, ptr_size)
+    fields = _leaves(layout)
+    alignment, size, fmt = layout.alignment, layout.size, _format(layout)
+    pointers = {name: leaves[0] for name, leaves in fields.items() if leaves[0].pointer is not None}
+
+    enc = ["def encode(asm, obj, ctx):"]
+    enc.append("    # %s, pointer size %i" % (tp.__name__, ptr_size))
+    if pointers:
+        enc.append("    ctx2 = dict(obj.__dict__)")
+        enc.append("    if \"__length\" in ctx:")
+        enc.append("        ctx2[\"__length\"] = ctx[\"__length\"]")
+    values = []
+    for name, leaves in fields.items():
+        if len(leaves) > 1:
+            enc.append("    assert len(obj.%s) == %i" % (name, len(leaves)))
+        for i, leaf in enumerate(leaves):
+            value = "obj.%s" % name if len(leaves) == 1 else "obj.%s[%i]" % (name, i)
+            var = "%s_%i" % (name, i)
+            if leaf.pointer is not None:
+                continue
+            elif leaf.encoding is not None:
+                enc.append("    assert len(%s) == %i" % (value, leaf.length))
+                enc.append("    %s = %s.encode(%r, errors=\"strict\")" % (var, value, leaf.encoding.encoding))
+                enc.append("    if len(%s) != %i:" % (var, leaf.size))
+                enc.append("        raise UnicodeError(\"unsupported characters in object\")")
+                values.append(var)
+            elif leaf.format.endswith("s"):
+                enc.append("    assert len(%s) == %i" % (value, leaf.length))
+                values.append(value)
+            else:
+                values.append(value)
+    enc.append("    out = BinaryObject(alignment=%i)" % alignment)
+    enc.append("    out.data = bytearray(%i)" % size)
+    enc.append("    pack_into(out.data, 0, %s)" % ", ".join(values) if values else "    pass")
+    for name, leaf in pointers.items():
+        enc.append("    if obj.%s is not None:" % name)
+        enc.append("        target = asm._compile(obj.%s, target_%s, **ctx2)" % (name, name))
+        enc.append("        if target.name is None and target is not obj.%s:" % name)
+        enc.append("            target.name = %r" % ("%s.%s" % (tp.__name__, name)))
+        enc.append("        out.symbols[%i] = Offset(target, %i)" % (leaf.offset, leaf.size))
+        enc.append("    else:")
+        enc.append("        out.symbols[%i] = Offset(None, %i)" % (leaf.offset, leaf.size))
+    enc.append("    return out")
+
+    dec = ["def decode(asm, data, ctx):"]
+    dec.append("    # %s, pointer size %i" % (tp.__name__, ptr_size))
+    dec.append("    data.read_padding(%i)" % alignment)
+    dec.append("    start = data.offset")
+    dec.append("    if start + %i > len(data.target.data):" % size)
+    dec.append("        raise IOError(\"end of stream\")")
+    unpacked = ["%s_%i" % (name, i)
+                for name, leaves in fields.items()
+                for i, leaf in enumerate(leaves)
+                if leaf.pointer is None]
+    if unpacked:
+        dec.append("    %s, = unpack_from(data.target.data, start)" % ", ".join(unpacked))
+    dec.append("    data.offset = start + %i" % size)
+    for name, leaves in fields.items():
+        for i, leaf in enumerate(leaves):
+            var = "%s_%i" % (name, i)
+            if leaf.encoding is not None:
+                dec.append("    s = %s.decode(%r, errors=\"strict\")" % (var, leaf.encoding.encoding))
+                dec.append("    if len(%s) != len(s) * %i:" % (var, leaf.encoding.sizeof))
+                dec.append("        raise UnicodeError(\"read incorrect\")")
+                dec.append("    assert len(s) == %i" % leaf.length)
+                dec.append("    %s = s" % var)
+    args = []
+    for name, leaves in fields.items():
+        if len(leaves) > 1:
+            args.append("(%s)" % "".join("%s_%i, " % (name, i) for i in range(len(leaves))))
+        else:
+            args.append("%s_0" % name)
+    if pointers:
+        dec.append("    ctx2 = {k: v for k, v in ctx.items() if k.startswith(\"__\")}")
+        for name, arg in zip(fields, args):
+            if name not in pointers:
+                dec.append("    ctx2[%r] = %s" % (name, arg))
+        for name, leaf in pointers.items():
+            dec.append("    %s_0 = ctx2[%r] = asm._decompile(BinaryObjectReader(data.target, start + %i), hint_%s, **ctx2)"
+                       % (name, name, leaf.offset, name))
+    dec.append("    return cls(%s)" % ", ".join(args))
+
+    header = "# struct format %r" % fmt
+    return "\n".join([header, ""] + enc + ["", ""] + dec) + "\n"
+
+
+def load(tp, ptr_size: int, **namespace) -> Optional[Tuple[Callable, Callable]]:
+    """
+    Generate and compile the encoder and decoder for a struct.
+
+    :param namespace: ``BinaryObject``, ``BinaryObjectReader`` and ``Offset``
+    :return: encode and decode functions, or None if the struct is not fixed-size
+    """
+    source = generate(tp, ptr_size)
+    if source is None:
+        return None
+    layout = StructLayout.of(tp, ptr_size)
+    packer = struct.Struct(_format(layout))
+    namespace = dict(namespace, cls=tp, pack_into=packer.pack_into, unpack_from=packer.unpack_from)
+    for name, hint in typing.get_type_hints(tp, include_extras=True).items():
+        if layout.fields[name].pointer is not None:
+            namespace["hint_" + name] = hint
+            # pointed-to values are compiled without the pointer annotation
+            namespace["target_" + name] = layout.fields[name].pointer
+    exec(compile(source, "<codegen %s %i>" % (tp.__name__, ptr_size), "exec"), namespace)
+    return namespace["encode"], namespace["decode"]
+
@@ -17,12 +17,13 @@
 
 import dataclasses
 from operator import itemgetter
-from warnings import warn
 
 from .types import *
-from ..layout import Layout, KeyCode, ScanCode, ShiftState, Character, KeyAttributes, DeadKey
+from ..layout import Layout, KeyCode, ScanCode, ShiftState, Character, KeyAttributes, DeadKey, intern, \
+    iter_characters
 
 from . import _version
+from ..tracing import warn
 
 
 __version__ = _version
@@ -78,10 +79,9 @@ def compile_kbd_charmap(kbdtables: KBDTABLES, layout: Layout):
         VK_TO_BIT(0x10, 1), VK_TO_BIT(0x11, 2), VK_TO_BIT(0x12, 4), VK_TO_BIT(0x15, 8)
     ]
 
-    max_mask = 0
-    shift_states = []
-    shift_state_map = {}
+    used_states = set()
     vk_attributes = {}
+    vk_characters = {}
     for scancode, keycode in layout.keymap.items():
         vk = KeyCode.translate_vk(keycode.win_vk)
         if vk in (0, 0xFF) or len(layout.charmap.get(vk, {})) == 0:
@@ -90,12 +90,15 @@ def compile_kbd_charmap(kbdtables: KBDTABLES, layout: Layout):
             warn("unknown special vk, skipping: 0x%X" % vk)
             continue
         vk_attributes[vk] = keycode.attributes
-        for shiftstate, character in layout.charmap[vk].items():
-            shiftstate = dataclasses.replace(shiftstate, capslock=False)
-            if shiftstate not in shift_state_map:
-                shift_state_map[shiftstate] = len(shift_state_map)
-                shift_states.append(shiftstate)
-                max_mask = max(max_mask, shiftstate.to_bits())
+        # shift states as bits, see iter_characters
+        vk_characters[vk] = characters = list(iter_characters(layout.charmap[vk]))
+        used_states.update(shiftstate & 0xF for shiftstate, char, dead in characters)  # without capslock
+
+    # columns in the order of the shift state bits, so that the output does not depend on the order
+    # in which the charmap stores the characters of a key
+    shift_states = sorted(used_states)
+    shift_state_map = {shiftstate: column for column, shiftstate in enumerate(shift_states)}
+    max_mask = max(shift_states, default=0)
 
     # XXX it might be possible to use more columns if we skip column 15 (invalid)
     if len(shift_state_map) >= 15:
@@ -107,7 +110,7 @@ def compile_kbd_charmap(kbdtables: KBDTABLES, layout: Layout):
         vk_to_bits,
         max_mask,
         [
-            shift_state_map.get(ShiftState.from_bits(mask), 0xF)
+            shift_state_map.get(mask, 0xF)
             for mask in range(max_mask + 1)
         ],
     )
@@ -115,50 +118,45 @@ def compile_kbd_charmap(kbdtables: KBDTABLES, layout: Layout):
 
     vk_to_wchars = []
     for vk, attributes in sorted(vk_attributes.items(), key=lambda e: KeyCode.untranslate_vk(e[0])):
-        characters = layout.charmap[vk]
+        characters = {shiftstate: "\uF001" if dead else char  # WCH_DEAD
+                      for shiftstate, char, dead in vk_characters[vk]}
 
         secondary = {}
-        dead = {shiftstate: character.char
-                for shiftstate, character in characters.items()
-                if character.dead and not shiftstate.capslock}
+        dead = {shiftstate: char
+                for shiftstate, char, dead in vk_characters[vk]
+                if dead and not shiftstate & 0x10}
 
         if attributes.capslock_secondary:
             if dead:
                 warn("CAPSLOCK_SECONDARY is incompatible with dead keys, ignoring")
                 attributes = dataclasses.replace(attributes, capslock_secondary=False)
             else:
-                secondary = {dataclasses.replace(shiftstate, capslock=False): character
-                             for shiftstate, character in characters.items()
-                             if shiftstate.capslock}
+                secondary = {shiftstate & 0xF: char
+                             for shiftstate, char in characters.items()
+                             if shiftstate & 0x10}
                 # while unusual, deadkeys are valid in secondary capslock layer
-                dead = {dataclasses.replace(shiftstate, capslock=False): character
-                        for shiftstate, character in characters.items()
-                        if character.dead and shiftstate.capslock}
+                dead = {shiftstate & 0xF: char
+                        for shiftstate, char, dead in vk_characters[vk]
+                        if dead and shiftstate & 0x10}
 
         # base row
         row = VK_TO_WCHARS(vk, attributes.to_bits(), [])
-        for shiftstate in range(len(shift_states)):
-            character = characters.get(shift_states[shiftstate], Character("\uF000"))  # WCH_NONE
-            if character.dead:
-                character = Character("\uF001")  # WCH_DEAD
-            row.wch.append(character.char)
+        for shiftstate in shift_states:
+            row.wch.append(characters.get(shiftstate, "\uF000"))  # WCH_NONE
         vk_to_wchars.append(row)
 
         # secondary capslock row (SGCAPS)
         if attributes.capslock_secondary:
             row = VK_TO_WCHARS(vk, 0, [])
-            for shiftstate in range(len(shift_states)):
-                character = secondary.get(shift_states[shiftstate], Character("\uF000"))  # WCH_NONE
-                if character.dead:
-                    character = Character("\uF001")  # WCH_DEAD
-                row.wch.append(character.char)
+            for shiftstate in shift_states:
+                row.wch.append(secondary.get(shiftstate, "\uF000"))  # WCH_NONE
             vk_to_wchars.append(row)
 
         # dead keys row
         if dead:
             row = VK_TO_WCHARS(0xFF, 0, [
-                dead.get(shift_states[shiftstate], "\uF000")
-                for shiftstate in range(len(shift_states)) 
+                dead.get(shiftstate, "\uF000")
+                for shiftstate in shift_states
             ])
             vk_to_wchars.append(row)
 
@@ -297,7 +295,7 @@ def decompile_kbd_charmap(kbdtables: KBDTABLES, layout: Layout):
             characters = {}
             for col, char in enumerate(the_row.wch):
                 shiftstate = shift_state_map[col]
-                character = Character(char)
+                character = intern(Character(char))
                 if character.char == "\uF000":  # Null
                     pass
                 elif character.char == "\uF001":  # Dead
@@ -317,8 +315,8 @@ def decompile_kbd_charmap(kbdtables: KBDTABLES, layout: Layout):
                 if the_row.Attributes != 0:
                     warn("expected 0 Attributes, not 0x%X" % the_row.Attributes)
                 for col, char in enumerate(the_row.wch):
-                    shiftstate = dataclasses.replace(shift_state_map[col], capslock=True)
-                    character = Character(char)
+                    shiftstate = intern(dataclasses.replace(shift_state_map[col], capslock=True))
+                    character = intern(Character(char))
                     if character.char == "\uF000":  # Null
                         pass
                     elif character.char == "\uF001":  # Dead
@@ -339,8 +337,9 @@ def decompile_kbd_charmap(kbdtables: KBDTABLES, layout: Layout):
                         if char != "\uF000":
                             warn("expected WCH_NONE, not 0x%X" % ord(char))
                     else:
-                        shiftstate = dataclasses.replace(shift_state_map[col], capslock=attributes.capslock_secondary)
-                        character = Character(char, True)
+                        shiftstate = intern(dataclasses.replace(shift_state_map[col],
+                                                                        capslock=attributes.capslock_secondary))
+                        character = intern(Character(char, True))
                         if character.char in "\uF000\uF001\uF002":
                             warn("dead key maps to invalid character")
                         else:
@@ -352,7 +351,8 @@ def decompile_kbd_charmap(kbdtables: KBDTABLES, layout: Layout):
             layout.charmap[vk] = characters
             attributes_update[vk] = attributes
     layout.keymap = {
-        scancode: dataclasses.replace(keycode, attributes=attributes_update.get(keycode.win_vk, KeyAttributes()))
+        scancode: dataclasses.replace(keycode,
+                                      attributes=attributes_update.get(keycode.win_vk, KeyAttributes.from_bits(0)))
         for scancode, keycode in layout.keymap.items()
     }
 
@@ -370,7 +370,7 @@ def decompile_kbd_charmap(kbdtables: KBDTABLES, layout: Layout):
             composed_attr = deadkey.uFlags
             if composed_attr > 1:
                 warn("unknown dead key attributes: 0x%x" % composed_attr)
-            composed = Character(composed_char, composed_attr == 1)
+            composed = intern(Character(composed_char, composed_attr == 1))
             if accent not in layout.deadkeys:
                 layout.deadkeys[accent] = DeadKey(dead_key_names.get(accent, accent), {})
             if character in layout.deadkeys[accent].charmap:
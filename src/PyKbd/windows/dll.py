@@ -17,11 +17,30 @@
 
 import typing
 from collections import defaultdict
-from dataclasses import dataclass, field, is_dataclass
+from dataclasses import dataclass, field, is_dataclass, replace
+from functools import lru_cache
+from mmap import mmap, ACCESS_READ
 from operator import itemgetter
-from warnings import warn
-
-from ..linker_binary import BinaryObject, BinaryObjectReader, Symbol, link
+from os import PathLike, fspath
+
+from . import codegen, records
+from .structs import StructLayout, _prefix_layout, _type_hints
+from .view import view_at
+from ..linker_binary import (
+    BinaryObject,
+    BinaryObjectReader,
+    LinkerMap,
+    MapEntry,
+    MapSection,
+    Symbol,
+    link,
+    link_into,
+    link_to,
+)
+from ..pipeline import Pipeline, Stage, StageStats
+from ..profiling import Profiler, profiled
+from .. import tracing
+from ..tracing import warn
 from . import _version, _version_num
 from .types import (
     CHAR_E,
@@ -74,11 +93,76 @@ class Pointer(Offset):
         return self.offset + offset
 
 
+_codecs = {}
+"""Generated encoders and decoders by (struct, pointer size), None if not available"""
+
+_alignments = {}
+"""Alignment by (pointer size, type, annotations)"""
+
+MAX_NODES = 0x10000
+"""Default maximum number of pointed-to objects decoded by Assembler.decompile"""
+
+
+@lru_cache(maxsize=None)
+def _context_names(tp) -> typing.Optional[typing.FrozenSet[str]]:
+    """Names of context values decoding a type depends on, or None if it may depend on any"""
+    names = set()
+    if typing.get_origin(tp) is typing.Annotated:
+        tp, *annotations = typing.get_args(tp)
+        for annotation in annotations:
+            if isinstance(annotation, _LengthExpr):
+                return None
+            elif isinstance(annotation, _LengthReferenced):
+                names.add(annotation.reference)
+        args = [tp]
+    elif is_dataclass(tp):
+        # structs only pass on their own fields
+        args = []
+    else:
+        args = typing.get_args(tp)
+    for arg in args:
+        arg_names = _context_names(arg)
+        if arg_names is None:
+            return None
+        names |= arg_names
+    return frozenset(names)
+
+
+@dataclass()
+class _DecompileState:
+    max_nodes: typing.Optional[int]
+    nodes: int = 0
+    memo: dict = field(default_factory=dict)
+    """pointed-to objects by (target, address, type, context)"""
+    active: set = field(default_factory=set)
+    """(target, address, type) of pointed-to objects being decoded"""
+
+
 @dataclass()
 class Assembler:
     ptr_size: int
+    codegen: bool = True  # use generated encoders and decoders for fixed-size structs
+    records: bool = False  # decompile arrays of records into NumPy structured arrays, see records module
+
+    def _codec(self, tp):
+        if not self.codegen:
+            return None
+        key = (tp, self.ptr_size)
+        if key not in _codecs:
+            _codecs[key] = codegen.load(
+                tp, self.ptr_size,
+                BinaryObject=BinaryObject, BinaryObjectReader=BinaryObjectReader, Offset=Offset,
+            )
+        return _codecs[key]
 
     def _alignment(self, tp, *annotations):
+        key = (self.ptr_size, tp, annotations)
+        alignment = _alignments.get(key)
+        if alignment is None:
+            alignment = _alignments[key] = self._compute_alignment(tp, *annotations)
+        return alignment
+
+    def _compute_alignment(self, tp, *annotations):
         annotations = list(annotations)
         if annotations:
             annotation = annotations.pop()
@@ -102,7 +186,9 @@ class Assembler:
             tp, = typing.get_args(tp)
             return self._alignment(tp)
         elif is_dataclass(tp):
-            fields = typing.get_type_hints(tp, include_extras=True)
+            if StructLayout.is_fixed(tp, self.ptr_size):
+                return StructLayout.of(tp, self.ptr_size).alignment
+            fields = _type_hints(tp)
             return max(self._alignment(tp) for tp in fields.values())
         else:
             raise NotImplementedError(tp)
@@ -191,6 +277,8 @@ class Assembler:
             assert isinstance(obj, BinaryObject)
             return obj
         elif typing.get_origin(tp) is list:
+            if records.is_records(obj):
+                return records.compile_array(self, obj, typing.get_args(tp)[0], ctx)
             assert isinstance(obj, list)
             tp, = typing.get_args(tp)
             alignment = None
@@ -208,13 +296,22 @@ class Assembler:
             return out
         elif is_dataclass(tp):
             assert isinstance(obj, tp)
+            codec = self._codec(tp)
+            if codec is not None:
+                return codec[0](self, obj, ctx)
             values = []
-            fields = typing.get_type_hints(tp, include_extras=True)
-            ctx2 = obj.__dict__
+            fields = _type_hints(tp)
+            ctx2 = dict(obj.__dict__)
             if "__length" in ctx:
                 ctx2["__length"] = ctx["__length"]
             for name, type_hint in fields.items():
-                values.append(self._compile(getattr(obj, name), type_hint, **ctx2))
+                field_value = getattr(obj, name)
+                value = self._compile(field_value, type_hint, **ctx2)
+                if isinstance(value, Offset) and value.target is not None and value.target.name is None \
+                        and value.target is not field_value:
+                    # name pointed-to objects compiled here for linker maps, BinaryObject fields belong to the caller
+                    value.target.name = "%s.%s" % (tp.__name__, name)
+                values.append(value)
             alignment = 0
             for val in values:
                 if isinstance(val, Offset):
@@ -231,7 +328,10 @@ class Assembler:
 
     def compile(self, obj):
         """Compile struct"""
-        return self._compile(obj, type(obj))
+        out = self._compile(obj, type(obj))
+        if out.name is None and out is not obj:
+            out.name = type(obj).__name__
+        return out
 
     def _decompile(self, data: BinaryObjectReader, tp, *annotations, **ctx):
         annotations = list(annotations)
@@ -258,10 +358,7 @@ class Assembler:
                     addr = self._decompile(data, int, _WinInt(annotation.sizeof, False))
                 if addr != 0:
                     addr = ctx["__conv"](addr - ctx["__base"])
-                    obj = self._decompile(BinaryObjectReader(data.target, addr), tp, *annotations, **ctx)
-                    if isinstance(obj, BinaryObject):
-                        obj.placement = (data.target, addr)
-                    return obj
+                    return self._decompile_target(data.target, addr, tp, ctx)
                 else:
                     return None
             elif isinstance(annotation, _Length):
@@ -326,6 +423,10 @@ class Assembler:
             return BinaryObject(d)
         elif typing.get_origin(tp) is list:
             tp, = typing.get_args(tp)
+            if self.records:
+                array = records.decompile_array(self, data, tp, ctx)
+                if array is not None:
+                    return array
             if not isinstance(ctx["__length"], _NullTerminated):
                 return [self._decompile(data, tp, **ctx) for _ in range(ctx["__length"])]
             else:
@@ -342,11 +443,14 @@ class Assembler:
                     v = self._decompile(data, tp, **ctx)
                 return out
         elif is_dataclass(tp):
+            codec = self._codec(tp)
+            if codec is not None:
+                return codec[1](self, data, ctx)
             data.read_padding(self._alignment(tp))
             # delay PTRs to allow referenced length to follow the pointer
             delayed = {}
             out = tp()
-            fields = typing.get_type_hints(tp, include_extras=True)
+            fields = _type_hints(tp)
             ctx2 = {k: v for k, v in ctx.items() if k.startswith("__")}
             for name, type_hint in fields.items():
                 if typing.get_origin(type_hint) is typing.Annotated and \
@@ -368,16 +472,81 @@ class Assembler:
         else:
             raise NotImplementedError(tp)
 
-    def decompile(self, data, tp, off=0, base=0, conv=lambda x: x):
+    def _decompile_target(self, target: BinaryObject, addr: int, tp, ctx):
+        """Decompile a pointed-to object, or return the object already decoded from the same address"""
+        state = ctx.get("__state")
+        if state is None:
+            state = ctx["__state"] = _DecompileState(None)
+
+        names = _context_names(tp)
+        if names is None:
+            names = sorted(name for name in ctx if not name.startswith("__"))
+        key = (target, addr, tp, ctx.get("__length"), tuple(ctx.get(name) for name in sorted(names)))
+        try:
+            if key in state.memo:
+                tracing.count("cache_hits")
+                return state.memo[key]
+        except TypeError:
+            key = None  # unhashable context, do not memoize
+
+        active = (target, addr, tp)
+        if active in state.active:
+            raise ValueError("pointer cycle at 0x%X" % addr)
+        state.nodes += 1
+        if state.max_nodes is not None and state.nodes > state.max_nodes:
+            raise ValueError("too many objects to decompile: more than %i" % state.max_nodes)
+
+        state.active.add(active)
+        try:
+            obj = self._decompile(BinaryObjectReader(target, addr), tp, **ctx)
+        finally:
+            state.active.discard(active)
+        if isinstance(obj, BinaryObject):
+            obj.placement = (target, addr)
+        if key is not None:
+            state.memo[key] = obj
+        return obj
+
+    def _decompile_detached(self, target: BinaryObject, addr: int, tp, ctx):
+        """Decompile an object outside of a decompile() call, used by views"""
+        ctx = dict(ctx, __state=_DecompileState(ctx.get("__max_nodes", MAX_NODES)))
+        obj = self._decompile(BinaryObjectReader(target, addr), tp, **ctx)
+        if isinstance(obj, BinaryObject):
+            obj.placement = (target, addr)
+        return obj
+
+    def view(self, data, tp, off=0, base=0, conv=lambda x: x, max_nodes=MAX_NODES):
+        """
+        Lazy view of struct
+
+        Same as decompile(), but fields are read and pointers followed only when accessed.
+        The data must not be modified or closed while the view is used.
+
+        :param max_nodes: Limit used when a part of the view is decoded, see decompile().
+        :return: StructView, or the decoded value if tp cannot be viewed
+        """
+        if isinstance(data, BinaryObjectReader):
+            target, off = data.target, data.offset
+        elif isinstance(data, BinaryObject):
+            target = data
+        else:
+            target = BinaryObject(data, alignment=self.ptr_size)
+        return view_at(self, target, off, tp, {"__base": base, "__conv": conv, "__max_nodes": max_nodes})
+
+    def decompile(self, data, tp, off=0, base=0, conv=lambda x: x, max_nodes=MAX_NODES):
         """
         Decompile struct
 
+        Each pointed-to object is decoded once, objects referenced by several pointers are shared.
+
         :param data: The raw data to decompile.
                      Converted to BinaryObject if not a BinaryObjectReader.
         :param tp:   Expected type of struct.
         :param off:  Offset of struct in given data if it is not a BinaryObjectReader.
         :param base: Subtracted from pointers before reading pointed-to struct.
         :param conv: Pointer conversion routine, accepts subtracted address.
+        :param max_nodes: Maximum number of pointed-to objects to decode, or None for no limit.
+        :raises ValueError: if pointers form a cycle or max_nodes is exceeded
         """
         if isinstance(data, BinaryObjectReader):
             reader = data
@@ -385,7 +554,7 @@ class Assembler:
             if not isinstance(data, BinaryObject):
                 data = BinaryObject(data, alignment=self.ptr_size)
             reader = BinaryObjectReader(data, off)
-        return self._decompile(reader, tp, __base=base, __conv=conv)
+        return self._decompile(reader, tp, __base=base, __conv=conv, __state=_DecompileState(max_nodes))
 
 
 def _aligned_next(addr, align):
@@ -731,6 +900,10 @@ class Compiler:
     align_file: int = 0x200
     align_section: int = 0x1000
 
+    optimize_size: bool = False  # use the smallest section alignment accepted by the loader, reduces SizeOfImage
+    merge_sections: bool = False  # place resources and relocations into one data section, reduces file size
+    emit_map: bool = False  # store a map of the compiled image in linker_map
+
     assembler: typing.Optional[Assembler] = None
 
     dir_export: typing.Optional[BinaryObject] = None
@@ -741,28 +914,168 @@ class Compiler:
     sec_rsrc: typing.Optional[BinaryObject] = None
     sec_reloc: typing.Optional[BinaryObject] = None
 
+    header: typing.Optional[BinaryObject] = None
     file: typing.Optional[BinaryObject] = None
+    linker_map: typing.Optional[LinkerMap] = None
+
+    pipeline: typing.Optional[Pipeline] = field(default=None, compare=False, repr=False)  # see default_pipeline()
+    # stats of the stages of the last compile, see Pipeline.run()
+    stage_stats: typing.Optional[typing.List[StageStats]] = field(default=None, compare=False, repr=False)
+
+    def __post_init__(self):
+        if self.optimize_size:
+            # SectionAlignment may be below page size only if it equals FileAlignment,
+            # the image is then mapped as-is, i.e. file offsets must equal RVAs
+            if self.align_section not in (Compiler.align_section, self.align_file):
+                raise ValueError("optimize_size requires align_section equal to align_file")
+            self.align_section = self.align_file
+        if self.pipeline is None:
+            self.pipeline = self.default_pipeline()
+
+    @staticmethod
+    def default_pipeline() -> Pipeline:
+        """Stages run by compile(), compile_to() and compile_into() stop before link."""
+        return Pipeline([
+            Stage("assembler", Compiler.compile_assembler),
+            Stage("compile_sec_data", Compiler._compile_sec_data, ("sec_data",)),
+            Stage("compile_sec_rsrc", Compiler._compile_sec_rsrc, ("sec_rsrc",)),
+            Stage("compile_sec_reloc", Compiler._compile_sec_reloc, ("sec_reloc",)),
+            Stage("compile_header", Compiler.compile_header, ("header",)),
+            Stage("linker_map", Compiler.compile_linker_map),
+            Stage("link", Compiler.link, ("file",)),
+        ])
+
+    def compile(self, profile: typing.Optional[Profiler] = None):
+        """:param profile: profile the run, see profiling module"""
+        with profiled(profile, "compile %s" % self.dll_name), self._span("compile") as span:
+            self.stage_stats = self.pipeline.run(self)
+            span.set(size=len(self.file.data))
+        return bytes(self.file.data)
 
-    def compile(self):
-        self.assembler = Assembler(self.arch.pointer_native)
+    def compile_to(self, file: typing.Union[str, PathLike, typing.BinaryIO],
+                   profile: typing.Optional[Profiler] = None) -> int:
+        """
+        Compile and write the image directly to a file, without assembling it in memory.
+
+        :param file: path or writable binary file object
+        :param profile: profile the run, see profiling module
+        :return: number of bytes written
+        """
+        with profiled(profile, "compile %s" % self.dll_name), self._span("compile") as span:
+            self.compile_sections()
+            with tracing.span("write", path=fspath(file) if isinstance(file, (str, PathLike)) else None) as write:
+                if isinstance(file, (str, PathLike)):
+                    with open(file, "wb") as f:
+                        length = link_to(self._assembly_objects(), f)
+                else:
+                    length = link_to(self._assembly_objects(), file)
+                write.set(size=length)
+            span.set(size=length)
+            return length
+
+    def compile_into(self, buffer, profile: typing.Optional[Profiler] = None) -> int:
+        """
+        Compile and write the image directly into a writable buffer, without assembling it in memory.
+
+        :param buffer: object supporting the writable buffer protocol, e.g. bytearray or mmap
+        :param profile: profile the run, see profiling module
+        :return: number of bytes written
+        """
+        with profiled(profile, "compile %s" % self.dll_name), self._span("compile") as span:
+            self.compile_sections()
+            with tracing.span("write") as write:
+                length = link_into(self._assembly_objects(), buffer)
+                write.set(size=length)
+            span.set(size=length)
+            return length
+
+    def _span(self, event: str, **fields):
+        return tracing.span(event, layout=self.dll_name, architecture=self.arch.name, **fields)
+
+    def size_report(self) -> typing.Tuple[int, int]:
+        """
+        Compile with default options and with the options of this object.
+
+        :return: file size with default options, file size with current options
+        """
+        default = Compiler(self.arch, self.kbdtables, self.versioninfo, self.timestamp, self.dll_name)
+        return len(default.compile()), len(self.compile())
+
+    def _assembly_objects(self):
+        # sections are already linked, place them into the file as they are
+        for section in (self.sec_data, self.sec_rsrc, self.sec_reloc):
+            section.placement = None
+            section.symbols = {}
+        return [self.header]
 
-        # skip header "section"
-        next_section = self.align_section
+    def compile_sections(self):
+        self.stage_stats = self.pipeline.run(self, stop="link")
 
+    def compile_assembler(self):
+        self.assembler = Assembler(self.arch.pointer_native)
+
+    def _section_base(self, previous: typing.Optional[BinaryObject]) -> int:
+        """RVA of the section following previous, or of the first section"""
+        if previous is None:
+            # skip header "section"
+            return _aligned_next(self._header_length(), self.align_section)
+        # relocations merged into the resource section are only aligned as required by their contents
+        align_section = 4 if self.merge_sections and previous is self.sec_rsrc else self.align_section
+        return previous.placement[1] + _aligned_next(len(previous.data), align_section)
+
+    def _compile_sec_data(self):
+        next_section = self._section_base(None)
         self.compile_sec_data(next_section)
         assert self.sec_data.placement == (None, next_section)
-        next_section += _aligned_next(len(self.sec_data.data), self.align_section)
 
+    def _compile_sec_rsrc(self):
+        next_section = self._section_base(self.sec_data)
         self.compile_sec_rsrc(next_section)
         assert self.sec_rsrc.placement == (None, next_section)
-        next_section += _aligned_next(len(self.sec_rsrc.data), self.align_section)
 
+    def _compile_sec_reloc(self):
+        next_section = self._section_base(self.sec_rsrc)
         self.compile_sec_reloc(next_section)
         assert self.sec_reloc.placement == (None, next_section)
-        next_section += _aligned_next(len(self.sec_reloc.data), self.align_section)
 
-        self.compile_header()
-        return bytes(self.file.data)
+    def compile_linker_map(self):
+        if self.emit_map:
+            self.linker_map = self._linker_map()
+
+    def link(self):
+        self.file = link(self._assembly_objects())
+
+    def _linker_map(self) -> LinkerMap:
+        # must run before linking the file, addresses are RVAs only until then
+        linker_map = LinkerMap()
+        mz = self.header
+        pe, = (symbol.target for symbol in mz.symbols.values())
+        pe_address = _aligned_next(len(mz.data), pe.alignment)
+        linker_map.sections.append(MapSection("headers", 0, [
+            MapEntry(mz.name, 0, len(mz.data), mz.alignment, 0),
+            MapEntry(pe.name, pe_address, len(pe.data), pe.alignment, pe_address - len(mz.data)),
+        ]))
+        for section in (self.sec_data, self.sec_rsrc, self.sec_reloc):
+            name = ".rsrc" if self.merge_sections and section is self.sec_reloc else next(
+                name for name, sec, characteristics in self._sections() if sec is section
+            )
+            linker_map.add(name.rstrip("\0"), section)
+        return linker_map
+
+    def _merge_section(self, section: BinaryObject):
+        """Append linked relocations to .rsrc"""
+        end = self.sec_rsrc.placement[1] + len(self.sec_rsrc.data)
+        self.sec_rsrc.data.extend(bytes(section.placement[1] - end))
+        self.sec_rsrc.data.extend(section.data)
+
+    def _sections(self):
+        sections = [
+            (".data\0\0\0", self.sec_data, 0x60000040),  # char: init data, read, execute
+            (".rsrc\0\0\0", self.sec_rsrc, 0x42000040),  # char: init data, read, discard
+        ]
+        if not self.merge_sections:
+            sections.append((".reloc\0\0", self.sec_reloc, 0x42000040))  # char: init data, read, discard
+        return sections
 
     def compile_sec_data(self, base):
         """Keyboard data and functions"""
@@ -770,7 +1083,7 @@ class Compiler:
 
         kbdtables = Assembler(self.arch.pointer_tables).compile(self.kbdtables)
 
-        KbdLayerDescriptor = BinaryObject(self.arch.func % func_ptr(None)().data)
+        KbdLayerDescriptor = BinaryObject(self.arch.func % func_ptr(None)().data, name="KbdLayerDescriptor")
         KbdLayerDescriptor.symbols[self.arch.func.index(b"%b")] = func_ptr(kbdtables)
 
         export = DirExport()
@@ -836,21 +1149,48 @@ class Compiler:
         self.dir_reloc = self.assembler.compile(reloc)
         self.sec_reloc = link([self.dir_reloc], base=base)
         self.sec_reloc.alignment = self.align_file
+        if self.merge_sections:
+            self._merge_section(self.sec_reloc)
 
-    def compile_header(self):
+    def _compile_headers(self, headers: HeaderDOS) -> BinaryObject:
+        mz = self.assembler.compile(headers)
+        mz.append(dos_stub)
+        mz.append(b"Generated with PyKbd %a for %a" % (__version__, self.arch.name))
+        return mz
+
+    def _new_headers(self) -> HeaderDOS:
+        """Headers with all fields that determine their length, i.e. all but addresses and sizes"""
         headers = HeaderDOS()
+        headers.pe.opt.Magic = self.arch.magic
+        headers.pe.opt.NumberOfRvaAndSizes = 16
+        headers.pe.opt.Directories = [Directory()] * 16
+        headers.pe.SizeOfOptionalHeader = len(headers.pe.opt)
+        headers.pe.sections = [
+            Section(name, Characteristics=characteristics) for name, section, characteristics in self._sections()
+        ]
+        headers.pe.NumberOfSections = len(headers.pe.sections)
+        return headers
+
+    def _header_length(self) -> int:
+        """Length of headers produced by compile_header, excluding padding"""
+        mz = self._compile_headers(self._new_headers())
+        pe, = (symbol.target for symbol in mz.symbols.values())
+        return _aligned_next(len(mz.data), pe.alignment) + len(pe.data)
+
+    def compile_header(self):
+        headers = self._new_headers()
+        sections = self._sections()
 
         assert isinstance(headers.pe, HeaderCOFF)
         headers.pe.Machine = self.arch.machine
-        headers.pe.NumberOfSections = 3
+        headers.pe.NumberOfSections = len(sections)
         headers.pe.TimeDateStamp = self.timestamp
         headers.pe.Characteristics = self.arch.characteristics
 
         assert isinstance(headers.pe.opt, HeaderOpt)
-        headers.pe.opt.Magic = self.arch.magic
         headers.pe.opt.SizeOfInitializedData = sum(
-            _aligned_next(len(sec.data), self.align_file)
-            for sec in (self.sec_data, self.sec_reloc)
+            _aligned_next(len(section.data), self.align_file)
+            for name, section, characteristics in sections
         )
         headers.pe.opt.BaseOfCode = self.sec_data.placement[1]
         if self.arch.pointer_native == 8:
@@ -863,40 +1203,61 @@ class Compiler:
         headers.pe.opt.FileAlignment = self.align_file
         headers.pe.opt.ImageVersion = self.versioninfo.Value.FILEVERSION[:2]
         headers.pe.opt.SizeOfImage = _aligned_next(
-            self.sec_reloc.placement[1] + len(self.sec_reloc.data), self.align_section
+            sections[-1][1].placement[1] + len(sections[-1][1].data), self.align_section
         )
-        headers.pe.opt.SizeOfHeaders = 2*self.align_file  # FIXME
+        headers.pe.opt.SizeOfHeaders = _aligned_next(self._header_length(), self.align_file)
         headers.pe.opt.CheckSum = 0x83D6DB17  # FIXME
-        headers.pe.opt.NumberOfRvaAndSizes = 16
-        headers.pe.opt.Directories = [Directory()] * 16
+        headers.pe.opt.Directories = list(headers.pe.opt.Directories)
         for i, d in (
                 (0, self.dir_export),
                 (2, self.dir_rsrc),
                 (5, self.dir_reloc)
         ):
             headers.pe.opt.Directories[i] = Directory(d.find_placement()[1], len(d.data))
-        headers.pe.SizeOfOptionalHeader = len(headers.pe.opt)
 
-        for name, section, characteristics in (
-                (".data\0\0\0", self.sec_data, 0x60000040),  # char: init data, read, execute
-                (".rsrc\0\0\0", self.sec_rsrc, 0x42000040),  # char: init data, read, discard
-                (".reloc\0\0", self.sec_reloc, 0x42000040),  # char: init data, read, discard
-        ):
-            s = Section(name)
+        for s, (name, section, characteristics) in zip(headers.pe.sections, sections):
             s.VirtualSize = len(section.data)
             s.VirtualAddress = section.placement[1]
-            section = BinaryObject(section.data, self.align_file)
             section.append_padding(self.align_file)
             s.SizeOfRawData = len(section.data)
             s.PointerToRawData = section
-            s.Characteristics = characteristics
-            headers.pe.sections.append(s)
-        headers.pe.NumberOfSections = len(headers.pe.sections)
 
-        mz = self.assembler.compile(headers)
-        mz.append(dos_stub)
-        mz.append(b"Generated with PyKbd %a for %a" % (__version__, self.arch.name))
-        self.file = link([mz])
+        self.header = self._compile_headers(headers)
+
+
+def _decode_descriptor(code: bytes, arch: Architecture, base: int, rva: int) -> typing.Tuple[Architecture, int]:
+    """
+    Decode KbdLayerDescriptor, which returns the address of KBDTABLES.
+
+    :param code: start of the function, it is typically shorter than 16 bytes
+    :param arch: architecture from the COFF header, X86 for both X86 and WOW64
+    :param base: image base
+    :param rva: RVA of the function
+    :return: architecture, i.e. WOW64 if the address is sign-extended, and RVA of KBDTABLES
+    :raise IOError: if the function is not recognized
+    """
+    reader = BinaryObjectReader(BinaryObject(code))
+    if arch == AMD64:
+        reader.read_or_fail(b"\x48")
+    ins = reader.read_bytes(1)
+    if ins == b"\xB8":  # MOV EAX, ...
+        table_rva = int.from_bytes(reader.read_bytes(arch.pointer_native), byteorder="little") - base
+        ins = reader.read_bytes(1)
+        if ins == b"\x99":  # CDQ
+            if arch == X86:
+                arch = WOW64
+            elif arch != WOW64:
+                raise IOError("unexpected instruction: 0x%s" % ins.hex().upper())
+            ins = reader.read_bytes(1)
+    elif ins == b"\x8D":  # LEA ...
+        reader.read_or_fail(b"\x05")  # (ModR/M) ... EAX, [disp32]
+        table_rva = int.from_bytes(reader.read_bytes(4), byteorder="little") + rva + reader.offset
+        ins = reader.read_bytes(1)
+    else:
+        raise IOError("unexpected instruction: 0x%s" % ins.hex().upper())
+    if ins != b"\xC3":  # RET
+        raise IOError("unexpected instruction: 0x%s" % ins.hex().upper())
+    return arch, table_rva
 
 
 @dataclass()
@@ -907,6 +1268,9 @@ class Decompiler:
     base: int = 0
 
     assembler: Assembler = field(default_factory=lambda: Assembler(4))
+    max_nodes: typing.Optional[int] = MAX_NODES
+    view: bool = False  # return a lazy view of KBDTABLES, data must stay open while it is used
+    records: bool = False  # decompile arrays of records in KBDTABLES into NumPy structured arrays
 
     sections: typing.Optional[list[Section]] = None
 
@@ -919,6 +1283,9 @@ class Decompiler:
     kbdtables: typing.Optional[KBDTABLES] = None
     versioninfo: typing.Optional[Resource] = None
 
+    image: typing.Optional[BinaryObject] = None
+    """data read by decompile(), the given data is never modified"""
+
     def convert_rva(self, rva):
         """Convert RVA to file offset or raise ValueError"""
         for section in self.sections:
@@ -929,21 +1296,25 @@ class Decompiler:
                     return section.PointerToRawData.placement[1] + offset
         raise ValueError(rva)
 
-    def decompile(self):
-        if not isinstance(self.data, BinaryObject):
-            self.data = BinaryObject(self.data, 4)
+    def decompile(self, profile: typing.Optional[Profiler] = None):
+        """:param profile: profile the run, see profiling module"""
+        with profiled(profile, "decompile"), tracing.span("decompile", size=len(self.data)) as span:
+            # sections of a PE image are aligned to at least 512 bytes, regardless of the given alignment
+            self.image = BinaryObject.wrap(self.data.data if isinstance(self.data, BinaryObject) else self.data,
+                                           alignment=0x200)
 
-        self.decompile_header()
+            self.decompile_header()
 
-        self.decompile_dir_export()
+            self.decompile_dir_export()
+            span.set(layout=self.dll_name, architecture=self.arch.name)
 
         return self.kbdtables, self.versioninfo, self.timestamp, self.dll_name
 
     def decompile_header(self):
-        reader = BinaryObjectReader(self.data)
+        reader = BinaryObjectReader(self.image)
 
         reader.read_or_fail(b"MZ")
-        reader.offset = 0x3C
+        reader.offset = StructLayout.of(HeaderDOS, 4).offsetof("pe")
         pe_offset = self.assembler.decompile(reader, DWORD)
         dos = reader.read_bytes(pe_offset - 0x40)
         reader.read_or_fail(b"PE\0\0")
@@ -952,13 +1323,12 @@ class Decompiler:
             self.arch = X86  # could be WOW64, checked later
         elif coff_machine == AMD64.machine:
             self.arch = AMD64
-            self.data.alignment = 8  # FIXME changing guess from decompile()
-                                     #       should not affect given BinaryObject
         else:
             raise IOError("unknown architecture: %x" % coff_machine)
-        self.assembler.ptr_size = self.arch.pointer_native
+        # the given assembler may be shared
+        self.assembler = replace(self.assembler, ptr_size=self.arch.pointer_native)
 
-        header = self.assembler.decompile(self.data, HeaderDOS)
+        header = self.assembler.decompile(self.image, HeaderDOS, max_nodes=self.max_nodes)
 
         assert isinstance(header.pe, HeaderCOFF)
         assert header.pe.Machine == self.arch.machine
@@ -979,7 +1349,7 @@ class Decompiler:
                 directory = header.pe.opt.Directories[num]
                 if directory.VirtualAddress != 0 and directory.Size != 0:
                     off = self.convert_rva(directory.VirtualAddress)
-                    obj = BinaryObject(self.data.data[off:off + directory.Size], 4)
+                    obj = BinaryObject(self.image.data[off:off + directory.Size], 4)
                     assert len(obj) == directory.Size
                     obj.placement = (None, directory.VirtualAddress)
                     setattr(self, f"dir_{name}", obj)
@@ -987,7 +1357,8 @@ class Decompiler:
     def decompile_dir_export(self):
         reader = BinaryObjectReader(self.dir_export)
 
-        dir_export = self.assembler.decompile(reader, DirExport, base=self.dir_export.placement[1])
+        dir_export = self.assembler.decompile(reader, DirExport, base=self.dir_export.placement[1],
+                                              max_nodes=self.max_nodes)
         self.dll_name = dir_export.name
 
         for name, ordinal in zip(dir_export.names, dir_export.ordinals):
@@ -1001,35 +1372,154 @@ class Decompiler:
             raise IOError("not a valid keyboard layout")
 
         # function is typically shorter than 16 bytes
-        reader = BinaryObjectReader(
-            BinaryObject(self.data.data[KbdLayerDescriptor_off:KbdLayerDescriptor_off+16])
+        self.arch, table_rva = _decode_descriptor(
+            bytes(self.image.data[KbdLayerDescriptor_off:KbdLayerDescriptor_off+16]),
+            self.arch, self.base, KbdLayerDescriptor_rva,
         )
 
-        if self.arch == AMD64:
-            reader.read_or_fail(b"\x48")
-        ins = reader.read_bytes(1)
-        if ins == b"\xB8":  # MOV EAX, ...
-            table_rva_bts = reader.read_bytes(self.arch.pointer_native)
-            table_rva = self.assembler.decompile(table_rva_bts, DWORD_PTR) - self.base
-            ins = reader.read_bytes(1)
-            if ins == b"\x99":  # CDQ
-                if self.arch == X86:
-                    self.arch = WOW64
-                elif self.arch != WOW64:
-                    raise IOError("unexpected instruction: 0x%X" % ins)
-                ins = reader.read_bytes(1)
-        elif ins == b"\x8D":  # LEA ...
-            reader.read_or_fail(b"\x05")  # (ModR/M) ... EAX, [disp32]
-            table_rva_bts = reader.read_bytes(4)
-            table_rva = self.assembler.decompile(table_rva_bts, DWORD)
-            table_rva += KbdLayerDescriptor_rva + reader.offset
-            ins = reader.read_bytes(1)
-        else:
-            raise IOError("unexpected instruction: 0x%X" % ins)
-        if ins != b"\xC3":  # RET
-            raise IOError("unexpected instruction: 0x%X" % ins)
-
         table_off = self.convert_rva(table_rva)
-        self.kbdtables = Assembler(self.arch.pointer_tables).decompile(
-            self.data, KBDTABLES, off=table_off, base=self.arch.base, conv=self.convert_rva
+        assembler = Assembler(self.arch.pointer_tables, records=self.records)
+        self.kbdtables = (assembler.view if self.view else assembler.decompile)(
+            self.image, KBDTABLES, off=table_off, base=self.arch.base, conv=self.convert_rva, max_nodes=self.max_nodes
         )
+
+
+def decompile_file(path: typing.Union[str, PathLike], profile: typing.Optional[Profiler] = None):
+    """
+    Decompile a DLL by mapping it into memory instead of reading it.
+
+    Only the parts of the file that are needed are read.
+
+    :param profile: profile the run, see profiling module
+    :return: same as Decompiler.decompile()
+    """
+    with profiled(profile, "decompile %s" % fspath(path)), tracing.span("decompile", path=fspath(path)), \
+            open(path, "rb") as f, mmap(f.fileno(), 0, access=ACCESS_READ) as data:
+        return Decompiler(BinaryObject.wrap(data, 4)).decompile()
+
+
+_SECTION = StructLayout.of(Section, 4)
+
+
+@dataclass(frozen=True)
+class DllInfo:
+    arch: Architecture
+    timestamp: int
+    dll_name: typing.Optional[str]
+    layout: bool  # exports KbdLayerDescriptor
+
+
+class _SniffReader:
+    """Reads small pieces of a file or buffer, serving the first page from memory."""
+
+    def __init__(self, file):
+        self.file = None
+        try:
+            self.head = memoryview(file).cast("B")
+        except TypeError:
+            self.file = file
+            self.file.seek(0)
+            self.head = self.file.read(0x1000)
+
+    def read(self, offset, size):
+        if offset < 0:
+            return b""
+        if self.file is None or offset + size <= len(self.head):
+            return bytes(self.head[offset:offset + size])
+        self.file.seek(offset)
+        return self.file.read(size)
+
+    def int(self, offset, size):
+        data = self.read(offset, size)
+        if len(data) != size:
+            raise EOFError
+        return int.from_bytes(data, byteorder="little", signed=False)
+
+    def fields(self, tp, ptr_size: int, offset: int) -> typing.Callable[[str], typing.Any]:
+        """Reader of the leading fixed-size fields of the struct at offset, see StructLayout.read()"""
+        layout, complete = _prefix_layout(tp, ptr_size)
+        data = self.read(offset, layout.size)
+        if len(data) != layout.size:
+            raise EOFError
+        return lambda name: layout.read(data, name)
+
+    def str(self, offset, limit=0x100):
+        data = self.read(offset, limit)
+        end = data.find(b"\0")
+        if end < 0:
+            raise EOFError
+        return data[:end].decode("ascii", errors="replace")
+
+
+def sniff(file) -> typing.Optional[DllInfo]:
+    """
+    Quickly classify a DLL by reading only its headers and export name table.
+
+    KBDTABLES is never read, so this is much cheaper than a full Decompiler run.
+
+    :param file: path, binary file object or buffer (e.g. bytes or mmap)
+    :return: None if file is not a PE image of a known architecture
+    """
+    if isinstance(file, (str, PathLike)):
+        with open(file, "rb") as f:
+            return sniff(f)
+
+    reader = _SniffReader(file)
+    try:
+        if reader.read(0, 2) != b"MZ":
+            return None
+        pe = reader.fields(HeaderDOS, 4, 0)("pe")
+        coff = reader.fields(HeaderCOFF, 4, pe)
+        if coff("signature") != b"PE\0\0":
+            return None
+        if coff("Machine") == X86.machine:
+            arch = X86  # could be WOW64, checked later
+        elif coff("Machine") == AMD64.machine:
+            arch = AMD64
+        else:
+            return None
+        timestamp = coff("TimeDateStamp")
+
+        # the optional header and the section table follow the fixed fields of the COFF header
+        opt_offset = pe + _prefix_layout(HeaderCOFF, 4)[0].size
+        opt_layout = _prefix_layout(HeaderOpt, arch.pointer_native)[0]
+        opt = reader.fields(HeaderOpt, arch.pointer_native, opt_offset)
+        if opt("Magic") != arch.magic:
+            return None
+        sections = [reader.fields(Section, 4, opt_offset + coff("SizeOfOptionalHeader") + i * _SECTION.size)
+                    for i in range(coff("NumberOfSections"))]
+
+        def convert_rva(rva):
+            for section in sections:
+                if section("VirtualAddress") <= rva < section("VirtualAddress") + section("VirtualSize"):
+                    return section("PointerToRawData") + rva - section("VirtualAddress")
+            raise EOFError
+
+        if opt("NumberOfRvaAndSizes") < 1:
+            return DllInfo(arch, timestamp, None, False)
+        directory = reader.fields(Directory, 4, opt_offset + opt_layout.size)  # export directory
+        if directory("VirtualAddress") == 0:
+            return DllInfo(arch, timestamp, None, False)
+        export = reader.fields(DirExport, 4, convert_rva(directory("VirtualAddress")))
+
+        dll_name = reader.str(convert_rva(export("name")))
+        names = reader.read(convert_rva(export("names")), 4 * export("name_count"))
+        for i in range(len(names) // 4):
+            name = convert_rva(int.from_bytes(names[4 * i:4 * i + 4], byteorder="little"))
+            if reader.read(name, 19) == b"KbdLayerDescriptor\0":
+                break
+        else:
+            return DllInfo(arch, timestamp, dll_name, False)
+
+        if arch == X86:
+            # the address of KBDTABLES is sign-extended on WOW64, decoded like Decompiler does
+            ordinal = reader.int(convert_rva(export("ordinals")) + 2 * i, 2)
+            func = reader.int(convert_rva(export("addresses")) + 4 * ordinal, 4)
+            try:
+                arch = _decode_descriptor(reader.read(convert_rva(func), 16), arch, opt("ImageBase"), func)[0]
+            except IOError:
+                return None
+
+        return DllInfo(arch, timestamp, dll_name, True)
+    except EOFError:
+        return None
@@ -0,0 +1,263 @@
+# This file is part of PyKbd
+#
+# Copyright (C) 2019-2020  Nulano
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+NumPy structured arrays of fixed-size records.
+
+Arrays of records without pointers, e.g. ``VSC_VK``, ``DEADKEY``, ``pusVSCtoVK`` or ``VK_TO_WCHARS`` rows,
+can be read and written as NumPy structured arrays in a single ``frombuffer`` or ``tobytes`` call.
+Characters are stored as code units (``u1`` or ``<u2``), pointers are not supported.
+
+NumPy is an optional dependency, it is only imported by this module.
+Pass ``records=True`` to the Assembler to decompile such arrays into structured arrays,
+structured arrays of the right dtype are compiled regardless.
+"""
+
+import typing
+from dataclasses import is_dataclass
+from typing import Optional
+
+from . import _version
+from .structs import FieldLayout, _prefix_layout, _scalar, _type_hints
+from .types import _Length, _NullTerminated
+from .view import _aligned, _count, _element, _unwrap
+from ..linker_binary import BinaryObject, BinaryObjectReader
+
+try:
+    import numpy
+except ImportError:  # optional dependency
+    numpy = None
+
+
+__version__ = _version
+
+
+def _require():
+    if numpy is None:
+        raise ImportError("NumPy is required for record arrays")
+
+
+def _trailing(tp, ptr_size: int) -> Optional[FieldLayout]:
+    """Element layout of the array ending a struct, e.g. VK_TO_WCHARS.wch"""
+    layout, complete = _prefix_layout(tp, ptr_size)
+    hints = _type_hints(tp)
+    if layout is None or complete or len(layout.fields) != len(hints) - 1:
+        return None
+    name, hint = list(hints.items())[-1]
+    item, annotations = _unwrap(hint)
+    if typing.get_origin(item) is not list or [type(annotation) for annotation in annotations] != [_Length]:
+        return None
+    scalar = _scalar(name, typing.get_args(item)[0], ptr_size)
+    if scalar is None or scalar.pointer is not None:
+        return None
+    return scalar
+
+
+def _field_dtype(field: FieldLayout):
+    if field.elements:
+        formats = {_field_dtype(element) for element in field.elements}
+        sizes = sum(element.size for element in field.elements)
+        if len(formats) == 1 and sizes == field.size:
+            return formats.pop(), (len(field.elements),)
+        return numpy.dtype({
+            "names": ["f%i" % i for i in range(len(field.elements))],
+            "formats": [_field_dtype(element) for element in field.elements],
+            "offsets": [element.offset - field.offset for element in field.elements],
+            "itemsize": field.size,
+        })
+    elif field.encoding is not None:
+        unit = "u1" if field.encoding.sizeof == 1 else "<u%i" % field.encoding.sizeof
+        return unit if field.length == 1 else (unit, (field.length,))
+    elif field.format.endswith("s"):
+        return "S%i" % field.length
+    return "<" + field.format
+
+
+def dtype(tp, ptr_size: int, length: Optional[int] = None):
+    """
+    Structured dtype of an array element.
+
+    Elements are padded to their alignment, like in compiled arrays.
+
+    :param tp: fixed-size struct without pointers, struct ending with an array (e.g. VK_TO_WCHARS), or integer type
+    :param length: length of the array ending a struct
+    :raises TypeError: if tp cannot be stored in a structured array
+    """
+    _require()
+    if not is_dataclass(tp):
+        scalar = _scalar("", tp, ptr_size)
+        if scalar is None or scalar.pointer is not None or scalar.encoding is not None:
+            raise TypeError("not a record type: %r" % (tp,))
+        return numpy.dtype(_field_dtype(scalar))
+    layout, complete = _prefix_layout(tp, ptr_size)
+    trailing = None if complete else _trailing(tp, ptr_size)
+    if layout is None or (not complete and trailing is None) or \
+            any(field.pointer is not None for field in layout.fields.values()):
+        raise TypeError("not a record type: %r" % (tp,))
+    names = list(layout.fields)
+    formats = [_field_dtype(field) for field in layout.fields.values()]
+    offsets = [field.offset for field in layout.fields.values()]
+    size, alignment = layout.size, layout.alignment
+    if trailing is not None:
+        if length is None:
+            raise TypeError("length of %s.%s is required" % (tp.__name__, trailing.name))
+        offset = _aligned(size, trailing.alignment)
+        names.append(trailing.name)
+        formats.append((_field_dtype(trailing), (length,)))
+        offsets.append(offset)
+        size, alignment = offset + length * trailing.size, max(alignment, trailing.alignment)
+    return numpy.dtype({"names": names, "formats": formats, "offsets": offsets,
+                        "itemsize": _aligned(size, alignment)})
+
+
+def is_records(obj) -> bool:
+    return numpy is not None and isinstance(obj, numpy.ndarray)
+
+
+def read(buffer, tp, count: int, offset: int = 0, ptr_size: int = 4, length: Optional[int] = None):
+    """
+    Array of count elements at offset of buffer, sharing memory with buffer.
+
+    :param length: length of the array ending a struct, see dtype()
+    """
+    return numpy.frombuffer(buffer, dtype(tp, ptr_size, length), count, offset)
+
+
+def _is_unit(unit: int, sizeof: int) -> bool:
+    """Whether a character is a single code unit of ascii (sizeof 1) or utf-16 (sizeof 2)"""
+    if sizeof == 1:
+        return unit < 0x80
+    return unit < 0xD800 or 0xE000 <= unit < 0x10000
+
+
+def _to_raw(field: FieldLayout, value):
+    if field.elements:
+        if len(value) != len(field.elements):
+            raise ValueError("%s must have %i elements" % (field.name, len(field.elements)))
+        return tuple(_to_raw(element, v) for element, v in zip(field.elements, value))
+    elif field.encoding is not None:
+        if len(value) != field.length:
+            raise ValueError("%s must have length %i" % (field.name, field.length))
+        units = [ord(char) for char in value]
+        if not all(_is_unit(unit, field.encoding.sizeof) for unit in units):
+            raise UnicodeError("unsupported characters in object")
+        return units[0] if field.length == 1 else units
+    return value
+
+
+def _from_raw(field: FieldLayout, value):
+    if field.elements:
+        return tuple(_from_raw(element, v) for element, v in zip(field.elements, value))
+    elif field.encoding is not None:
+        units = [value] if field.length == 1 else value
+        if not all(_is_unit(unit, field.encoding.sizeof) for unit in units):
+            raise UnicodeError("read incorrect")
+        return "".join(map(chr, units))
+    return value
+
+
+def _fields(tp, ptr_size: int):
+    layout, complete = _prefix_layout(tp, ptr_size)
+    fields = list(layout.fields.values())
+    trailing = None if complete else _trailing(tp, ptr_size)
+    return fields, trailing
+
+
+def to_records(values: list, tp, ptr_size: int = 4):
+    """Structured array of a list of structs or integers."""
+    _require()
+    if not is_dataclass(tp):
+        return numpy.array(values, dtype=dtype(tp, ptr_size))
+    fields, trailing = _fields(tp, ptr_size)
+    length = None
+    if trailing is not None:
+        lengths = {len(getattr(value, trailing.name)) for value in values}
+        if len(lengths) > 1:
+            raise ValueError("%s must have the same length in all elements" % trailing.name)
+        length = lengths.pop() if lengths else 0
+    array = numpy.zeros(len(values), dtype(tp, ptr_size, length))
+    for field in fields:
+        array[field.name] = [_to_raw(field, getattr(value, field.name)) for value in values]
+    if trailing is not None and values:
+        array[trailing.name] = [[_to_raw(trailing, char) for char in getattr(value, trailing.name)]
+                                for value in values]
+    return array
+
+
+def from_records(array, tp, ptr_size: int = 4) -> list:
+    """List of structs or integers of a structured array."""
+    if not is_dataclass(tp):
+        return array.tolist()
+    fields, trailing = _fields(tp, ptr_size)
+    columns = [[_from_raw(field, value) for value in array[field.name].tolist()] for field in fields]
+    if trailing is not None:
+        columns.append([[_from_raw(trailing, unit) for unit in row] for row in array[trailing.name].tolist()])
+    return [tp(*row) for row in zip(*columns)]
+
+
+def _record_type(assembler, hint, ctx):
+    """Element type, dtype and size of an array of records, or None"""
+    element = _element(assembler, hint, ctx)
+    if element is None:
+        return None
+    size, alignment, element_ctx = element
+    tp = _unwrap(hint)[0] if is_dataclass(_unwrap(hint)[0]) else hint
+    try:
+        return dtype(tp, assembler.ptr_size, element_ctx.get("__length")), size
+    except TypeError:
+        return None
+
+
+def decompile_array(assembler, data: BinaryObjectReader, hint, ctx: dict):
+    """Decode a list of records with one frombuffer call, or return None if the elements are not records"""
+    _require()
+    record_type = _record_type(assembler, hint, ctx)
+    if record_type is None:
+        return None
+    dt, size = record_type
+    data.read_padding(assembler._alignment(hint))
+    start = data.offset
+    count = ctx["__length"]
+    if isinstance(count, _NullTerminated):
+        count = _count(data.target.data, start, size, dt.itemsize)
+        end = start + count * dt.itemsize + size  # the terminator is read too
+    else:
+        end = start + max(count * dt.itemsize - dt.itemsize + size, 0)
+    if end > len(data.target.data):
+        raise IOError("end of stream")
+    if start + count * dt.itemsize > len(data.target.data):
+        return None  # padding of the last element is missing
+    array = numpy.frombuffer(data.target.data, dt, count, start).copy()
+    data.offset = end
+    return array
+
+
+def compile_array(assembler, array, hint, ctx: dict) -> BinaryObject:
+    """Compile a structured array of records"""
+    record_type = _record_type(assembler, hint, ctx)
+    if record_type is None:
+        raise TypeError("not a record type: %r" % (hint,))
+    dt, size = record_type
+    if array.dtype != dt:
+        raise TypeError("array has dtype %s, expected %s" % (array.dtype, dt))
+    # padding of copied structured arrays is not initialized
+    padded = numpy.zeros(len(array), dt)
+    padded[...] = array
+    out = BinaryObject(padded.tobytes(), alignment=assembler._alignment(hint))
+    if len(array):
+        # elements are not padded at the end, like compiled lists
+        del out.data[len(out.data) - dt.itemsize + size:]
+    return out
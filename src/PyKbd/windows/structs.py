@@ -0,0 +1,226 @@
+# This file is part of PyKbd
+#
+# Copyright (C) 2019-2020  Nulano
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Size, alignment and field offsets of fixed-size structs.
+
+A struct is fixed-size if all of its fields are integers, fixed-length strings or bytes,
+tuples of those, or pointers. Layouts match what the Assembler compiles:
+fields are aligned to their own alignment, tuples to the sum of the alignment of their elements,
+and structs are not padded at the end.
+"""
+
+import struct
+import typing
+from dataclasses import dataclass, field, is_dataclass
+from functools import lru_cache
+from typing import Any, Dict, Optional, Tuple
+
+from . import _version
+from .types import _LengthFixed, _StrEncoding, _WinInt, _WinIntPtr, _WinPtr
+
+
+__version__ = _version
+
+
+_INT_FORMATS = {
+    (1, False): "B", (2, False): "H", (4, False): "I", (8, False): "Q",
+    (1, True): "b", (2, True): "h", (4, True): "i", (8, True): "q",
+}
+
+
+@dataclass(frozen=True)
+class FieldLayout:
+    name: str
+    offset: int
+    size: int
+    alignment: int
+    format: str
+    """struct module format of the field, pointers are read and written as integers"""
+    encoding: Optional[_StrEncoding] = None
+    length: int = 0
+    """number of characters or bytes of fixed-length strings and bytes"""
+    pointer: Optional[Any] = None
+    """pointed-to type, if this field is a pointer"""
+    elements: Tuple["FieldLayout", ...] = ()
+    """elements of tuple fields"""
+
+    _struct: struct.Struct = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "_struct", struct.Struct("<" + self.format))
+
+    def _moved(self, offset: int) -> "FieldLayout":
+        return FieldLayout(self.name, offset, self.size, self.alignment, self.format,
+                           self.encoding, self.length, self.pointer,
+                           tuple(element._moved(element.offset + offset - self.offset) for element in self.elements))
+
+    def _decode(self, value):
+        if self.encoding is not None:
+            s = value.decode(self.encoding.encoding, errors="strict")
+            if len(value) != len(s) * self.encoding.sizeof:
+                raise UnicodeError("read incorrect")
+            return s
+        return value
+
+    def _encode(self, value):
+        if self.format.endswith("s"):
+            if len(value) != self.length:
+                raise ValueError("%s must have length %i" % (self.name, self.length))
+        if self.encoding is not None:
+            bts = value.encode(self.encoding.encoding, errors="strict")
+            if len(bts) != self.size:
+                raise UnicodeError("unsupported characters in object")
+            return bts
+        return value
+
+    def read(self, buffer, base: int = 0):
+        """Read the value of this field from a struct at offset base of buffer."""
+        values = self._struct.unpack_from(buffer, base + self.offset)
+        if self.elements:
+            return tuple(element._decode(value) for element, value in zip(self.elements, values))
+        return self._decode(values[0])
+
+    def write(self, buffer, value, base: int = 0):
+        """Write the value of this field into a struct at offset base of a writable buffer."""
+        if self.elements:
+            if len(value) != len(self.elements):
+                raise ValueError("%s must have %i elements" % (self.name, len(self.elements)))
+            values = [element._encode(v) for element, v in zip(self.elements, value)]
+        else:
+            values = [self._encode(value)]
+        self._struct.pack_into(buffer, base + self.offset, *values)
+
+
+@dataclass(frozen=True)
+class StructLayout:
+    type: Any
+    ptr_size: int
+    size: int
+    """size without trailing padding, as compiled by the Assembler"""
+    alignment: int
+    fields: Dict[str, FieldLayout]
+
+    @staticmethod
+    def of(tp, ptr_size: int) -> "StructLayout":
+        """
+        Layout of a struct for a pointer size, computed once and cached.
+
+        :raises TypeError: if tp is not a fixed-size struct
+        """
+        layout = _struct_layout(tp, ptr_size)
+        if layout is None:
+            raise TypeError("not a fixed-size struct: %r" % (tp,))
+        return layout
+
+    @staticmethod
+    def is_fixed(tp, ptr_size: int) -> bool:
+        return _struct_layout(tp, ptr_size) is not None
+
+    def offsetof(self, name: str) -> int:
+        return self.fields[name].offset
+
+    def read(self, buffer, name: str, base: int = 0):
+        """Read a single field of a struct at offset base of buffer."""
+        return self.fields[name].read(buffer, base)
+
+    def write(self, buffer, name: str, value, base: int = 0):
+        """Patch a single field of a struct at offset base of a writable buffer."""
+        self.fields[name].write(buffer, value, base)
+
+
+def _scalar(name: str, tp, ptr_size: int) -> Optional[FieldLayout]:
+    """Layout of a scalar type at offset 0, or None if it is not supported."""
+    if typing.get_origin(tp) is not typing.Annotated:
+        return None
+    tp, *annotations = typing.get_args(tp)
+    if len(annotations) == 1 and isinstance(annotations[0], (_WinInt, _WinIntPtr)) and tp is int:
+        annotation = annotations[0]
+        size = ptr_size if isinstance(annotation, _WinIntPtr) else annotation.sizeof
+        return FieldLayout(name, 0, size, size, _INT_FORMATS[size, annotation.signed])
+    elif len(annotations) == 1 and isinstance(annotations[0], _WinPtr):
+        size = annotations[0].sizeof or ptr_size
+        target, none = typing.get_args(tp)
+        assert none is type(None)
+        return FieldLayout(name, 0, size, size, _INT_FORMATS[size, False], pointer=target)
+    elif len(annotations) == 2 and isinstance(annotations[1], _LengthFixed) \
+            and isinstance(annotations[0], _StrEncoding) and tp is str:
+        encoding, length = annotations[0], annotations[1].length
+        return FieldLayout(name, 0, length * encoding.sizeof, encoding.sizeof, "%is" % (length * encoding.sizeof),
+                           encoding=encoding, length=length)
+    elif len(annotations) == 1 and isinstance(annotations[0], _LengthFixed) and tp is bytes:
+        length = annotations[0].length
+        return FieldLayout(name, 0, length, 1, "%is" % length, length=length)
+    return None
+
+
+def _is_power_of_two(value: int) -> bool:
+    return value > 0 and value & (value - 1) == 0
+
+
+@lru_cache(maxsize=None)
+def _type_hints(tp) -> Dict[str, Any]:
+    """Type hints of a struct including annotations, computed once per type; do not modify"""
+    return typing.get_type_hints(tp, include_extras=True)
+
+
+@lru_cache(maxsize=None)
+def _prefix_layout(tp, ptr_size: int) -> Tuple[Optional[StructLayout], bool]:
+    """Layout of the leading fixed-size fields of a struct, and whether these are all of its fields"""
+    if not is_dataclass(tp) or not isinstance(tp, type):
+        return None, False
+    fields = {}
+    offset = 0
+    complete = False
+    for name, hint in _type_hints(tp).items():
+        if typing.get_origin(hint) is tuple:
+            elements = [_scalar("%s[%i]" % (name, i), element, ptr_size)
+                        for i, element in enumerate(typing.get_args(hint))]
+            if not elements or None in elements or any(element.pointer for element in elements):
+                break
+            alignment = sum(element.alignment for element in elements)
+            offset += (-offset) % alignment
+            start = offset
+            fmt = ""
+            placed = []
+            for element in elements:
+                padding = (-offset) % element.alignment
+                fmt += "%ix" % padding if padding else ""
+                fmt += element.format
+                placed.append(element._moved(offset + padding))
+                offset += padding + element.size
+            layout = FieldLayout(name, start, offset - start, alignment, fmt, elements=tuple(placed))
+        else:
+            layout = _scalar(name, hint, ptr_size)
+            if layout is None:
+                break
+            offset += (-offset) % layout.alignment
+            layout = layout._moved(offset)
+            offset += layout.size
+        if not _is_power_of_two(layout.alignment):
+            return None, False
+        fields[name] = layout
+    else:
+        complete = True
+    if not fields:
+        return None, False
+    alignment = max(layout.alignment for layout in fields.values())
+    return StructLayout(tp, ptr_size, offset, alignment, fields), complete
+
+
+def _struct_layout(tp, ptr_size: int) -> Optional[StructLayout]:
+    layout, complete = _prefix_layout(tp, ptr_size)
+    return layout if complete else None
@@ -0,0 +1,273 @@
+# This file is part of PyKbd
+#
+# Copyright (C) 2019-2020  Nulano
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Lazy views of decompiled structs.
+
+A view reads fields directly from the underlying buffer when they are accessed,
+and follows pointers only when a pointer field is accessed.
+Fixed-size structs, the leading fixed-size fields of other structs and arrays of those are read lazily,
+anything else is decoded by the Assembler when it is reached.
+
+Views keep a reference to the buffer they read from, e.g. a mapped file must stay open while they are used.
+Call ``materialize()`` to decode a view into the same objects ``Assembler.decompile`` returns.
+"""
+
+import typing
+from collections.abc import Sequence
+from dataclasses import is_dataclass
+from typing import Any, Optional, Tuple
+
+from . import _version
+from .structs import StructLayout, _prefix_layout, _scalar, _type_hints
+from .types import _Length, _LengthFixed, _LengthReferenced, _NullTerminated
+from ..linker_binary import BinaryObject
+
+
+__version__ = _version
+
+
+def _aligned(offset: int, alignment: int) -> int:
+    return offset + (-offset) % alignment
+
+
+def _unwrap(hint) -> Tuple[Any, tuple]:
+    if typing.get_origin(hint) is typing.Annotated:
+        tp, *annotations = typing.get_args(hint)
+        return tp, tuple(annotations)
+    return hint, ()
+
+
+def _length(annotations: tuple, ctx: dict):
+    """Length given by the last annotation, _NullTerminated, or None if it cannot be read lazily"""
+    if len(annotations) != 1:
+        return None
+    annotation, = annotations
+    if isinstance(annotation, _LengthReferenced):
+        if annotation.reference not in ctx:
+            return None
+        length = ctx[annotation.reference] * annotation.mul + annotation.add
+        assert isinstance(length, int) or length.is_integer()
+        return int(length)
+    elif isinstance(annotation, _LengthFixed):
+        return annotation.length
+    elif isinstance(annotation, _NullTerminated):
+        return annotation
+    return None
+
+
+def _element(assembler, hint, ctx: dict) -> Optional[Tuple[int, int, dict]]:
+    """Size, alignment and context of array elements, or None if elements are not all the same size"""
+    tp, annotations = _unwrap(hint)
+    if is_dataclass(tp):
+        layout, complete = _prefix_layout(tp, assembler.ptr_size)
+        if layout is None:
+            return None
+        if complete:
+            return layout.size, layout.alignment, ctx
+        # structs ending with an array whose length is given by the array, e.g. VK_TO_WCHARS
+        hints = _type_hints(tp)
+        *_, (name, last) = hints.items()
+        if len(layout.fields) != len(hints) - 1:
+            return None
+        length = _length(annotations, ctx)
+        item, item_annotations = _unwrap(last)
+        if not isinstance(length, int) or typing.get_origin(item) is not list \
+                or [type(annotation) for annotation in item_annotations] != [_Length]:
+            return None
+        scalar = _scalar(name, typing.get_args(item)[0], assembler.ptr_size)
+        if scalar is None or scalar.pointer is not None:
+            return None
+        size = _aligned(layout.size, scalar.alignment) + length * scalar.size
+        return size, assembler._alignment(hint), dict(ctx, __length=length)
+    scalar = _scalar("", hint, assembler.ptr_size)
+    if scalar is None or scalar.pointer is not None:
+        return None
+    return scalar.size, scalar.alignment, ctx
+
+
+def _count(data, offset: int, size: int, stride: int) -> int:
+    """Number of elements of a null-terminated array, not counting the terminator"""
+    end = b"\0" * size
+    count = 0
+    while True:
+        position = offset + count * stride
+        if position + size > len(data):
+            raise IOError("end of stream")
+        if data[position:position + size] == end:
+            return count
+        count += 1
+
+
+def view_at(assembler, target: BinaryObject, offset: int, hint, ctx: dict):
+    """
+    View of a value of type hint at offset of target.
+
+    Values that cannot be viewed are decoded immediately.
+
+    :param ctx: decompile context, must contain ``__base`` and ``__conv``
+    """
+    tp, annotations = _unwrap(hint)
+    if is_dataclass(tp):
+        layout, complete = _prefix_layout(tp, assembler.ptr_size)
+        length = _length(annotations, ctx) if annotations else None
+        if layout is not None and (not annotations or isinstance(length, int)):
+            if length is not None:
+                ctx = dict(ctx, __length=length)
+            return StructView(assembler, hint, target, _aligned(offset, assembler._alignment(tp)), ctx)
+    elif typing.get_origin(tp) is list:
+        length = _length(annotations, ctx)
+        element = _element(assembler, typing.get_args(tp)[0], ctx)
+        if length is not None and element is not None:
+            size, alignment, element_ctx = element
+            offset = _aligned(offset, alignment)
+            stride = _aligned(size, alignment)
+            if isinstance(length, _NullTerminated):
+                length = _count(target.data, offset, size, stride)
+            return ArrayView(assembler, hint, target, offset, stride, length, ctx, element_ctx)
+    return assembler._decompile_detached(target, offset, hint, ctx)
+
+
+class StructView:
+    """
+    Lazy view of a struct.
+
+    Fields are read from the buffer on access, pointer fields return views of the pointed-to values.
+    Fields following a variable-length field are read by decoding the whole struct.
+    """
+
+    __slots__ = ("_assembler", "_hint", "_type", "_layout", "_target", "_offset", "_ctx", "_values", "_materialized")
+
+    def __init__(self, assembler, hint, target: BinaryObject, offset: int, ctx: dict):
+        self._assembler = assembler
+        self._hint = hint
+        self._type = _unwrap(hint)[0]
+        self._layout, _ = _prefix_layout(self._type, assembler.ptr_size)
+        if offset + self._layout.size > len(target.data):
+            raise IOError("end of stream")
+        self._target = target
+        self._offset = offset
+        self._ctx = ctx
+        self._values = {}
+        self._materialized = None
+
+    @property
+    def type(self):
+        return self._type
+
+    @property
+    def layout(self) -> StructLayout:
+        """Layout of the fields read lazily"""
+        return self._layout
+
+    def __getattr__(self, name):
+        if name.startswith("_") or name not in _type_hints(self._type):
+            raise AttributeError(name)
+        if name in self._values:
+            return self._values[name]
+        field = self._layout.fields.get(name)
+        if field is None:
+            return getattr(self.materialize(), name)
+        value = field.read(self._target.data, self._offset)
+        if field.pointer is not None:
+            value = self._follow(field.pointer, value, name)
+        self._values[name] = value
+        return value
+
+    def _follow(self, tp, addr: int, name: str):
+        if addr == 0:
+            return None
+        ctx = {key: value for key, value in self._ctx.items() if key.startswith("__")}
+        for field in self._layout.fields.values():
+            if field.pointer is None:
+                ctx[field.name] = field.read(self._target.data, self._offset)
+        if any(key not in ctx for key in _referenced(tp)):
+            return getattr(self.materialize(), name)
+        addr = ctx["__conv"](addr - ctx["__base"])
+        return view_at(self._assembler, self._target, addr, tp, ctx)
+
+    def materialize(self):
+        """Decode this struct and everything it points to."""
+        if self._materialized is None:
+            self._materialized = self._assembler._decompile_detached(self._target, self._offset, self._hint, self._ctx)
+        return self._materialized
+
+    def __dir__(self):
+        return list(_type_hints(self._type)) + ["layout", "materialize", "type"]
+
+    def __repr__(self):
+        return "<%s view at 0x%X>" % (self._type.__name__, self._offset)
+
+
+class ArrayView(Sequence):
+    """Lazy view of an array of elements of the same size."""
+
+    def __init__(self, assembler, hint, target: BinaryObject, offset: int, stride: int, length: int,
+                 ctx: dict, element_ctx: dict):
+        self._assembler = assembler
+        self._hint = hint
+        self._element = typing.get_args(_unwrap(hint)[0])[0]
+        self._target = target
+        self._offset = offset
+        self._stride = stride
+        self._length = length
+        self._ctx = ctx
+        self._element_ctx = element_ctx
+        self._items = {}
+        self._materialized = None
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._length))]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError(index)
+        if index not in self._items:
+            offset = self._offset + index * self._stride
+            if is_dataclass(_unwrap(self._element)[0]):
+                self._items[index] = StructView(self._assembler, self._element, self._target, offset, self._element_ctx)
+            else:
+                self._items[index] = _scalar("", self._element, self._assembler.ptr_size).read(self._target.data, offset)
+        return self._items[index]
+
+    def to_numpy(self):
+        """Structured array of the elements, sharing memory with the buffer. Requires NumPy, see records module."""
+        from . import records
+        tp = _unwrap(self._element)[0]
+        return records.read(self._target.data, tp if is_dataclass(tp) else self._element, self._length, self._offset,
+                            self._assembler.ptr_size, self._element_ctx.get("__length"))
+
+    def materialize(self) -> list:
+        """Decode all elements and everything they point to."""
+        if self._materialized is None:
+            self._materialized = self._assembler._decompile_detached(self._target, self._offset, self._hint, self._ctx)
+        return self._materialized
+
+    def __repr__(self):
+        return "<array view of %i elements at 0x%X>" % (self._length, self._offset)
+
+
+def _referenced(hint) -> Tuple[str, ...]:
+    """Names of fields a pointed-to type references directly"""
+    tp, annotations = _unwrap(hint)
+    names = tuple(annotation.reference for annotation in annotations if isinstance(annotation, _LengthReferenced))
+    if typing.get_origin(tp) is list:
+        names += _referenced(typing.get_args(tp)[0])
+    return names
@@ -44,6 +44,13 @@ class Architecture:
     def __str__(self):
         return self.name
 
+    def __reduce__(self):
+        # architectures are compared by identity, unpickle the predefined ones to the same objects
+        for name in ("X86", "WOW64", "AMD64"):
+            if globals().get(name) is self:
+                return name
+        return Architecture, (self.pointer, self.long_pointer, self.base, self.suffix, self.name)
+
 
 X86 = Architecture(4, 4, 0x00005FFF0000, '32', 'Windows-x86')
 WOW64 = Architecture(4, 8, 0x00005FFE0000, 'WW', 'Windows-WoW64')
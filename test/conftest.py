@@ -0,0 +1,44 @@
+# This file is part of PyKbd
+#
+# Copyright (C) 2019-2020  Nulano
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+
+from PyKbd.compile_windll import WinDll
+from PyKbd.layout import *
+from PyKbd.wintypes import *
+
+
+@pytest.fixture(scope='module')
+def layout():
+    return Layout("Dummy Test Layout", "PyKbd Test Layout", "PyKbd Test File", (1, 0), "kbdtst.dll",
+                  {
+                      ScanCode(0x10): KeyCode(ord('Q')),
+                      ScanCode(0x11): KeyCode(ord('W')),
+                      ScanCode(0x3B): KeyCode(0x70, 'F1'),
+                      ScanCode(0x47, 0xE0): KeyCode(0x124, 'Home'),
+                      ScanCode(0x1D, 0xE1): KeyCode(0x13, 'Pause'),
+                  }, {
+                      ord('Q'): {ShiftState(): Character('q'), ShiftState(shift=True): Character('Q')},
+                      ord('W'): {ShiftState(): Character('w', dead=True)},
+                  }, {
+                      'w': DeadKey("Test W", {'w': Character('w', dead=True), 'q': Character('q')}),
+                  })
+
+
+@pytest.fixture(scope='module', params=[X86, WOW64, AMD64], ids=["x86", "WoW64", "amd64"])
+def windll(request, layout: Layout):
+    return WinDll(layout, request.param)
@@ -0,0 +1,73 @@
+# This file is part of PyKbd
+#
+# Copyright (C) 2019-2020  Nulano
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+import pickle
+import threading
+import time
+
+import pytest
+
+from PyKbd import aio
+from PyKbd.compile_windll import WinDll
+from PyKbd.layout import *
+from PyKbd.wintypes import *
+
+
+def _recompile(windll: WinDll, data: bytes) -> bytes:
+    """Compile windll with the timestamp of data"""
+    decompiled = WinDll()
+    decompiled.decompile(data)
+    compiler = WinDll(windll.layout, windll.architecture)
+    compiler.timestamp = decompiled.timestamp
+    return compiler.compile()
+
+
+def test_pickle_architecture():
+    # process executors pickle the architecture, which is compared by identity
+    for arch in (X86, WOW64, AMD64):
+        assert pickle.loads(pickle.dumps(arch)) is arch
+
+
+def test_aio(windll: WinDll):
+    data = windll.compile()
+    windll2 = WinDll()
+    windll2.decompile(data)
+
+    async def main():
+        result = await aio.compile(windll.layout, windll.architecture, timeout=10)
+        assert result == _recompile(windll, result)
+        assert await aio.decompile_layout(data) == windll2.layout
+        with ProcessPoolExecutor(2) as executor:
+            results = await aio.compile_many([(windll.layout, windll.architecture)] * 3, executor=executor, limit=2)
+        # WoW64 images differ from x86 ones only in their header
+        assert [result == _recompile(windll, result) for result in results] == [True] * 3
+        results = await aio.decompile_many([data, b"not a dll"], return_exceptions=True)
+        assert results[0][3] == windll.layout.dll_name
+        assert isinstance(results[1], Exception)
+        with pytest.raises(asyncio.TimeoutError):
+            await aio.run(time.sleep, 0.2, timeout=0.01)
+
+    asyncio.run(main())
+
+
+def test_aio_cancel(layout: Layout):
+    cancelled = threading.Event()
+    cancelled.set()
+    with pytest.raises(CancelledError):
+        aio._compile(layout, X86, {}, cancelled)
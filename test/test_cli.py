@@ -0,0 +1,80 @@
+# This file is part of PyKbd
+#
+# Copyright (C) 2019-2020  Nulano
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+from operator import itemgetter
+
+import pytest
+
+from PyKbd import cli
+from PyKbd.compile_windll import WinDll
+from PyKbd.layout import *
+
+
+def _recompile(windll: WinDll, data: bytes) -> bytes:
+    """Compile windll from its JSON layout with the timestamp of data"""
+    decompiled = WinDll()
+    decompiled.decompile(data)
+    compiler = WinDll(Layout.from_json(windll.layout.to_json()), windll.architecture)
+    compiler.timestamp = decompiled.timestamp
+    return compiler.compile()
+
+
+def test_cli(windll: WinDll, tmp_path, capsys):
+    arch = next(name for name, arch in cli.ARCHITECTURES.items() if arch == windll.architecture)
+    for name in ("a", "b"):
+        (tmp_path / (name + ".json")).write_text(windll.layout.to_json(), encoding="utf-8")
+
+    assert cli.main(["compile", "-a", arch, "-j", "2", "--json", "-o", str(tmp_path / "out"),
+                     str(tmp_path / "*.json")]) == 0
+    results = sorted((json.loads(line) for line in capsys.readouterr().out.splitlines()), key=itemgetter("input"))
+    assert [result["architecture"] for result in results] == [windll.architecture.name] * 2
+    for name, result in zip("ab", results):
+        assert result["output"] == str(tmp_path / "out" / (name + windll.architecture.suffix + ".dll"))
+        with open(result["output"], "rb") as f:
+            data = f.read()
+        assert result["size"] == len(data)
+        assert data == _recompile(windll, data)
+
+    # the glob also matches the JSON layouts written by the first decompile, which must be skipped
+    for _ in range(2):
+        assert cli.main(["decompile", str(tmp_path / "out" / "*")]) == 0
+        assert len(capsys.readouterr().out.splitlines()) == 2
+    windll2 = WinDll()
+    windll2.decompile(data)
+    layout = Layout.from_json((tmp_path / "out" / ("a" + windll.architecture.suffix + ".json")).read_text("utf-8"))
+    assert layout == windll2.layout
+
+    json_path = tmp_path / "a.json"
+    assert cli.main(["decompile", str(json_path)]) == 1
+    assert "a.json: error: " in capsys.readouterr().out
+    assert Layout.from_json(json_path.read_text("utf-8")) == windll.layout
+
+    assert cli.main(["bench", "-a", arch, "-n", "1", str(tmp_path / "a.json"), str(tmp_path / "missing.json")]) == 1
+    out = capsys.readouterr().out.splitlines()
+    assert len(out) == 2
+    assert "missing.json: error: " in out[1]
+
+
+@pytest.mark.parametrize("args", [
+    ["bench", "-n", "0", "a.json"], ["compile", "-j", "0", "a.json"], ["decompile", "-j", "-1", "a.json"],
+    ["serve", "--workers", "0"], ["serve", "--backlog", "-1"],
+])
+def test_cli_positive(args, capsys):
+    with pytest.raises(SystemExit):
+        cli.main(args)
+    assert "must be at least 1" in capsys.readouterr().err
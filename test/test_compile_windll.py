@@ -15,7 +15,12 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import replace
+from io import BytesIO
+import json
 from operator import itemgetter
+import warnings
 from warnings import warn
 
 import pytest
@@ -25,7 +30,8 @@ from PyKbd import _version_num
 from PyKbd.layout import *
 from PyKbd.wintypes import *
 from PyKbd.linker_binary import BinaryObject
-from PyKbd.compile_windll import WinDll
+from PyKbd.compile_windll import WinDll, compile_all, compile_layout, decompile_bytes
+from PyKbd.windows.dll import Assembler, Decompiler, HeaderDOS
 
 from .parse_helper import match_object
 
@@ -38,28 +44,6 @@ def len_round(base):
     return lambda x: round_up(len(x), base)
 
 
-@pytest.fixture(scope='module')
-def layout():
-    return Layout("Dummy Test Layout", "PyKbd Test Layout", "PyKbd Test File", (1, 0), "kbdtst.dll",
-                  {
-                      ScanCode(0x10): KeyCode(ord('Q')),
-                      ScanCode(0x11): KeyCode(ord('W')),
-                      ScanCode(0x3B): KeyCode(0x70, 'F1'),
-                      ScanCode(0x47, 0xE0): KeyCode(0x124, 'Home'),
-                      ScanCode(0x1D, 0xE1): KeyCode(0x13, 'Pause'),
-                  }, {
-                      ord('Q'): {ShiftState(): Character('q'), ShiftState(shift=True): Character('Q')},
-                      ord('W'): {ShiftState(): Character('w', dead=True)},
-                  }, {
-                      'w': DeadKey("Test W", {'w': Character('w', dead=True), 'q': Character('q')}),
-                  })
-
-
-@pytest.fixture(scope='module', params=[X86, WOW64, AMD64], ids=["x86", "WoW64", "amd64"])
-def windll(request, layout: Layout):
-    return WinDll(layout, request.param)
-
-
 def test_compile_kbd_keymap(windll: WinDll):
     windll.compile_kbd_keymap()
 
@@ -327,6 +311,20 @@ def test_compile(windll: WinDll):
     assert windll.compile() == bytes(windll.assembly.data)
 
 
+def test_compile_to(windll: WinDll):
+    windll2 = WinDll(windll.layout, windll.architecture)
+    windll2.timestamp = windll.timestamp
+    out = BytesIO()
+    assert windll2.compile_to(out) == len(windll.assembly.data)
+    assert out.getvalue() == windll.assembly.data
+
+    windll2 = WinDll(windll.layout, windll.architecture)
+    windll2.timestamp = windll.timestamp
+    out = bytearray(len(windll.assembly.data))
+    assert windll2.compile_into(out) == len(windll.assembly.data)
+    assert out == windll.assembly.data
+
+
 def test_decompile(windll: WinDll):
     version_str = '.'.join(map(str, windll.layout.version))
 
@@ -338,6 +336,156 @@ def test_decompile(windll: WinDll):
     assert windll2.layout == windll.layout
 
 
+@pytest.mark.parametrize("optimize_size", [False, True], ids=["paged", "unpaged"])
+@pytest.mark.parametrize("merge_sections", [False, True], ids=["separate", "merged"])
+def test_compile_optimize_size(windll: WinDll, optimize_size, merge_sections):
+    windll2 = WinDll(windll.layout, windll.architecture, optimize_size=optimize_size, merge_sections=merge_sections)
+    windll2.timestamp = windll.timestamp
+    data = windll2.compile()
+    size_before, size_after = windll2.size_report()
+    assert size_before == len(windll.compile())
+    assert size_after == len(data)
+    # only merging sections saves file alignment padding
+    assert (size_after < size_before) == merge_sections
+    assert (windll2.align_section == windll2.align_file) == optimize_size
+
+    def size_of_image(image: bytes) -> int:
+        return Assembler(windll.architecture.pointer).decompile(image, HeaderDOS).pe.opt.SizeOfImage
+    assert size_of_image(data) <= size_of_image(windll.compile())
+    assert (size_of_image(data) < windll.align_section) == optimize_size
+
+    windll3 = WinDll()
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        windll3.decompile(data)
+    assert any("section alignment" in str(warning.message) for warning in caught) == optimize_size
+    assert len(windll3.sections) == (2 if merge_sections else 3)
+    # only .data with the code of KbdLayerDescriptor is executable
+    header = Assembler(windll.architecture.pointer).decompile(data, HeaderDOS)
+    assert [section.Characteristics & 0x20000000 != 0 for section in header.pe.sections] == \
+        [True] + [False] * (len(header.pe.sections) - 1)
+    if optimize_size:
+        for rva, offset in windll3.sections:
+            assert rva == offset
+    windll3.layout.name = windll3.layout.name[:-len(" 1.0")]
+    assert windll3.layout == windll.layout
+
+    windll4 = WinDll(windll3.layout, windll3.architecture, optimize_size=optimize_size, merge_sections=merge_sections)
+    windll4.timestamp = windll3.timestamp
+    assert windll4.compile() == data
+
+
+def test_compile_align_section(windll: WinDll):
+    class PagedWinDll(WinDll):
+        align_section = 0x2000
+
+    with pytest.raises(ValueError, match="optimize_size requires align_section"):
+        PagedWinDll(windll.layout, windll.architecture, optimize_size=True)
+    assert PagedWinDll(windll.layout, windll.architecture).align_section == 0x2000
+
+
+def test_compile_shared(windll: WinDll):
+    shared = {}
+    for arch in (X86, WOW64, AMD64):
+        windll2 = WinDll(windll.layout, arch, shared=shared)
+        windll2.timestamp = windll.timestamp
+        if arch == windll.architecture:
+            assert windll2.compile() == windll.compile()
+        else:
+            windll2.compile()
+    assert sorted(key[0] for key in shared) == ["_charmap_tables", "_keymap_tables", "_version_info"]
+
+    # other layouts and options do not reuse the cached tables
+    layout = replace(windll.layout, name="Other", charmap={}, deadkeys={})
+    for options in ({}, {"optimize_size": True}, {"merge_sections": True}):
+        for compiled_layout in (layout, windll.layout):
+            expected = WinDll(compiled_layout, windll.architecture, **options)
+            expected.timestamp = windll.timestamp
+            windll2 = WinDll(compiled_layout, windll.architecture, shared=shared, **options)
+            windll2.timestamp = windll.timestamp
+            assert windll2.compile() == expected.compile()
+
+    compiled = compile_all(windll.layout, [windll.architecture])
+    assert list(compiled) == [windll.architecture]
+    windll2 = WinDll()
+    windll2.decompile(compiled[windll.architecture])
+    windll3 = WinDll(windll.layout, windll.architecture)
+    windll3.timestamp = windll2.timestamp
+    assert compiled[windll.architecture] == windll3.compile()
+
+
+def test_compile_layout(windll: WinDll):
+    def recompile(data: bytes, **options) -> bytes:
+        # compile_layout() stamps the current time, compile again with the timestamp it used
+        windll2 = WinDll(windll.layout, windll.architecture, **options)
+        windll2.timestamp = Decompiler(data).decompile()[2]
+        return windll2.compile()
+
+    windll2 = WinDll()
+    windll2.decompile(windll.compile())
+    with ProcessPoolExecutor(2) as executor:
+        data, = executor.map(compile_layout, [windll.layout], [windll.architecture])
+        layout, = executor.map(decompile_bytes, [data])
+    assert data == recompile(data)
+    assert layout == windll2.layout
+
+    options = {"optimize_size": True, "merge_sections": True}
+    data = compile_layout(windll.layout, windll.architecture, options)
+    assert data == recompile(data, **options)
+
+
+def test_compile_map(windll: WinDll):
+    windll2 = WinDll(windll.layout, windll.architecture, emit_map=True)
+    windll2.timestamp = windll.timestamp
+    assert windll2.compile() == windll.compile()
+
+    linker_map = windll2.linker_map
+    assert [section.name for section in linker_map.sections] == ["headers", ".data", ".rsrc", ".reloc"]
+    # addresses are RVAs
+    assert [section.address for section in linker_map.sections] == [0, 0x1000, 0x2000, 0x3000]
+    for section, (name, first, last, characteristics) in zip(linker_map.sections[1:], windll2._sections()):
+        assert section.size <= len(first.data)
+    totals = linker_map.totals()
+    for name in ("HEADERS", "EXPORT", "KbdLayerDescriptor", "KBDTABLES", "MODIFIERS", "VK_TO_BIT",
+                 "VK_TO_WCHAR_TABLE", "VK_TO_WCHARS", "DEADKEY", "KEY_NAMES", "KEY_NAMES_EXT",
+                 "KEY_NAMES_DEAD", "VSC_TO_VK", "VSC_TO_VK_E0", "VSC_TO_VK_E1", "RESOURCES", "RELOCS"):
+        assert totals[name] > 0
+    assert None not in totals
+    assert totals["KBDTABLES"] == len(windll2.kbdtables.data)
+    assert totals["RELOCS"] == len(windll2.dir_reloc.data)
+    # key name strings are listed after the table referencing them
+    assert totals["KEY_NAMES"] == len(windll2.kbd_key_names.data)
+    assert totals["KEY_NAMES[]"] > 0 and totals["KEY_NAMES_DEAD[]"] > 0
+
+    # compilers sharing tables list them the same way
+    shared = {}
+    maps = []
+    for _ in range(2):
+        windll3 = WinDll(windll.layout, windll.architecture, emit_map=True, shared=shared)
+        windll3.compile()
+        maps.append(windll3.linker_map)
+    assert maps[0] == maps[1] == linker_map
+
+    data = json.loads(linker_map.to_json())
+    assert [section["size"] for section in data["sections"]] == [section.size for section in linker_map.sections]
+    assert "KBDTABLES" in linker_map.to_text()
+
+
+def test_decompile_file(windll: WinDll, tmp_path):
+    path = tmp_path / windll.layout.dll_name
+    path.write_bytes(windll.assembly.data)
+
+    windll2 = WinDll()
+    windll2.decompile(windll.assembly.data)
+
+    windll3 = WinDll()
+    windll3.decompile_file(path)
+
+    assert windll3.layout == windll2.layout
+    assert windll3.architecture == windll2.architecture
+    assert windll3.assembly is None
+
+
 @pytest.mark.parametrize("name", [
     "KBDUS_WIN10_AMD64",
     "KBDSL1_WINXP_X86",
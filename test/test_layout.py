@@ -0,0 +1,277 @@
+# This file is part of PyKbd
+#
+# Copyright (C) 2019-2020  Nulano
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from dataclasses import FrozenInstanceError, replace
+import pickle
+
+import pytest
+
+from PyKbd.compile_windll import WinDll
+from PyKbd.layout import *
+from PyKbd.windows import dll
+from PyKbd.windows.compiler import compile_kbd_tables, compile_resources
+from PyKbd.wintypes import *
+
+
+def _compile(layout: Layout, architecture: Architecture) -> bytes:
+    windll = WinDll(layout, architecture)
+    windll.timestamp = 1
+    return windll.compile()
+
+
+@pytest.mark.parametrize("arch", [X86, WOW64, AMD64], ids=["x86", "WoW64", "amd64"])
+def test_pickle_layout(layout: Layout, arch: Architecture):
+    layout2 = replace(layout, keymap={
+        **layout.keymap,
+        ScanCode(0x1E): KeyCode(ord('A'), attributes=KeyAttributes(capslock=True, kanalock=True)),
+    }, charmap={
+        **layout.charmap,
+        ord('A'): {ShiftState(capslock=True): Character('\U0001F600'),
+                   ShiftState(control=True, alt=True): Character('ae')},
+    })
+    for layout3 in (layout, layout2):
+        data = pickle.dumps(layout3, pickle.HIGHEST_PROTOCOL)
+        assert b"ShiftState" not in data and b"Character" not in data
+        layout4 = pickle.loads(data)
+        assert layout4 == layout3
+        assert list(layout4.keymap) == list(layout3.keymap)
+        assert [list(characters) for characters in layout4.charmap.values()] == \
+            [list(characters) for characters in layout3.charmap.values()]
+    # layout2 has characters that do not fit into a DLL
+    assert _compile(pickle.loads(pickle.dumps(layout)), arch) == _compile(layout, arch)
+
+
+def test_intern_layout(windll: WinDll):
+    layout = Layout.from_json(windll.layout.to_json())
+    windll2 = WinDll()
+    windll2.decompile(windll.compile())
+    for layout2 in (windll2.layout, pickle.loads(pickle.dumps(layout))):
+        for vk, characters in layout2.charmap.items():
+            for (state, character), (state2, character2) in zip(layout.charmap[vk].items(), characters.items()):
+                assert state is state2 and character is character2
+    assert layout.keymap[ScanCode(0x10)].attributes is KeyAttributes.from_bits(0) is KeyAttributes.from_string("default")
+    assert ShiftState.from_bits(1) is ShiftState.from_string("shift") is pickle.loads(pickle.dumps(ShiftState(True)))
+    assert intern(Character('q')) is layout.charmap[ord('Q')][ShiftState()]
+
+    # interned objects compile like the originals
+    assert _compile(pickle.loads(pickle.dumps(layout)), windll.architecture) == _compile(layout, windll.architecture)
+
+    assert not hasattr(ShiftState(), "__dict__")
+    with pytest.raises(AttributeError):
+        ShiftState().shift = True
+
+
+
+def test_layout_diff(layout: Layout):
+    layout2 = pickle.loads(pickle.dumps(layout))
+    assert not layout.diff(layout2) and layout.diff(layout2) == LayoutPatch()
+
+    layout2.name = "Changed"
+    del layout2.keymap[ScanCode(0x11)]
+    layout2.keymap[ScanCode(0x1E)] = KeyCode(ord('A'))
+    layout2.charmap[ord('Q')][ShiftState(shift=True, capslock=True)] = Character('q')
+    del layout2.charmap[ord('Q')][ShiftState()]
+    del layout2.charmap[ord('W')]
+    layout2.charmap[ord('A')] = {ShiftState(): Character('a')}
+    layout2.deadkeys['w'] = DeadKey("Changed W", {'a': Character('b')})
+    patch = layout.diff(layout2)
+    assert patch == LayoutPatch(
+        name="Changed",
+        keymap={ScanCode(0x11): None, ScanCode(0x1E): KeyCode(ord('A'))},
+        charmap={
+            ord('Q'): {ShiftState(): None, ShiftState(shift=True, capslock=True): Character('q')},
+            ord('W'): None,
+            ord('A'): {ShiftState(): Character('a')},
+        },
+        deadkeys={'w': DeadKey("Changed W", {'a': Character('b')})},
+    )
+
+    for patch in (patch, LayoutPatch.from_json(patch.to_json()), pickle.loads(pickle.dumps(patch))):
+        for charmap in (dict, DenseCharmap):
+            layout3 = pickle.loads(pickle.dumps(layout))
+            layout3.charmap = charmap(layout3.charmap)
+            layout3.apply(patch)
+            assert layout3 == layout2
+            # applying twice does not change anything
+            layout3.apply(patch)
+            assert layout3 == layout2
+            assert _compile(layout3, AMD64) == _compile(layout2, AMD64)
+
+
+
+def test_frozen_layout(windll: WinDll):
+    layout = windll.layout
+    frozen = layout.freeze()
+    assert frozen.thaw() == layout and frozen.to_json() == layout.to_json()
+    assert FrozenLayout.from_json(layout.to_json()) == frozen and hash(frozen) == hash(layout.freeze())
+    assert pickle.loads(pickle.dumps(frozen)) == frozen
+    # tables are compiled in the order of the persistent maps, which may differ from the original layout
+    data = _compile(frozen, windll.architecture)
+    assert data == _compile(frozen.thaw(), windll.architecture)
+    windll2 = WinDll()
+    windll2.decompile(data)
+    assert windll2.layout == replace(layout, name="%s %d.%d" % ((layout.name,) + layout.version))
+
+    frozen2 = frozen.set_character(ord('Q'), ShiftState(alt=True), Character('x')).remove_key(ScanCode(0x11))
+    frozen2 = frozen2.set_deadkey('q', DeadKey("Q", {'q': Character('Q')})).remove_characters(ord('W'))
+    assert frozen.thaw() == layout
+    assert frozen2.charmap[ord('Q')][ShiftState(alt=True)] == Character('x')
+    assert frozen2.keymap[ScanCode(0x10)] is frozen.keymap[ScanCode(0x10)]
+    assert frozen2.deadkeys['w'] is frozen.deadkeys['w']
+    with pytest.raises(FrozenInstanceError):
+        frozen2.name = "Changed"
+
+    patch = frozen.diff(frozen2)
+    assert patch == layout.diff(frozen2.thaw())
+    assert frozen.apply(patch) == frozen2
+    layout2 = frozen.thaw()
+    layout2.apply(patch)
+    assert layout2 == frozen2.thaw()
+    assert _compile(frozen2, windll.architecture) == _compile(frozen2.thaw(), windll.architecture)
+
+
+
+def test_dense_charmap(windll: WinDll):
+    layout = windll.layout
+    charmap = DenseCharmap(layout.charmap)
+    assert charmap == layout.charmap and layout.charmap == charmap
+    assert list(charmap) == list(layout.charmap)
+    assert charmap[ord('W')][ShiftState()] is intern(Character('w', dead=True))
+    assert ShiftState(shift=True) not in charmap[ord('W')]
+    assert sorted(iter_characters(charmap[ord('Q')])) == sorted(iter_characters(layout.charmap[ord('Q')])) == \
+        [(0, 'q', False), (1, 'Q', False)]
+
+    dense = replace(layout, charmap=charmap)
+    assert dense.to_json() == layout.to_json()
+    assert pickle.loads(pickle.dumps(dense)) == layout
+    windll2 = WinDll(dense, windll.architecture)
+    windll2.timestamp = windll.timestamp
+    assert windll2.compile() == windll.compile()
+
+    charmap[ord('A')] = {ShiftState(capslock=True): Character('\U0001F600'), ShiftState(alt=True): Character('ae')}
+    charmap[ord('Q')][ShiftState(shift=True)] = Character('Q', dead=True)
+    del charmap[ord('Q')][ShiftState()]
+    charmap[ord('W')] = charmap[ord('W')]
+    assert charmap == {
+        ord('Q'): {ShiftState(shift=True): Character('Q', dead=True)},
+        ord('W'): {ShiftState(): Character('w', dead=True)},
+        ord('A'): {ShiftState(alt=True): Character('ae'), ShiftState(capslock=True): Character('\U0001F600')},
+    }
+    assert list(charmap[ord('A')]) == [ShiftState(alt=True), ShiftState(capslock=True)]
+    del charmap[ord('Q')]
+    assert ord('Q') not in charmap and len(charmap) == 2
+    with pytest.raises(KeyError):
+        del charmap[ord('W')][ShiftState(shift=True)]
+
+
+def test_dense_charmap_rows():
+    charmap = DenseCharmap({ord('Q'): {ShiftState(): Character('q')}, ord('W'): {ShiftState(): Character('w')}})
+    rows = len(charmap._dead)
+    del charmap[ord('Q')]
+    # freed rows are reused
+    charmap[ord('E')] = {ShiftState(shift=True): Character('E', dead=True)}
+    charmap[ord('R')] = {ShiftState(alt=True): Character('\U0001F600')}
+    assert len(charmap._dead) == rows + 1
+    assert charmap == {
+        ord('W'): {ShiftState(): Character('w')},
+        ord('E'): {ShiftState(shift=True): Character('E', dead=True)},
+        ord('R'): {ShiftState(alt=True): Character('\U0001F600')},
+    }
+    del charmap[ord('R')]
+    del charmap[ord('E')]
+    charmap[ord('T')] = {ShiftState(): Character('t')}
+    assert len(charmap._dead) == rows + 1
+    assert charmap == {ord('W'): {ShiftState(): Character('w')}, ord('T'): {ShiftState(): Character('t')}}
+    assert not charmap._long
+
+
+def test_dense_charmap_pickle(layout: Layout):
+    dense = replace(layout, charmap=DenseCharmap(layout.charmap))
+    layout2 = pickle.loads(pickle.dumps(dense))
+    assert isinstance(layout2.charmap, DenseCharmap)
+    assert layout2 == layout
+    assert type(pickle.loads(pickle.dumps(layout)).charmap) is dict
+
+    function, args = layout.__reduce__()
+    with pytest.raises(ValueError, match="unsupported pickled layout version: 2"):
+        function(args[0], 2, *args[2:])
+
+
+@pytest.mark.parametrize("arch", [X86, WOW64, AMD64], ids=["x86", "WoW64", "amd64"])
+def test_dense_charmap_order(layout: Layout, arch: Architecture):
+    # shift states are numbered by their bits, whatever order the characters of a key are stored in
+    states = [ShiftState(control=True, alt=True), ShiftState(shift=True), ShiftState(), ShiftState(control=True)]
+    unordered = {vk: {} for vk in layout.charmap}
+    for state in states:
+        for vk, characters in layout.charmap.items():
+            if state in characters:
+                unordered[vk][state] = characters[state]
+    unordered[ord('W')][ShiftState(control=True, alt=True)] = Character('ŵ')
+    unordered[ord('Q')][ShiftState(control=True)] = Character('\u0011')
+    assert list(unordered[ord('Q')]) != sorted(unordered[ord('Q')], key=ShiftState.to_bits)
+    ordered = {vk: dict(sorted(characters.items(), key=lambda item: item[0].to_bits()))
+               for vk, characters in unordered.items()}
+
+    images = []
+    for charmap in (unordered, ordered, DenseCharmap(unordered)):
+        windll = WinDll(replace(layout, charmap=charmap), arch)
+        windll.timestamp = 1
+        images.append(windll.compile())
+    assert images[0] == images[1] == images[2]
+
+    dll_arch = {X86: dll.X86, WOW64: dll.WOW64, AMD64: dll.AMD64}[arch]
+    images = [dll.Compiler(dll_arch, compile_kbd_tables(replace(layout, charmap=charmap)),
+                           compile_resources(layout), 1, layout.dll_name).compile()
+              for charmap in (unordered, ordered, DenseCharmap(unordered))]
+    assert images[0] == images[1] == images[2]
+
+
+@pytest.mark.parametrize("arch", [X86, WOW64, AMD64], ids=["x86", "WoW64", "amd64"])
+def test_charmap_column_order(layout: Layout, arch: Architecture):
+    # the first row, its shift states are not in bit order
+    row = {ShiftState(shift=True, control=True, alt=True): Character('X'), ShiftState(): Character('x'),
+           ShiftState(shift=True): Character('X')}
+    layout = replace(layout, keymap={ScanCode(0x2D): KeyCode(ord('X')), **layout.keymap},
+                     charmap={ord('X'): row, **layout.charmap})
+    dense = replace(layout, charmap=DenseCharmap(layout.charmap))
+    # columns are numbered in order of the shift state bits, 0 (none), 1 (shift), 7 (shift+ctrl+alt)
+    columns = {0: 0, 1: 1, 7: 2}
+
+    kbdtables = compile_kbd_tables(layout)
+    assert {bits: column for bits, column in enumerate(kbdtables.pCharModifiers.ModNumber)
+            if column != 0x0F} == columns  # SHFT_INVALID
+    wchars, = (wchars for table in kbdtables.pVkToWcharTable for wchars in table.pVkToWchars
+               if wchars.VirtualKey == ord('X'))
+    assert wchars.wch == ['x', 'X', 'X']
+    assert compile_kbd_tables(dense) == kbdtables
+
+    images = []
+    for compiled in (layout, dense):
+        windll = WinDll(compiled, arch)
+        windll.timestamp = 1
+        images.append(windll.compile())
+    assert images[0] == images[1]
+    assert images[0] == _compile(layout, arch)
+    kbdtables = dll.Decompiler(images[0]).decompile()[0]
+    assert {bits: column for bits, column in enumerate(kbdtables.pCharModifiers.ModNumber)
+            if column != 0x0F} == columns  # SHFT_INVALID
+
+    dll_arch = {X86: dll.X86, WOW64: dll.WOW64, AMD64: dll.AMD64}[arch]
+    images = [dll.Compiler(dll_arch, compile_kbd_tables(compiled), compile_resources(compiled), 1,
+                           compiled.dll_name).compile()
+              for compiled in (layout, dense)]
+    assert images[0] == images[1]
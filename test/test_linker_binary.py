@@ -16,11 +16,13 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from dataclasses import dataclass
+from io import BytesIO
+import json
 from typing import Optional
 
 from pytest import raises, mark
 
-from PyKbd.linker_binary import BinaryObject, link, Symbol
+from PyKbd.linker_binary import BinaryObject, LinkerMap, MapEntry, link, link_into, link_to, Symbol
 
 
 @dataclass(frozen=True)
@@ -246,3 +248,97 @@ def test_alignment_invalid():
     b = BinaryObject(alignment=2)
     with raises(ValueError):
         a.append(b)
+
+
+def _link_objects():
+    a = BinaryObject(b'\xAA', alignment=4)
+    b = BinaryObject(b'\xBB\xBB', alignment=4)
+    c = BinaryObject(b'\xCC', alignment=2)
+    a.append(_TestSymbol(c, 0x33))
+    b.append(_TestSymbol(a, 0x44))
+    return [a, b], c
+
+
+def test_link_to():
+    objects, c = _link_objects()
+    target = link(objects, base=0x10)
+
+    objects, c = _link_objects()
+    out = BytesIO()
+    length = link_to(objects, out, base=0x10)
+
+    assert target.data == out.getvalue()
+    assert len(target.data) == length
+    assert (None, 0x18) == c.find_placement()
+
+
+def test_link_into():
+    objects, c = _link_objects()
+    target = link(objects)
+
+    objects, c = _link_objects()
+    out = bytearray(b'\x55' * 16)
+    length = link_into(objects, out)
+
+    assert target.data == out[:length]
+    assert b'\x55' * (16 - length) == out[length:]
+
+    objects, c = _link_objects()
+    with raises(ValueError):
+        link_into(objects, bytearray(length - 1))
+
+
+def test_linker_map():
+    a = BinaryObject(b'\xAA', alignment=4, name="A")
+    b = BinaryObject(b'\xBB\xBB', alignment=4)
+    c = BinaryObject(b'\xCC', alignment=2, name="C")
+    a.append(_TestSymbol(b, 0x33))
+    inner = link([a], base=0x10)
+    inner.placement = None
+    out = link([inner, c], base=0x10)
+
+    linker_map = LinkerMap()
+    linker_map.add(".data", out)
+    section, = linker_map.sections
+    assert section.address == 0x10
+    # b is listed after the object referencing it
+    assert section.entries == [
+        MapEntry("A", 0x10, 2, 4, 0),
+        MapEntry("A[]", 0x14, 2, 4, 2),
+        MapEntry("C", 0x16, 1, 2, 0),
+    ]
+    assert section.size == 7
+    assert section.padding == 2
+    assert b.name is None
+    assert linker_map.totals() == {"A": 2, "A[]": 2, "C": 1}
+
+    data = json.loads(linker_map.to_json())
+    assert data["sections"][0]["size"] == 7
+    assert data["totals"] == [{"name": "A", "size": 2}, {"name": "A[]", "size": 2}, {"name": "C", "size": 1}]
+    assert "0x00000014      2     4    2  A[]" in linker_map.to_text()
+
+
+@mark.parametrize("stream", [False, True], ids=["link", "link_to"])
+def test_linker_map_names(stream: bool):
+    # names are derived per map, linking does not rename the objects
+    shared = BinaryObject(b'\xBB')
+    nested = BinaryObject(b'\xDD')
+    shared.append(_TestSymbol(nested))
+    labels = []
+    for referrer in ("X", "Y"):
+        first = BinaryObject(b'\xAA', name=referrer)
+        first.append(_TestSymbol(shared))
+        second = BinaryObject(b'\xCC', name="Z")
+        second.append(_TestSymbol(shared))
+        shared.placement = nested.placement = None
+        if stream:
+            link_to([first, second], BytesIO())
+            out = first.placement[0]
+        else:
+            out = link([first, second])
+        linker_map = LinkerMap()
+        linker_map.add(".data", out)
+        labels.append([entry.name for entry in linker_map.sections[0].entries])
+    assert shared.name is None and nested.name is None
+    # the shared object is listed after the first object referencing it in link order
+    assert labels == [["X", "Z", "X[]", "X[][]"], ["Y", "Z", "Y[]", "Y[][]"]]
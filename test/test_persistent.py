@@ -0,0 +1,87 @@
+# This file is part of PyKbd
+#
+# Copyright (C) 2019-2020  Nulano
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pickle
+import random
+
+from pytest import raises
+
+from PyKbd.persistent import PMap
+
+
+class Key:
+    """key with a chosen hash, to force collisions and deep tries"""
+
+    def __init__(self, value: int, hash: int):
+        self.value = value
+        self.hash = hash
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        return isinstance(other, Key) and other.value == self.value
+
+    def __repr__(self):
+        return "Key(%i)" % self.value
+
+
+def random_key(rnd: random.Random):
+    value = rnd.randint(0, 100)
+    if value < 50:
+        return value * 37
+    # few distinct hashes sharing low bits
+    return Key(value, [0, 32, 1024, 1 << 40, (1 << 40) + 32, -1][value % 6])
+
+
+def test_pmap_random():
+    rnd = random.Random(0)
+    for _ in range(100):
+        pmap, expected, versions = PMap(), {}, []
+        for _ in range(rnd.randint(1, 200)):
+            key = random_key(rnd)
+            if rnd.random() < 0.6:
+                expected[key] = value = rnd.random()
+                pmap = pmap.set(key, value)
+            elif key in expected:
+                del expected[key]
+                pmap = pmap.delete(key)
+            else:
+                with raises(KeyError):
+                    pmap.delete(key)
+                assert pmap.discard(key) is pmap
+            versions.append((pmap, dict(expected)))
+            assert len(pmap) == len(expected)
+            assert pmap == expected and dict(pmap.items()) == expected
+        # old versions are unchanged
+        for pmap, expected in versions:
+            assert pmap == expected
+        assert pickle.loads(pickle.dumps(pmap)) == pmap
+        assert PMap(expected) == pmap and hash(PMap(expected)) == hash(pmap)
+
+
+def test_pmap_sharing():
+    pmap = PMap((i, str(i)) for i in range(1000))
+    assert pmap.set(5, pmap[5]) is pmap
+    assert pmap.update({5: pmap[5], 6: pmap[6]}) is pmap
+    assert PMap(pmap) == pmap
+
+    pmap2 = pmap.set(5, "five")
+    assert pmap[5] == "5" and pmap2[5] == "five"
+    assert pmap2.get(1000) is None and 1000 not in pmap2
+    # only the path to the changed key is copied
+    assert sum(a is b for a, b in zip(pmap._root.entries, pmap2._root.entries)) == len(pmap._root.entries) - 1
@@ -0,0 +1,91 @@
+# This file is part of PyKbd
+#
+# Copyright (C) 2019-2020  Nulano
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from io import BytesIO
+import threading
+
+import pytest
+
+from PyKbd.compile_windll import WinDll
+from PyKbd.layout import Layout
+from PyKbd.pipeline import Pipeline, Stage
+from PyKbd.windows import dll
+from PyKbd.windows.compiler import compile_kbd_tables, compile_resources
+
+
+def test_compile_pipeline(windll: WinDll):
+    calls = []
+    pipeline = WinDll.default_pipeline()
+    pipeline.trace_memory = True
+    pipeline.before.append(lambda stage, target: calls.append(("before", stage.name)))
+    pipeline.after.append(lambda stage, target, stats: calls.append(("after", stats.name)))
+    pipeline.insert_after("compile_tables", Stage("custom", lambda target: calls.append(("run", "custom"))))
+
+    windll2 = WinDll(windll.layout, windll.architecture, pipeline=pipeline)
+    windll2.timestamp = windll.timestamp
+    assert windll2.compile() == windll.compile()
+
+    names = pipeline.names
+    assert names[:4] == ["compile_kbd_keymap", "compile_kbd_charmap", "compile_tables", "custom"]
+    assert names[-1] == "assemble"
+    assert calls[calls.index(("before", "custom")) + 1] == ("run", "custom")
+    assert [stats.name for stats in windll2.stage_stats] == names
+    stats = {stats.name: stats for stats in windll2.stage_stats}
+    assert stats["compile_tables"].output_size == len(windll2.kbdtables.data)
+    assert stats["assemble"].output_size == len(windll2.assembly.data)
+    assert all(stats.wall_time >= 0 and stats.allocated is not None for stats in windll2.stage_stats)
+    assert "compile_header" in Pipeline.report(windll2.stage_stats)
+
+    # writing the output replaces the assemble stage
+    out = BytesIO()
+    windll2.compile_to(out)
+    assert out.getvalue() == windll.compile()
+    assert "assemble" not in [stats.name for stats in windll2.stage_stats]
+
+
+def test_shared_pipeline(windll: WinDll):
+    # compilers running at the same time keep the stats of their own run
+    pipeline = WinDll.default_pipeline()
+    barrier = threading.Barrier(2)
+    pipeline.insert_after("compile_tables", Stage("wait", lambda target: barrier.wait()))
+    compilers = [WinDll(windll.layout, windll.architecture, pipeline=pipeline) for _ in range(2)]
+    compilers[1].merge_sections = True
+    threads = [threading.Thread(target=compiler.compile) for compiler in compilers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for compiler in compilers:
+        stats = {stats.name: stats for stats in compiler.stage_stats}
+        assert stats["assemble"].output_size == len(compiler.assembly.data)
+
+
+@pytest.mark.parametrize("arch", [dll.X86, dll.WOW64, dll.AMD64], ids=["x86", "WoW64", "amd64"])
+def test_compiler_pipeline(layout: Layout, arch: dll.Architecture):
+    def compiler():
+        return dll.Compiler(arch, compile_kbd_tables(layout), compile_resources(layout), 1, layout.dll_name)
+
+    compiler1 = compiler()
+    data = compiler1.compile()
+    assert [stats.name for stats in compiler1.stage_stats] == compiler1.pipeline.names
+    assert compiler1.stage_stats[-1].output_size == len(data)
+
+    compiler2 = compiler()
+    out = BytesIO()
+    compiler2.compile_to(out)
+    assert out.getvalue() == data
+    assert compiler2.stage_stats[-1].name == "linker_map"
@@ -0,0 +1,85 @@
+# This file is part of PyKbd
+#
+# Copyright (C) 2019-2020  Nulano
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pstats
+import threading
+
+import pytest
+
+from PyKbd import cli, profiling
+from PyKbd.compile_windll import WinDll
+from PyKbd.layout import Layout
+from PyKbd.profiling import Profiler
+
+
+@pytest.mark.parametrize("mode", ["cprofile", "sample"])
+def test_compile_profile(windll: WinDll, tmp_path, mode):
+    data = windll.compile()
+    profiler = Profiler(mode, interval=0.0001)
+    for i in range(2):
+        windll2 = WinDll(windll.layout, windll.architecture)
+        windll2.timestamp = windll.timestamp
+        assert windll2.compile(profile=profiler) == data
+    WinDll().decompile(data, profile=profiler)
+
+    assert [run.name for run in profiler.runs] == ["compile kbdtst.dll"] * 2 + ["decompile"]
+    assert all(run.wall_time > 0 and run.peak_memory > 0 for run in profiler.runs)
+
+    path = tmp_path / "profile"
+    profiler.dump(path)
+    if mode == "cprofile":
+        stats = pstats.Stats(str(path))
+        assert any(name == "compile_tables" for _, _, name in stats.stats)
+    else:
+        for line in path.read_text().splitlines():
+            stack, count = line.rsplit(" ", 1)
+            assert int(count) > 0
+
+
+def test_profile_threads(windll: WinDll):
+    profiler = Profiler()
+    entered = threading.Event()
+    release = threading.Event()
+
+    def idle():
+        with profiler.run("idle"):
+            entered.set()
+            release.wait()
+
+    thread = threading.Thread(target=idle)
+    thread.start()
+    entered.wait()
+    # a run of another thread is not nested in the running one
+    WinDll(windll.layout, windll.architecture).compile(profile=profiler)
+    release.set()
+    thread.join()
+
+    assert sorted(run.name for run in profiler.runs) == ["compile kbdtst.dll", "idle"]
+    assert any(name == "compile_tables" for _, _, name in profiler.stats().stats)
+
+
+def test_profile_workers(layout: Layout, tmp_path, monkeypatch):
+    for name in ("a", "b"):
+        (tmp_path / (name + ".json")).write_text(layout.to_json(), encoding="utf-8")
+    monkeypatch.setenv(profiling.ENVIRONMENT_VARIABLE, str(tmp_path / "profile.pstats"))
+    assert cli.main(["compile", "-a", "x86", "-j", "2", str(tmp_path / "*.json")]) == 0
+
+    paths = list(tmp_path.glob("profile.*.pstats"))
+    assert paths
+    calls = sum(stats[1] for path in paths for (_, _, name), stats in pstats.Stats(str(path)).stats.items()
+                if name == "compile_tables")
+    assert calls == 2
@@ -0,0 +1,139 @@
+# This file is part of PyKbd
+#
+# Copyright (C) 2019-2020  Nulano
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import http.client
+import threading
+
+import pytest
+
+from PyKbd import cli, server
+from PyKbd.compile_windll import WinDll
+from PyKbd.layout import *
+
+
+def _recompile(layout: Layout, windll: WinDll, data: bytes) -> bytes:
+    """Compile layout for the architecture of windll with the timestamp of data"""
+    decompiled = WinDll()
+    decompiled.decompile(data)
+    compiler = WinDll(layout, windll.architecture)
+    compiler.timestamp = decompiled.timestamp
+    return compiler.compile()
+
+
+def _post_headers(srv: server.Server, path: str, length: int) -> http.client.HTTPResponse:
+    """Send only the headers of a POST request and return the response"""
+    connection = http.client.HTTPConnection(*srv.address, timeout=10)
+    connection.putrequest("POST", path)
+    connection.putheader("Content-Length", str(length))
+    connection.endheaders()
+    return connection.getresponse()
+
+
+@pytest.mark.parametrize("transport", ["tcp", "unix"])
+def test_server(windll: WinDll, tmp_path, transport):
+    if transport == "unix" and not hasattr(server.socket, "AF_UNIX"):
+        pytest.skip("Unix sockets are not supported")
+    address = str(tmp_path / "socket") if transport == "unix" else ("127.0.0.1", 0)
+    arch = next(name for name, arch in cli.ARCHITECTURES.items() if arch == windll.architecture)
+    data = windll.compile()
+
+    with server.Server(address, workers=2) as srv:
+        client = server.Client(srv.address)
+        result = client.compile(windll.layout, [arch])
+        name = windll.layout.dll_name[:-4] + windll.architecture.suffix + ".dll"
+        assert list(result.artifacts) == [name]
+        compiled = result.artifacts[name]
+        assert compiled == _recompile(Layout.from_json(windll.layout.to_json()), windll, compiled)
+        assert result.metrics["job"] == "compile"
+        assert result.metrics["output_size"] == len(data)
+        assert result.metrics["run_time"] >= 0 and result.metrics["queue_time"] >= 0
+
+        result = client.decompile(data)
+        windll2 = WinDll()
+        windll2.decompile(data)
+        assert Layout.from_json(result.artifacts[windll.layout.dll_name[:-4] + ".json"].decode()) == windll2.layout
+
+        with pytest.raises(server.ServerError) as e:
+            client.decompile(b"not a dll")
+        assert e.value.status == 400
+        assert client.status()["completed"] == 2
+        assert client.status()["failed"] == 1
+
+
+def test_server_errors(monkeypatch):
+    def fail(data, params):
+        raise RuntimeError("broken")
+    monkeypatch.setitem(server.JOBS, "fail", fail)
+
+    with server.Server(workers=1, max_body=1024, processes=False) as srv:
+        client = server.Client(srv.address)
+        with pytest.raises(server.ServerError) as e:
+            client.compile("{")
+        assert e.value.status == 400
+        # only known keyboards are looked up in the visualizer
+        for keyboard in ("dvorak", "draw_keyboard", "__name__"):
+            with pytest.raises(server.ServerError) as e:
+                client.render("{}", keyboard)
+            assert (e.value.status, e.value.message) == (400, "ValueError: unknown keyboard: %s" % keyboard)
+        with pytest.raises(server.ServerError) as e:
+            client._job("fail", b"")
+        assert (e.value.status, e.value.message) == (500, "RuntimeError: broken")
+
+        # the body is neither read nor sent before the size is checked
+        response = _post_headers(srv, "/decompile", 1025)
+        assert response.status == 413
+        assert client.status()["failed"] == 5
+
+
+def test_server_busy(monkeypatch):
+    release = threading.Event()
+    monkeypatch.setitem(server.JOBS, "block", lambda data, params: release.wait() and {})
+
+    with server.Server(workers=1, backlog=1, processes=False) as srv:
+        client = server.Client(srv.address)
+        threads = [threading.Thread(target=client._job, args=("block", b"")) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        while client.status()["admitted"] < 2:
+            release.wait(0.01)
+        with pytest.raises(server.ServerBusy):
+            client._job("block", b"")
+        # rejected before waiting for the body
+        response = _post_headers(srv, "/block", 100)
+        assert response.status == 503
+        assert response.getheader("Retry-After") == "1"
+        release.set()
+        for thread in threads:
+            thread.join()
+        assert client.status() == dict(completed=2, failed=0, rejected=2, workers=1, backlog=1, admitted=0)
+
+
+def test_server_processes(layout: Layout):
+    # compiles run in worker processes, in parallel
+    with server.Server(workers=2) as srv:
+        client = server.Client(srv.address)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(client.compile(layout, ["amd64"])))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(results) == 4
+        assert all(list(result.artifacts) == ["kbdtst64.dll"] for result in results)
+        assert client.status()["completed"] == 4
+    assert isinstance(srv._executor, server.ProcessPoolExecutor)
@@ -0,0 +1,115 @@
+# This file is part of PyKbd
+#
+# Copyright (C) 2019-2020  Nulano
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+from dataclasses import replace
+import threading
+import warnings
+
+import pytest
+
+from PyKbd import tracing
+from PyKbd.compile_windll import WinDll
+from PyKbd.layout import *
+from PyKbd.pipeline import Stage
+from PyKbd.wintypes import X86
+
+
+def test_compile_trace(windll: WinDll, tmp_path):
+    pipeline = WinDll.default_pipeline()
+    pipeline.insert_after("link", Stage("check", lambda target: tracing.warn("custom warning")))
+    windll2 = WinDll(Layout.from_json(windll.layout.to_json()), windll.architecture, pipeline=pipeline)
+    windll2.timestamp = windll.timestamp
+
+    path = tmp_path / "trace.jsonl"
+    with tracing.traced(path):
+        with pytest.warns(UserWarning, match="custom warning"):
+            windll2.compile_to(tmp_path / "out.dll")
+    assert tracing.current() is None
+
+    events = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [event["event"] for event in events[-3:]] == ["stage", "write", "compile"]
+    stages = {event["stage"]: event for event in events if event["event"] == "stage"}
+    assert stages["check"]["warnings"] == ["custom warning"]
+    assert "warnings" not in stages["link"]
+    compiled = events[-1]
+    assert compiled["layout"] == windll.layout.name
+    assert compiled["architecture"] == windll.architecture.name
+    assert compiled["size"] == (tmp_path / "out.dll").stat().st_size
+    windll3 = WinDll(windll2.layout, windll.architecture)
+    windll3.timestamp = windll.timestamp
+    assert (tmp_path / "out.dll").read_bytes() == windll3.compile()
+    assert compiled["warnings"] == ["custom warning"]
+    assert all(event["duration"] >= 0 for event in events)
+
+    events = []
+    with tracing.traced(events.append):
+        Layout.from_json(windll.layout.to_json())
+    load, = events
+    assert load["event"] == "load"
+    assert load["layout"] == windll.layout.name
+
+
+def test_trace_threads():
+    events = []
+    barrier = threading.Barrier(2)
+
+    def run(name):
+        with tracing.span("outer", layout=name):
+            with tracing.span("inner"):
+                barrier.wait()
+                tracing.warn("warning of %s" % name)
+                barrier.wait()
+
+    with tracing.traced(events.append):
+        with pytest.warns(UserWarning):
+            threads = [threading.Thread(target=run, args=(name,)) for name in ("a", "b")]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+    assert len(events) == 4
+    for event in events:
+        assert event["warnings"] == ["warning of %s" % event["layout"]]
+
+
+def test_trace_repeated_warning(layout: Layout):
+    layout = replace(layout, keymap={**layout.keymap, ScanCode(0x48, 0xE0): KeyCode(0x126, 'Up')},
+                     charmap={**layout.charmap, 0x126: {ShiftState(): Character('u')}})
+
+    compiled = []
+    with tracing.traced(lambda event: compiled.append(event) if event["event"] == "compile" else None):
+        with warnings.catch_warnings(record=True) as shown:
+            # the second warning is not shown, but still traced
+            warnings.simplefilter("once")
+            for _ in range(2):
+                WinDll(layout, X86).compile()
+    assert len(shown) == 1
+    assert len(compiled) == 2
+    for event in compiled:
+        assert event["warnings"] == ["unknown special vk, skipping: 0x126"]
+
+
+def test_trace_other_warnings():
+    events = []
+    with tracing.traced(events.append):
+        with pytest.warns(UserWarning, match="not traced"):
+            with tracing.span("event"):
+                warnings.warn("not traced")
+    event, = events
+    assert "warnings" not in event
@@ -0,0 +1,110 @@
+# This file is part of PyKbd
+#
+# Copyright (C) 2019-2020  Nulano
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+
+from PyKbd import tracing
+from PyKbd.compile_windll import WinDll
+from PyKbd.layout import *
+from PyKbd.watch import Watcher
+from PyKbd.wintypes import AMD64, X86
+
+
+def _recompile(layout: Layout, windll: WinDll, data: bytes) -> bytes:
+    """Compile layout for the architecture of windll with the timestamp of data"""
+    decompiled = WinDll()
+    decompiled.decompile(data)
+    compiler = WinDll(layout, windll.architecture)
+    compiler.timestamp = decompiled.timestamp
+    return compiler.compile()
+
+
+def test_watch(windll: WinDll, tmp_path):
+    path = tmp_path / "layout.json"
+    target = tmp_path / ("layout" + windll.architecture.suffix + ".dll")
+
+    def write(text, mtime):
+        path.write_text(text, encoding="utf-8")
+        os.utime(path, ns=(mtime, mtime))
+
+    write(windll.layout.to_json(), 10 ** 18)
+    watcher = Watcher([str(tmp_path / "*.json")], [windll.architecture], debounce=0)
+    results = watcher.step()
+    assert [(result["output"], result["size"]) for result in results] == [(str(target), target.stat().st_size)]
+    layout = Layout.from_json(windll.layout.to_json())
+    assert target.read_bytes() == _recompile(layout, windll, target.read_bytes())
+    assert watcher.step() == []
+
+    # unchanged source and unchanged layout are not compiled
+    write(windll.layout.to_json(), 2 * 10 ** 18)
+    assert watcher.step() == []
+    write(json.dumps(json.loads(windll.layout.to_json())), 3 * 10 ** 18)
+    assert watcher.step() == []
+
+    data = json.loads(windll.layout.to_json())
+    data["name"] = "Changed"
+    write(json.dumps(data), 4 * 10 ** 18)
+    assert [result["architecture"] for result in watcher.step()] == [windll.architecture.name]
+    changed = Layout.from_json(json.dumps(data))
+    assert target.read_bytes() == _recompile(changed, windll, target.read_bytes())
+
+    # changes are compiled once they settle
+    watcher.debounce = 3600
+    write("{", 5 * 10 ** 18)
+    assert watcher.step() == []
+    watcher.debounce = 0
+    assert "error" in watcher.step()[0]
+    assert watcher.step() == []
+
+    # a failed compile is retried with the same source once the file is saved again
+    target.unlink()
+    target.mkdir()
+    write(windll.layout.to_json(), 6 * 10 ** 18)
+    assert "error" in watcher.step()[0]
+    target.rmdir()
+    write(windll.layout.to_json(), 7 * 10 ** 18)
+    assert [result["output"] for result in watcher.step()] == [str(target)]
+    assert target.read_bytes() == _recompile(layout, windll, target.read_bytes())
+
+
+def test_watch_shared(layout: Layout, tmp_path):
+    path = tmp_path / "layout.json"
+    path.write_text(layout.to_json(), encoding="utf-8")
+    os.utime(path, ns=(10 ** 18, 10 ** 18))
+
+    # the output DLLs match the pattern too, but only layouts are compiled
+    watcher = Watcher([str(tmp_path / "*")], [X86, AMD64], debounce=0)
+    assert [result["architecture"] for result in watcher.step()] == [X86.name, AMD64.name]
+    assert watcher.step() == []
+
+    # tables of unchanged parts of the layout are reused by the next compile
+    data = json.loads(layout.to_json())
+    data["name"] = "Changed"
+    path.write_text(json.dumps(data), encoding="utf-8")
+    os.utime(path, ns=(2 * 10 ** 18, 2 * 10 ** 18))
+    events = []
+    with tracing.traced(events.append):
+        results = watcher.step()
+    assert all("error" not in result for result in results)
+    hits = [event.get("cache_hits", 0) for event in events if event["event"] == "compile"]
+    assert hits == [2, 3]
+
+    changed = Layout.from_json(json.dumps(data))
+    for arch in (X86, AMD64):
+        target = tmp_path / ("layout" + arch.suffix + ".dll")
+        assert target.read_bytes() == _recompile(changed, WinDll(changed, arch), target.read_bytes())
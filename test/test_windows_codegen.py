@@ -0,0 +1,87 @@
+# This file is part of PyKbd
+#
+# Copyright (C) 2019-2020  Nulano
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from dataclasses import MISSING, fields, is_dataclass
+import random
+
+import pytest
+
+from PyKbd.layout import Layout
+from PyKbd.linker_binary import BinaryObject
+from PyKbd.pipeline import Stage
+from PyKbd.windows import codegen, dll, types
+from PyKbd.windows.compiler import compile_kbd_tables, compile_resources
+from PyKbd.windows.dll import Assembler, Decompiler
+from PyKbd.windows.structs import StructLayout
+
+
+def _fixed_structs():
+    for module in (types, dll):
+        for value in vars(module).values():
+            if is_dataclass(value) and isinstance(value, type) and value.__module__ == module.__name__:
+                for ptr_size in (4, 8):
+                    if StructLayout.is_fixed(value, ptr_size):
+                        yield pytest.param(value, ptr_size, id="%s-%i" % (value.__name__, ptr_size))
+
+
+@pytest.mark.parametrize("tp, ptr_size", list(_fixed_structs()))
+def test_codegen(tp, ptr_size: int):
+    layout = StructLayout.of(tp, ptr_size)
+    # printable bytes decode as any integer or string field, pointers are null
+    rng = random.Random("%s %i" % (tp.__name__, ptr_size))
+    data = bytearray(rng.randrange(0x20, 0x7F) for _ in range(layout.size))
+    for leaf in layout.fields.values():
+        if leaf.pointer is not None:
+            data[leaf.offset:leaf.offset + leaf.size] = bytes(leaf.size)
+
+    data = BinaryObject(bytes(data), alignment=16)
+
+    generic = Assembler(ptr_size, codegen=False)
+    generated = Assembler(ptr_size)
+    assert codegen.generate(tp, ptr_size) is not None
+    obj = generated.decompile(data, tp)
+    # the generic decoder needs default values
+    if all(field.default is not MISSING or field.default_factory is not MISSING for field in fields(tp)):
+        assert generic.decompile(data, tp) == obj
+
+    expected = generic.compile(obj)
+    compiled = generated.compile(obj)
+    assert compiled.data == expected.data
+    assert compiled.alignment == expected.alignment
+    assert compiled.symbols == expected.symbols
+    assert generated.decompile(BinaryObject(compiled.data, alignment=16), tp) == obj
+
+
+def test_codegen_variable():
+    assert codegen.generate(types.MODIFIERS, 4) is None
+    assert codegen.load(types.VK_TO_WCHARS, 8) is None
+
+
+@pytest.mark.parametrize("arch", [dll.X86, dll.WOW64, dll.AMD64], ids=["x86", "WoW64", "amd64"])
+def test_codegen_image(layout: Layout, arch: dll.Architecture):
+    # pointers are compiled and decompiled through the Assembler by both encoders
+    images = []
+    for use_codegen in (False, True):
+        compiler = dll.Compiler(arch, compile_kbd_tables(layout), compile_resources(layout), 1, layout.dll_name)
+        compiler.pipeline.replace("assembler", Stage("assembler", lambda target, use_codegen=use_codegen: setattr(
+            target, "assembler", Assembler(arch.pointer_native, codegen=use_codegen))))
+        images.append(compiler.compile())
+    assert images[0] == images[1]
+
+    decompiled = [Decompiler(images[0], assembler=Assembler(4, codegen=use_codegen)).decompile()
+                  for use_codegen in (False, True)]
+    assert decompiled[0] == decompiled[1]
@@ -0,0 +1,236 @@
+# This file is part of PyKbd
+#
+# Copyright (C) 2019-2020  Nulano
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from dataclasses import dataclass
+from io import BytesIO
+import pickle
+import struct
+import sys
+import threading
+
+import pytest
+
+from PyKbd.compile_windll import WinDll
+from PyKbd.layout import Layout
+from PyKbd.linker_binary import BinaryObject, LinkerMap, link
+from PyKbd.windows import dll
+from PyKbd.windows.compiler import compile_kbd_tables, compile_resources
+from PyKbd.windows.dll import Assembler, Decompiler, HeaderCOFF, HeaderDOS, sniff
+from PyKbd.windows.structs import _prefix_layout
+from PyKbd.windows.types import *
+
+
+@dataclass()
+class _Node:
+    value: DWORD = 0
+    next: PTR["_Node"] = None
+
+
+@dataclass()
+class _Pair:
+    first: PTR[_Node] = None
+    second: PTR[_Node] = None
+
+
+def _nodes(*links: int) -> bytes:
+    """Nodes at offsets 8, 16, ..., the i-th links to the node at links[i], 0 is null"""
+    return bytes(8) + b"".join(struct.pack("<II", i, link) for i, link in enumerate(links))
+
+
+def test_decompile_cycle():
+    assembler = Assembler(4)
+    with pytest.raises(ValueError, match="pointer cycle at 0x10"):
+        assembler.decompile(_nodes(16, 8), _Node, off=8)
+    with pytest.raises(ValueError, match="pointer cycle"):
+        assembler.decompile(_nodes(16, 16), _Node, off=8)
+
+
+def test_decompile_shared():
+    assembler = Assembler(4)
+    data = struct.pack("<II", 8, 8) + _nodes(0)[8:]
+    pair = assembler.decompile(data, _Pair)
+    assert pair.first == _Node(0, None)
+    assert pair.first is pair.second
+
+    # targets are shared within one decompile() call only
+    assert assembler.decompile(data, _Pair).first is not pair.first
+
+
+def test_decompile_max_nodes():
+    assembler = Assembler(4)
+    data = _nodes(16, 24, 32, 0)
+    node = assembler.decompile(data, _Node, off=8, max_nodes=3)
+    assert [node.value, node.next.value, node.next.next.value, node.next.next.next.value] == [0, 1, 2, 3]
+    assert assembler.decompile(data, _Node, off=8, max_nodes=None) == node
+    with pytest.raises(ValueError, match="more than 2"):
+        assembler.decompile(data, _Node, off=8, max_nodes=2)
+
+
+
+@dataclass()
+class _Blob:
+    value: DWORD = 0
+    node: PTR[_Node] = None
+    blob: PTR[BinaryObject] = None
+
+
+@pytest.mark.parametrize("codegen", [False, True], ids=["generic", "codegen"])
+def test_compile_names(codegen: bool):
+    # objects compiled by the Assembler are named after the struct field, objects of the caller are not renamed
+    blob = BinaryObject(b"\xAA" * 4, alignment=4)
+    out = Assembler(4, codegen=codegen).compile(_Blob(1, _Node(2), blob))
+    assert blob.name is None
+    assert out.name == "_Blob"
+    assert sorted(symbol.target.name or "" for symbol in out.symbols.values()) == ["", "_Blob.node"]
+
+    linker_map = LinkerMap()
+    linker_map.add(".data", link([out]))
+    assert [entry.name for entry in linker_map.sections[0].entries] == ["_Blob", "_Blob.node", "_Blob[]"]
+
+
+@pytest.mark.parametrize("arch", [dll.X86, dll.WOW64, dll.AMD64], ids=["x86", "WoW64", "amd64"])
+def test_compiler_optimize_size(layout: Layout, arch: dll.Architecture):
+    def compile(kbdtables, timestamp: int = 1, **options) -> bytes:
+        compiler = dll.Compiler(arch, kbdtables, compile_resources(layout), timestamp, layout.dll_name, **options)
+        return compiler.compile()
+
+    def size_of_image(image: bytes) -> int:
+        return Assembler(arch.pointer_native).decompile(image, HeaderDOS).pe.opt.SizeOfImage
+
+    default = compile(compile_kbd_tables(layout))
+    for optimize_size in (False, True):
+        for merge_sections in (False, True):
+            options = dict(optimize_size=optimize_size, merge_sections=merge_sections)
+            data = compile(compile_kbd_tables(layout), **options)
+            # only merging sections saves file alignment padding
+            assert (len(data) < len(default)) == merge_sections
+            assert len(data) % 0x200 == 0
+            assert (size_of_image(data) < 0x1000) == optimize_size
+            header = Assembler(arch.pointer_native).decompile(data, HeaderDOS)
+            assert len(header.pe.sections) == (2 if merge_sections else 3)
+            # only .data with the code of KbdLayerDescriptor is executable
+            assert [section.Characteristics & 0x20000000 != 0 for section in header.pe.sections] == \
+                [True] + [False] * (len(header.pe.sections) - 1)
+            assert (header.pe.opt.SectionAlignment == header.pe.opt.FileAlignment) == optimize_size
+
+            kbdtables, versioninfo, timestamp, dll_name = Decompiler(data).decompile()
+            assert kbdtables == Decompiler(default).decompile()[0]
+            assert (timestamp, dll_name) == (1, layout.dll_name)
+            assert compile(kbdtables, timestamp, **options) == data
+
+
+def test_compiler_align_section(layout: Layout):
+    args = dll.X86, compile_kbd_tables(layout), compile_resources(layout), 1, layout.dll_name
+    with pytest.raises(ValueError, match="optimize_size requires align_section"):
+        dll.Compiler(*args, align_section=0x2000, optimize_size=True)
+    assert dll.Compiler(*args, align_section=0x200, optimize_size=True).align_section == 0x200
+    assert dll.Compiler(*args, align_section=0x2000).align_section == 0x2000
+
+
+@pytest.mark.parametrize("arch", [dll.X86, dll.WOW64, dll.AMD64], ids=["x86", "WoW64", "amd64"])
+def test_compiler_map(layout: Layout, arch: dll.Architecture):
+    kbdtables = compile_kbd_tables(layout)
+    maps = []
+    for merge_sections in (False, False, True):
+        compiler = dll.Compiler(arch, kbdtables, compile_resources(layout), 1, layout.dll_name,
+                                merge_sections=merge_sections, emit_map=True)
+        data = compiler.compile()
+        maps.append(compiler.linker_map)
+    assert maps[0] == maps[1]
+    assert [section.name for section in maps[0].sections] == ["headers", ".data", ".rsrc", ".reloc"]
+    assert [section.name for section in maps[2].sections] == ["headers", ".data", ".rsrc"]
+    # merged sections need one section header less
+    totals, merged = maps[0].totals(), maps[2].totals()
+    assert totals.pop("HeaderDOS.pe") - merged.pop("HeaderDOS.pe") == 40
+    assert merged == totals
+    assert sum(maps[2].totals().values()) + sum(section.padding for section in maps[2].sections) <= len(data)
+
+    headers, sec_data = maps[0].sections[:2]
+    assert [entry.name for entry in headers.entries] == ["HeaderDOS", "HeaderDOS.pe"]
+    names = [entry.name for entry in sec_data.entries]
+    assert names[:names.index("KBDTABLES")] == ["DirExport", "DirExport.name", "DirExport.addresses",
+                                                 "DirExport.names", "DirExport.ordinals", "DirExport.names[]",
+                                                 "KbdLayerDescriptor"]
+    # strings of a table of string pointers are listed after the table
+    assert names[-1] == "KBDTABLES.pKeyNamesDead[]"
+    assert sec_data.entries[-1].size == maps[0].totals()["KBDTABLES.pKeyNamesDead[]"]
+    assert {"KBDTABLES.pCharModifiers", "MODIFIERS.pVkToBit", "VK_TO_WCHAR_TABLE.pVkToWchars",
+            "VSC_LPWSTR.pwsz"} <= set(names)
+
+
+def test_sniff(windll: WinDll, tmp_path):
+    data = windll.compile()
+    path = tmp_path / windll.layout.dll_name
+    path.write_bytes(data)
+    decompiler = Decompiler(data)
+    decompiler.decompile()
+
+    for file in (data, path, BytesIO(data)):
+        info = sniff(file)
+        assert info.arch == decompiler.arch
+        assert info.arch.name == windll.architecture.name
+        assert info.timestamp == windll.timestamp
+        assert info.dll_name == windll.layout.dll_name
+        assert info.layout
+
+    assert sniff(b"") is None
+    assert sniff(b"MZ" + bytes(0x3E)) is None
+    assert sniff(data[:0x100]) is None
+
+    # unknown machine
+    pe = _prefix_layout(HeaderDOS, 4)[0].read(data, "pe")
+    machine = pe + _prefix_layout(HeaderCOFF, 4)[0].offsetof("Machine")
+    assert sniff(data[:machine] + b"\xFF\xFF" + data[machine + 2:]) is None
+
+
+@pytest.mark.parametrize("codegen", [False, True], ids=["generic", "codegen"])
+def test_assembler_threads(windll: WinDll, codegen):
+    data = windll.compile()
+    decompiler = Decompiler(data)
+    tables = decompiler.decompile()[0]
+    state = pickle.dumps(tables)
+    assembler = Assembler(decompiler.arch.pointer_tables, codegen=codegen)
+    expected = link([assembler.compile(tables)]).data
+    shared = Assembler(4, codegen=codegen)
+
+    errors = []
+    barrier = threading.Barrier(8)
+
+    def work():
+        try:
+            barrier.wait()
+            for _ in range(10):
+                assert link([assembler.compile(tables)]).data == expected
+                assert Decompiler(data, assembler=shared).decompile()[0] == tables
+        except Exception as e:
+            errors.append(e)
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+
+    assert errors == []
+    # neither the compiled tables nor the given assembler are modified
+    assert pickle.dumps(tables) == state
+    assert shared.ptr_size == 4
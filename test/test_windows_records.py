@@ -0,0 +1,47 @@
+# This file is part of PyKbd
+#
+# Copyright (C) 2019-2020  Nulano
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+
+from PyKbd.compile_windll import WinDll
+from PyKbd.linker_binary import link
+from PyKbd.windows import records
+from PyKbd.windows.dll import Assembler, Decompiler
+from PyKbd.windows.types import DEADKEY, USHORT, VK_TO_WCHARS, VSC_VK
+
+numpy = pytest.importorskip("numpy")
+
+
+def test_decompile_records(windll: WinDll):
+    data = windll.compile()
+    tables = Decompiler(data).decompile()[0]
+    decompiler = Decompiler(data, records=True)
+    arrays = decompiler.decompile()[0]
+    ptr_size = decompiler.arch.pointer_tables
+
+    assert isinstance(arrays.pVSCtoVK_E0, numpy.ndarray)
+    assert arrays.pVSCtoVK_E0.dtype == records.dtype(VSC_VK, ptr_size)
+    assert records.from_records(arrays.pVSCtoVK_E0, VSC_VK) == tables.pVSCtoVK_E0
+    assert records.from_records(arrays.pDeadKey, DEADKEY) == tables.pDeadKey
+    assert records.from_records(arrays.pusVSCtoVK, USHORT) == tables.pusVSCtoVK
+    wchars = tables.pVkToWcharTable[0].pVkToWchars
+    assert records.from_records(arrays.pVkToWcharTable[0].pVkToWchars, VK_TO_WCHARS) == wchars
+    assert records.from_records(records.to_records(wchars, VK_TO_WCHARS), VK_TO_WCHARS) == wchars
+
+    # structured arrays compile to the same bytes as lists
+    assembler = Assembler(ptr_size)
+    assert link([assembler.compile(arrays)]).data == link([assembler.compile(tables)]).data
@@ -0,0 +1,94 @@
+# This file is part of PyKbd
+#
+# Copyright (C) 2019-2020  Nulano
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+
+from PyKbd.windows.dll import DirExport, HeaderCOFF, HeaderDOS, Section
+from PyKbd.windows.structs import StructLayout, _prefix_layout
+from PyKbd.windows.types import *
+
+
+# offsets from kbd.h and the PE format specification
+_KBDTABLES = ["pCharModifiers", "pVkToWcharTable", "pDeadKey", "pKeyNames", "pKeyNamesExt", "pKeyNamesDead",
+              "pusVSCtoVK", "bMaxVSCtoVK", "pVSCtoVK_E0", "pVSCtoVK_E1", "fLocaleFlags", "nLgMax", "cbLgEntry",
+              "pLigature", "dwType", "dwSubType"]
+
+
+@pytest.mark.parametrize("ptr_size, offsets, size", [
+    (4, [0, 4, 8, 12, 16, 20, 24, 28, 32, 36, 40, 44, 45, 48, 52, 56], 60),
+    (8, [0, 8, 16, 24, 32, 40, 48, 56, 64, 72, 80, 84, 85, 88, 96, 100], 104),
+])
+def test_layout_kbdtables(ptr_size: int, offsets, size: int):
+    layout = StructLayout.of(KBDTABLES, ptr_size)
+    assert [layout.offsetof(name) for name in _KBDTABLES] == offsets
+    assert list(layout.fields) == _KBDTABLES
+    assert (layout.size, layout.alignment) == (size, ptr_size)
+    assert layout.fields["pCharModifiers"].pointer is MODIFIERS
+    assert layout.fields["bMaxVSCtoVK"].pointer is None
+
+
+@pytest.mark.parametrize("ptr_size", [4, 8])
+def test_layout_tables(ptr_size: int):
+    layout = StructLayout.of(VK_TO_WCHAR_TABLE, ptr_size)
+    assert [field.offset for field in layout.fields.values()] == [0, ptr_size, ptr_size + 1]
+    layout = StructLayout.of(VSC_LPWSTR, ptr_size)
+    assert [field.offset for field in layout.fields.values()] == [0, ptr_size]
+    assert StructLayout.of(VSC_VK, ptr_size).offsetof("Vk") == 2
+    layout = StructLayout.of(DEADKEY, ptr_size)
+    assert [field.offset for field in layout.fields.values()] == [0, 4, 6]
+    assert [element.offset for element in layout.fields["dwBoth"].elements] == [0, 2]
+
+
+@pytest.mark.parametrize("ptr_size", [4, 8])
+def test_layout_variable(ptr_size: int):
+    # only the leading fields of variable-length structs have a layout
+    assert not StructLayout.is_fixed(VK_TO_WCHARS, ptr_size)
+    with pytest.raises(TypeError):
+        StructLayout.of(VK_TO_WCHARS, ptr_size)
+    layout, complete = _prefix_layout(VK_TO_WCHARS, ptr_size)
+    assert not complete
+    assert [(name, field.offset) for name, field in layout.fields.items()] == [("VirtualKey", 0), ("Attributes", 1)]
+
+
+def test_layout_headers():
+    dos = StructLayout.of(HeaderDOS, 4)
+    assert (dos.offsetof("signature"), dos.offsetof("pe"), dos.size) == (0, 0x3C, 0x40)
+    assert dos.fields["pe"].pointer is HeaderCOFF
+
+    coff, complete = _prefix_layout(HeaderCOFF, 4)
+    assert not complete
+    assert [coff.offsetof(name) for name in ("Machine", "NumberOfSections", "TimeDateStamp",
+                                             "SizeOfOptionalHeader", "Characteristics")] == [4, 6, 8, 20, 22]
+    assert coff.size == 24
+
+    section = StructLayout.of(Section, 8)
+    assert [section.offsetof(name) for name in ("VirtualSize", "PointerToRawData", "Characteristics")] == [8, 20, 36]
+    assert section.size == 40
+    export = StructLayout.of(DirExport, 8)
+    assert [export.offsetof(name) for name in ("name", "addresses", "names", "ordinals")] == [12, 28, 32, 36]
+    assert export.size == 40
+
+
+def test_layout_access():
+    layout = StructLayout.of(KBDTABLES, 8)
+    buffer = bytearray(layout.size)
+    layout.write(buffer, "fLocaleFlags", (1, 2))
+    layout.write(buffer, "dwSubType", 0x12345678)
+    assert buffer[80:84] == b"\x01\x00\x02\x00"
+    assert buffer[100:104] == b"\x78\x56\x34\x12"
+    assert layout.read(bytes(4) + bytes(buffer), "dwSubType", 4) == 0x12345678
+    assert StructLayout.of(KBDTABLES, 8) is layout
@@ -0,0 +1,56 @@
+# This file is part of PyKbd
+#
+# Copyright (C) 2019-2020  Nulano
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import typing
+
+from PyKbd.compile_windll import WinDll
+from PyKbd.windows.dll import Decompiler
+from PyKbd.windows.view import ArrayView, StructView
+
+
+def test_decompile_view(windll: WinDll):
+    data = windll.compile()
+    tables = Decompiler(data).decompile()[0]
+    view = Decompiler(data, view=True).decompile()[0]
+
+    assert isinstance(view, StructView)
+    assert view.bMaxVSCtoVK == tables.bMaxVSCtoVK
+    assert view.fLocaleFlags == tables.fLocaleFlags
+    assert view.pCharModifiers.wMaxModBits == tables.pCharModifiers.wMaxModBits
+    # variable-length fields are decoded on access
+    assert view.pCharModifiers.ModNumber == tables.pCharModifiers.ModNumber
+    assert isinstance(view.pVkToWcharTable, ArrayView)
+    assert view.pVkToWcharTable[0].nModifications == tables.pVkToWcharTable[0].nModifications
+    assert [keys.materialize() for keys in view.pVkToWcharTable[0].pVkToWchars] == \
+           tables.pVkToWcharTable[0].pVkToWchars
+    assert list(view.pusVSCtoVK) == tables.pusVSCtoVK
+    assert view.pKeyNames[0].pwsz == tables.pKeyNames[0].pwsz
+    assert view.materialize() == tables
+
+
+def test_view_type_hints(windll: WinDll, monkeypatch):
+    view = Decompiler(windll.compile(), view=True).decompile()[0]
+    assert view.bMaxVSCtoVK is not None
+
+    # type hints are computed once per type, not on every access
+    def get_type_hints(*args, **kwargs):
+        raise AssertionError("type hints computed again")
+    monkeypatch.setattr(typing, "get_type_hints", get_type_hints)
+    view = Decompiler(windll.compile(), view=True).decompile()[0]
+    assert view.fLocaleFlags is not None
+    assert view.pCharModifiers.wMaxModBits is not None
+    assert "bMaxVSCtoVK" in dir(view)